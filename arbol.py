@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+from typing import Iterator, List, Tuple, Union
+
+from lxml import etree
+
+# Utilidades para trabajar con lxml.etree dejando el árbol y el html igual
+# que los dejaría BeautifulSoup(data, "xml"), para que los dos motores de
+# miepub.py den exactamente el mismo resultado
+
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+DECLARACION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+# bs4 deja los textos que solo tienen estos espacios en "\n" o " "
+re_blanco = re.compile(r"[ \n\t\f\r]+\Z")
+
+
+def _colapsa(s: Union[str, None]) -> Union[str, None]:
+    if s and s.isspace() and re_blanco.match(s):
+        return "\n" if "\n" in s else " "
+    return s
+
+
+def parse(data: bytes) -> etree._Element:
+    """
+    Parsea el xhtml y colapsa los textos en blanco como bs4
+    """
+    root = etree.fromstring(data, parser)
+    for el in root.iter():
+        if el.tag is not etree.Comment and el.tag is not etree.PI:
+            el.text = _colapsa(el.text)
+        el.tail = _colapsa(el.tail)
+    return root
+
+
+def nombre(el: etree._Element) -> str:
+    """
+    El .name de bs4: el nombre sin espacio de nombres, con el prefijo si
+    lo tiene
+    """
+    if not isinstance(el.tag, str):
+        return ""
+    local = el.tag[el.tag.find("}") + 1:]
+    return el.prefix + ":" + local if el.prefix else local
+
+
+def tag(el: etree._Element, name: str) -> str:
+    """
+    Tag de lxml para name en el mismo espacio de nombres que el
+    """
+    return el.tag[:el.tag.find("}") + 1] + name
+
+
+def clases(el: etree._Element) -> List[str]:
+    return (el.get("class") or "").split()
+
+
+def texto(el: etree._Element) -> str:
+    """
+    El get_text() de bs4 (sin comentarios)
+    """
+    return "".join(el.itertext())
+
+
+def antes(el: etree._Element, s: str):
+    """
+    Añade s al texto que hay justo antes de el
+    """
+    prev = el.getprevious()
+    if prev is not None:
+        prev.tail = (prev.tail or "") + s
+    else:
+        padre = el.getparent()
+        padre.text = (padre.text or "") + s
+
+
+def saca(el: etree._Element):
+    """
+    El extract() de bs4: quita el del árbol dejando el texto que le sigue
+    """
+    if el.getparent() is None:
+        return
+    if el.tail:
+        antes(el, el.tail)
+    el.tail = None
+    el.getparent().remove(el)
+
+
+def mueve(el: etree._Element, padre: etree._Element):
+    """
+    El padre.append(el) de bs4 para un el que ya está en el árbol
+    """
+    saca(el)
+    padre.append(el)
+
+
+def vacia(el: etree._Element):
+    """
+    Quita todo el contenido de el, como al asignar su .string en bs4
+    """
+    for hijo in list(el):
+        el.remove(hijo)
+    el.text = None
+
+
+def desenvuelve(el: etree._Element):
+    """
+    El unwrap() de bs4: sustituye el por su contenido
+    """
+    padre = el.getparent()
+    if padre is None:
+        return
+    if el.text:
+        antes(el, el.text)
+    i = padre.index(el)
+    hijos = list(el)
+    tail = el.tail
+    el.tail = None
+    padre.remove(el)
+    for j, hijo in enumerate(hijos):
+        padre.insert(i + j, hijo)
+    if tail:
+        if hijos:
+            hijos[-1].tail = (hijos[-1].tail or "") + tail
+        elif i > 0:
+            padre[i - 1].tail = (padre[i - 1].tail or "") + tail
+        else:
+            padre.text = (padre.text or "") + tail
+
+
+def _textos(el: etree._Element) -> Iterator[Tuple[etree._Element, str]]:
+    if el.text and isinstance(el.tag, str):
+        yield el, "text"
+    for hijo in el:
+        yield from _textos(hijo)
+        if hijo.tail:
+            yield hijo, "tail"
+
+
+def primer_texto(el: etree._Element, hasta: etree._Element) -> Union[Tuple[etree._Element, str], None]:
+    """
+    El find(string=True) de bs4 pero solo antes de hasta, un hijo de el.
+    Devuelve (nodo, "text" o "tail")
+    """
+    if el.text:
+        return el, "text"
+    for hijo in el:
+        if hijo is hasta:
+            return None
+        for t in _textos(hijo):
+            return t
+        if hijo.tail:
+            return hijo, "tail"
+    return None
+
+
+def nuevo(padre: etree._Element, name: str, i: int = None) -> etree._Element:
+    """
+    Crea un tag en el mismo espacio de nombres que padre y lo inserta en la
+    posición i (o al final). Como el insert de bs4, en la posición 0 va
+    antes del texto de padre
+    """
+    el = etree.SubElement(padre, tag(padre, name))
+    if i is not None:
+        padre.insert(i, el)
+        if i == 0:
+            el.tail = padre.text
+            padre.text = None
+    return el
+
+
+def _escapa(s: str) -> str:
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _valor(v: str) -> str:
+    v = _escapa(v)
+    if '"' not in v:
+        return '"' + v + '"'
+    if "'" not in v:
+        return "'" + v + "'"
+    return '"' + v.replace('"', "&quot;") + '"'
+
+
+def _serializa(el: etree._Element, out: List[str], ns_padre: dict):
+    if el.tag is etree.Comment:
+        out.append("<!--" + (el.text or "") + "-->")
+        return
+    if el.tag is etree.PI:
+        out.append("<?" + el.target + (" " + el.text if el.text else "") + "?>")
+        return
+    nsmap = el.nsmap
+    attrs = []
+    for k, v in el.attrib.items():
+        if k[0] == "{":
+            ns, _, local = k[1:].partition("}")
+            prefijo = "xml" if ns == XML_NS else next(p for p, u in nsmap.items() if u == ns and p)
+            k = prefijo + ":" + local
+        attrs.append((k, v))
+    if nsmap != ns_padre:
+        for p, u in nsmap.items():
+            if p not in ns_padre or ns_padre[p] != u:
+                attrs.append(("xmlns" if p is None else "xmlns:" + p, u))
+    if len(attrs) > 1:
+        attrs.sort()
+    name = nombre(el)
+    out.append("<" + name)
+    for k, v in attrs:
+        out.append(" " + k + "=" + _valor(v))
+    if el.text is None and len(el) == 0:
+        out.append("/>")
+        return
+    out.append(">")
+    if el.text:
+        out.append(_escapa(el.text))
+    for hijo in el:
+        _serializa(hijo, out, nsmap)
+        if hijo.tail:
+            out.append(_escapa(hijo.tail))
+    out.append("</" + name + ">")
+
+
+def serializa(el: etree._Element, documento: bool = False) -> str:
+    """
+    El str() de bs4: atributos ordenados, <t/> para los tags vacíos, etc.
+    Con documento incluye la declaración xml y el doctype
+    """
+    out = []
+    if documento:
+        out.append(DECLARACION)
+        doctype = el.getroottree().docinfo.doctype
+        if doctype:
+            out.append(doctype + "\n")
+    padre = el.getparent()
+    _serializa(el, out, padre.nsmap if padre is not None else {})
+    return "".join(out)
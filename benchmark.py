@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark de miepub.py con libros sintéticos.
+
+Genera libros md/html según los parámetros de cada escenario, los convierte
+una vez con pandoc y mide después cada etapa de miepub.py (con pandoc
+sustituido por una copia del epub ya convertido) usando --metrics-json.
+Los programas externos que no estén instalados (epubcheck, ebook-meta...)
+se sustituyen por uno que no hace nada, así que funciona sin red.
+
+    ./benchmark.py --save base.json            # guarda la línea base
+    ./benchmark.py --compare base.json         # falla si algo va más lento
+    ./benchmark.py --backends                  # bs4 contra lxml
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Dict, List, NamedTuple
+
+from PIL import Image, ImageDraw
+
+MIEPUB = os.path.join(os.path.dirname(os.path.realpath(__file__)), "miepub.py")
+EXTERNOS = ("epubcheck", "ebook-meta", "exiftool", "picopt", "mogrify")
+BACKENDS = ("bs4", "lxml")
+
+# Se ejecuta en el proceso hijo: pandoc convierte la primera vez y el resto
+# de veces se copia el epub que generó
+RUNNER = '''
+import os, runpy, shutil, sys
+import pypandoc
+convert_file = pypandoc.convert_file
+def fake(source_file, to=None, outputfile=None, extra_args=(), **kwargs):
+    epub = os.environ["BENCH_EPUB"]
+    if not os.path.isfile(epub):
+        # pandoc 2 quitó --parse-raw, que miepub.py sigue pasando con html
+        extra_args = [a for a in extra_args if a != "--parse-raw"]
+        convert_file(source_file, to, outputfile=epub, extra_args=extra_args, **kwargs)
+        import benchmark
+        benchmark.notas_pandoc2(epub)
+    shutil.copy(epub, outputfile)
+pypandoc.convert_file = fake
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name="__main__")
+'''
+
+
+class Libro(NamedTuple):
+    formato: str = "md"
+    capitulos: int = 20
+    parrafos: int = 30
+    palabras: int = 80
+    notas: float = 0.2
+    tablas: int = 1
+    filas: int = 10
+    columnas: int = 5
+    # Filas de cada tabla (md) con todas las celdas en negrita, que
+    # miepub.py pasa al thead, y proporción de filas con una celda >
+    cabeceras: int = 0
+    colspans: float = 0.0
+    imagenes: int = 10
+    duplicadas: float = 0.2
+    seed: int = 1
+
+
+ESCENARIOS: Dict[str, Libro] = {
+    "md": Libro(),
+    "md-notas": Libro(capitulos=40, notas=1.0, imagenes=0),
+    "md-tablas": Libro(capitulos=10, parrafos=5, tablas=10, filas=60, columnas=8, imagenes=0),
+    "md-tabla-grande": Libro(capitulos=1, parrafos=2, notas=0, filas=20000, columnas=6, cabeceras=2, colspans=0.1, imagenes=0),
+    "md-imagenes": Libro(capitulos=5, parrafos=5, notas=0, imagenes=60, duplicadas=0.4),
+    "md-grande": Libro(capitulos=120, parrafos=50),
+    # Un solo capítulo de unos 2 MB, para minify y los pasos sobre un capítulo grande
+    "md-capitulo-grande": Libro(capitulos=1, parrafos=4000, notas=0.1, tablas=20, filas=30, imagenes=0),
+    "html": Libro(formato="html", notas=0),
+}
+
+PALABRAS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+            "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+            "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo").split()
+
+
+def _texto(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(PALABRAS) for _ in range(n))
+
+
+def _imagenes(libro: Libro, rnd: random.Random, root: str) -> List[str]:
+    """
+    Crea libro.imagenes imágenes, de las que una proporción libro.duplicadas
+    son copias exactas de otras con distinto nombre
+    """
+    os.makedirs(root + "/img", exist_ok=True)
+    imgs = []
+    for i in range(libro.imagenes):
+        ext = ("jpg", "png")[i % 2]
+        img = "img/img%03d.%s" % (i, ext)
+        originales = [o for o in imgs if o.endswith(ext)]
+        if originales and rnd.random() < libro.duplicadas:
+            shutil.copy(root + "/" + rnd.choice(originales), root + "/" + img)
+        else:
+            im = Image.new("RGB", (rnd.randint(600, 1600), rnd.randint(400, 1200)), "white")
+            draw = ImageDraw.Draw(im)
+            for _ in range(40):
+                x, y = rnd.randint(0, im.width), rnd.randint(0, im.height)
+                draw.rectangle((x, y, x + rnd.randint(10, 300), y + rnd.randint(10, 300)),
+                               fill=tuple(rnd.randint(0, 255) for _ in range(3)))
+            im.save(root + "/" + img)
+        imgs.append(img)
+    return imgs
+
+
+def genera(libro: Libro, root: str) -> str:
+    """
+    Genera el libro en root y devuelve la ruta del fichero fuente
+    """
+    rnd = random.Random(libro.seed)
+    os.makedirs(root, exist_ok=True)
+    Image.new("RGB", (600, 800), "gray").save(root + "/cover.png")
+    with open(root + "/estilo.css", "w") as f:
+        f.write("body { margin: 0 }\n.odd { background: #eee }\n")
+    imgs = _imagenes(libro, rnd, root)
+    imgs = [imgs[c::libro.capitulos] for c in range(libro.capitulos)]
+    capitulos = []
+    nota = 0
+    for c in range(libro.capitulos):
+        bloques = []
+        notas = []
+        for p in range(libro.parrafos):
+            txt = _texto(rnd, libro.palabras)
+            if libro.formato == "md" and rnd.random() < libro.notas:
+                nota = nota + 1
+                txt = txt + "[^%d]" % nota
+                notas.append("[^%d]: %s" % (nota, _texto(rnd, 20)))
+            bloques.append(txt)
+            if p < len(imgs[c]):
+                bloques.append(("![](%s)" if libro.formato == "md" else '<img src="%s" alt=""/>') % imgs[c][p])
+        for _ in range(libro.tablas):
+            filas = [[_texto(rnd, 2) for _ in range(libro.columnas)] for _ in range(libro.filas)]
+            for fila in filas[:libro.cabeceras]:
+                fila[:] = ["**%s**" % c for c in fila]
+            if libro.colspans:
+                for fila in filas[libro.cabeceras:]:
+                    if rnd.random() < libro.colspans:
+                        fila[1] = ">"
+            bloques.insert(rnd.randint(0, len(bloques)), filas)
+        capitulos.append((_texto(rnd, 3).capitalize() + " %d" % (c + 1), bloques, notas))
+
+    if libro.formato == "md":
+        out = ["---", "title: Libro sintético", "author: Benchmark", "date: 2020", "---", ""]
+        for titulo, bloques, notas in capitulos:
+            out.extend(["# " + titulo, ""])
+            for b in bloques:
+                if isinstance(b, list):
+                    out.append("| " + " | ".join("c%d" % i for i in range(len(b[0]))) + " |")
+                    out.append("|" + "---|" * len(b[0]))
+                    out.extend("| " + " | ".join(r) + " |" for r in b)
+                else:
+                    out.append(b)
+                out.append("")
+            out.extend(n + "\n" for n in notas)
+        out.extend(["# Notas", ""])
+        fuente = root + "/libro.md"
+    else:
+        out = ['<html><head><meta charset="utf-8"/><title>Libro sintético</title>',
+               '<meta name="author" content="Benchmark"/></head><body>']
+        for titulo, bloques, _ in capitulos:
+            out.append("<h1>%s</h1>" % titulo)
+            for b in bloques:
+                if isinstance(b, list):
+                    out.append("<table><thead><tr>" + "".join("<th>c%d</th>" % i for i in range(len(b[0]))) + "</tr></thead><tbody>")
+                    out.extend("<tr>" + "".join("<td>%s</td>" % c for c in r) + "</tr>" for r in b)
+                    out.append("</tbody></table>")
+                else:
+                    out.append("<p>%s</p>" % b)
+        out.append("</body></html>")
+        fuente = root + "/libro.html"
+    with open(fuente, "w") as f:
+        f.write("\n".join(out))
+    return fuente
+
+
+re_aside = re.compile(r'<aside epub:type="footnote"[^>]* id="fn(\d+)"[^>]*>\s*<p>(.*?)</p>\s*</aside>', re.S)
+re_footnotes = re.compile(r'(<section id="footnotes"[^>]*>)(.*?)</section>', re.S)
+
+
+def notas_pandoc2(epub: str):
+    """
+    Pasa las notas de pandoc 3 (un aside por nota) al formato de pandoc 2
+    (ol > li > p con el enlace footnote-back) que es el que entiende miepub.py
+    """
+    with zipfile.ZipFile(epub) as z:
+        files = [(i, z.read(i)) for i in z.infolist()]
+
+    def lis(m: re.Match) -> str:
+        body = re_aside.sub(lambda a: f'<li id="fn{a.group(1)}"><p>{a.group(2)}<a href="#fnref{a.group(1)}" class="footnote-back" role="doc-backlink">↩︎</a></p></li>', m.group(2))
+        return m.group(1) + "\n<hr />\n<ol>" + body.replace("<hr />", "") + "</ol>\n</section>"
+
+    with zipfile.ZipFile(epub, "w") as z:
+        for i, data in files:
+            if i.filename.endswith(".xhtml") and b'<aside epub:type="footnote"' in data:
+                data = re_footnotes.sub(lis, data.decode("utf-8")).encode("utf-8")
+            z.writestr(i, data)
+
+
+def _bin(root: str) -> str:
+    """
+    Directorio con un sustituto que no hace nada para cada programa externo
+    que no esté instalado
+    """
+    dir_bin = root + "/bin"
+    os.makedirs(dir_bin, exist_ok=True)
+    for p in EXTERNOS:
+        if shutil.which(p) is None:
+            with open(dir_bin + "/" + p, "w") as f:
+                f.write("#!/bin/sh\nexit 0\n")
+            os.chmod(dir_bin + "/" + p, 0o755)
+    return dir_bin
+
+
+def ejecuta(fuente: str, epub: str, dir_bin: str, extra: List[str]) -> Dict[str, float]:
+    """
+    Ejecuta miepub.py una vez y devuelve {etapa: segundos}, incluyendo
+    total (el build) y proceso (con el arranque del intérprete)
+    """
+    root = os.path.dirname(fuente)
+    metrics = root + "/metrics.jsonl"
+    if os.path.isfile(metrics):
+        os.remove(metrics)
+    cmd = [sys.executable, "-c", RUNNER, MIEPUB, "--out", root + "/salida.epub",
+           "--cover", "cover.png", "--css", "estilo.css", "--width", "1000", "--img-cache-size", "0",
+           "--metrics-json", metrics] + extra + [fuente]
+    env = dict(os.environ, BENCH_EPUB=epub, PATH=dir_bin + os.pathsep + os.environ.get("PATH", ""))
+    ini = time.perf_counter()
+    r = subprocess.run(cmd, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    proceso = time.perf_counter() - ini
+    if r.returncode != 0 or not os.path.isfile(metrics):
+        sys.exit(f"miepub.py ha fallado con {fuente}:\n" + r.stderr.decode("utf-8", "replace"))
+    with open(metrics) as f:
+        m = json.loads(f.readline())
+    tiempos = {}
+    for e in m["etapas"]:
+        if e["nombre"] != "pandoc":
+            tiempos[e["nombre"]] = tiempos.get(e["nombre"], 0) + e["wall"]
+    tiempos["total"] = m["wall"] - sum(e["wall"] for e in m["etapas"] if e["nombre"] == "pandoc")
+    tiempos["proceso"] = proceso
+    return tiempos
+
+
+def mide(nombre: str, libro: Libro, root: str, repeticiones: int, extra: List[str]) -> Dict[str, float]:
+    """
+    Mediana de cada etapa en varias ejecuciones, después de una primera
+    ejecución de calentamiento (que es la que llama a pandoc)
+    """
+    dir_libro = os.path.join(root, nombre)
+    fuente = genera(libro, dir_libro)
+    epub = dir_libro + "/pandoc.epub"
+    dir_bin = _bin(root)
+    ejecuta(fuente, epub, dir_bin, extra)
+    medidas: Dict[str, List[float]] = {}
+    for _ in range(repeticiones):
+        for k, v in ejecuta(fuente, epub, dir_bin, extra).items():
+            medidas.setdefault(k, []).append(v)
+    return {k: statistics.median(v) for k, v in medidas.items()}
+
+
+def diferencias(a: str, b: str) -> List[str]:
+    """
+    Ficheros que no son iguales en los epub a y b
+    """
+    with zipfile.ZipFile(a) as za, zipfile.ZipFile(b) as zb:
+        fa = {i.filename: za.read(i) for i in za.infolist()}
+        fb = {i.filename: zb.read(i) for i in zb.infolist()}
+    return sorted(n for n in set(fa) | set(fb) if fa.get(n) != fb.get(n))
+
+
+def compara_backends(nombre: str, libro: Libro, root: str, repeticiones: int, extra: List[str]) -> Dict[str, Dict[str, float]]:
+    """
+    Mide el escenario con cada --backend y comprueba que los epub que
+    generan son iguales fichero a fichero
+    """
+    resultados = {}
+    salida = os.path.join(root, nombre, "salida.epub")
+    for backend in BACKENDS:
+        resultados[backend] = mide(nombre, libro, root, repeticiones, extra + ["--backend", backend])
+        shutil.copy(salida, salida[:-5] + "-" + backend + ".epub")
+    distintos = diferencias(*(salida[:-5] + "-" + b + ".epub" for b in BACKENDS))
+    if distintos:
+        sys.exit(f"{nombre}: los backends generan epubs distintos en " + ", ".join(distintos))
+    return resultados
+
+
+def compara(base: Dict[str, Dict[str, float]], actual: Dict[str, Dict[str, float]], umbral: float, minimo: float) -> List[str]:
+    """
+    Etapas que van más de umbral veces más lentas que en la línea base
+    (ignorando las diferencias de menos de minimo segundos, que son ruido)
+    """
+    fallos = []
+    for escenario, etapas in actual.items():
+        for etapa, t in etapas.items():
+            b = base.get(escenario, {}).get(etapa)
+            if b is None:
+                continue
+            if t > b * umbral and t - b > minimo:
+                fallos.append(f"{escenario}/{etapa}: {b:.3f}s -> {t:.3f}s (x{t / b:.2f})")
+    return fallos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de miepub.py con libros sintéticos')
+    parser.add_argument("--escenario", action="append", choices=sorted(ESCENARIOS),
+                        help="Escenario a medir (se puede repetir, por defecto todos)")
+    parser.add_argument("--repeticiones", type=int, default=3, help="Ejecuciones por escenario (por defecto 3)")
+    parser.add_argument("--save", help="Guarda los resultados como línea base en este fichero")
+    parser.add_argument("--compare", help="Compara con la línea base de este fichero y falla si algo va más lento")
+    parser.add_argument("--umbral", type=float, default=1.25,
+                        help="Cuántas veces más lenta puede ir una etapa respecto a la línea base (por defecto 1.25)")
+    parser.add_argument("--minimo", type=float, default=0.05,
+                        help="Diferencia en segundos por debajo de la cual no se considera que algo va más lento (por defecto 0.05)")
+    parser.add_argument("--backends", action="store_true", default=False,
+                        help="Compara los backends de capítulos (" + " y ".join(BACKENDS) + "): tiempos y que generen el mismo epub")
+    parser.add_argument("--dir", help="Directorio donde generar los libros (por defecto uno temporal que se borra al terminar)")
+    parser.add_argument("extra", nargs="*", help="Argumentos extra para miepub.py (después de --)")
+    arg = parser.parse_args()
+
+    root = arg.dir or tempfile.mkdtemp(prefix="miepub_bench_")
+    try:
+        resultados = {}
+        for nombre in (arg.escenario or sorted(ESCENARIOS)):
+            if arg.backends:
+                por_backend = compara_backends(nombre, ESCENARIOS[nombre], root, arg.repeticiones, arg.extra)
+                print(nombre + " (mismo epub con " + " y ".join(BACKENDS) + ")")
+                print(f"    {'':<20}" + "".join(f" {b:>9}" for b in BACKENDS))
+                for etapa in por_backend[BACKENDS[0]]:
+                    print(f"    {etapa:<20}" + "".join(f" {por_backend[b].get(etapa, 0):>8.3f}s" for b in BACKENDS))
+                resultados.update((f"{nombre}/{b}", t) for b, t in por_backend.items())
+                continue
+            resultados[nombre] = mide(nombre, ESCENARIOS[nombre], root, arg.repeticiones, arg.extra)
+            print(nombre)
+            for etapa, t in resultados[nombre].items():
+                print(f"    {etapa:<20} {t:>8.3f}s")
+    finally:
+        if not arg.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if arg.save:
+        with open(arg.save, "w") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+        print("Línea base guardada en " + arg.save)
+    if arg.compare:
+        with open(arg.compare) as f:
+            base = json.load(f)
+        fallos = compara(base, resultados, arg.umbral, arg.minimo)
+        if fallos:
+            print("Más lento que la línea base:", *fallos, sep="\n    ")
+            sys.exit(1)
+        print("Sin regresiones respecto a " + arg.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import hashlib
+import os
+import tempfile
+from typing import Union
+
+
+class Cache:
+    """
+    Caché en disco de ficheros (imágenes optimizadas, epubs de pandoc,
+    capítulos transformados) indexada por el hash del original y de los
+    parámetros con los que se ha generado.
+    Se puede compartir entre varios procesos: las escrituras son atómicas
+    (fichero temporal + rename) y al podar se eliminan los ficheros menos
+    usados recientemente hasta quedar por debajo de limite bytes.
+    """
+
+    def __init__(self, root: str, limite: int):
+        self.root = root
+        self.limite = limite
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def clave(data: bytes, *partes: str) -> str:
+        h = hashlib.sha256(data)
+        for p in partes:
+            h.update(b"\0" + p.encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, clave: str) -> str:
+        return os.path.join(self.root, clave[:2], clave)
+
+    def get(self, clave: str) -> Union[bytes, None]:
+        path = self._path(clave)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, clave: str, data: bytes):
+        path = self._path(clave)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def podar(self):
+        with open(os.path.join(self.root, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Ya hay otro proceso podando
+                return
+            ficheros = []
+            total = 0
+            for entry in os.scandir(self.root):
+                if not entry.is_dir():
+                    continue
+                for f in os.scandir(entry.path):
+                    if f.name.startswith("."):
+                        continue
+                    try:
+                        st = f.stat()
+                    except FileNotFoundError:
+                        continue
+                    ficheros.append((st.st_mtime, st.st_size, f.path))
+                    total += st.st_size
+            for _, size, path in sorted(ficheros):
+                if total <= self.limite:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import Cache
+
+# Descargas a la vez (y conexiones abiertas por servidor)
+HILOS = 8
+# Segundos para conectar y para cada lectura
+TIMEOUT = (10, 60)
+REINTENTOS = 3
+
+
+def extension(url: str) -> str:
+    return os.path.splitext(urlparse(url).path)[1]
+
+
+class Descargas:
+    """
+    Descarga recursos por http(s) en paralelo reutilizando las conexiones,
+    con timeout y reintentos (con espera creciente) ante errores de red y
+    respuestas 429 y 5xx.
+    Si hay caché guarda cada respuesta que traiga ETag o Last-Modified y
+    la siguiente vez la pide de forma condicional, así que solo se vuelve
+    a descargar si ha cambiado. Si el servidor no responde se usa la copia
+    de la caché.
+    """
+
+    def __init__(self, cache: Union[Cache, None] = None, hilos: int = HILOS, timeout=TIMEOUT, reintentos: int = REINTENTOS):
+        self.cache = cache
+        self.hilos = hilos
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = "miepub"
+        retry = Retry(total=reintentos, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=hilos, pool_maxsize=hilos, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _de_cache(self, clave: Union[str, None]) -> Union[Tuple[dict, bytes], None]:
+        if clave is None:
+            return None
+        data = self.cache.get(clave)
+        if data is None:
+            return None
+        meta, body = data.split(b"\n", 1)
+        return json.loads(meta), body
+
+    def get(self, url: str) -> Tuple[bytes, str]:
+        """
+        Devuelve el contenido de url y su Content-Type
+        """
+        clave = Cache.clave(url.encode("utf-8"), "http") if self.cache is not None else None
+        cacheado = self._de_cache(clave)
+        headers = {}
+        if cacheado is not None:
+            meta, body = cacheado
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if cacheado is None:
+                raise
+            print(f"No se ha podido descargar {url} ({type(e).__name__}), se usa la copia de la caché")
+            return cacheado[1], cacheado[0].get("tipo", "")
+        if r.status_code == 304 and cacheado is not None:
+            return cacheado[1], cacheado[0].get("tipo", "")
+        r.raise_for_status()
+        meta = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "tipo": r.headers.get("Content-Type", "")
+        }
+        if clave is not None and (meta["etag"] or meta["last_modified"]):
+            self.cache.put(clave, json.dumps(meta).encode("utf-8") + b"\n" + r.content)
+        return r.content, meta["tipo"]
+
+    def descargar(self, url: str, dwn: str) -> str:
+        """
+        Guarda url en dwn. Si dwn no tiene extensión se le añade la que
+        corresponda al Content-Type. Devuelve la ruta final
+        """
+        data, tipo = self.get(url)
+        if not os.path.splitext(dwn)[1]:
+            dwn = dwn + (mimetypes.guess_extension(tipo.split(";")[0].strip()) or "")
+        os.makedirs(os.path.dirname(dwn) or ".", exist_ok=True)
+        with open(dwn, "wb") as f:
+            f.write(data)
+        return dwn
+
+    def descargar_todo(self, destinos: Dict[str, str]) -> Dict[str, Union[str, Exception]]:
+        """
+        Descarga a la vez cada url en su fichero. Devuelve para cada url la
+        ruta final o la excepción que ha impedido descargarla
+        """
+        def uno(url: str, dwn: str) -> Tuple[str, Union[str, Exception]]:
+            try:
+                return url, self.descargar(url, dwn)
+            except Exception as e:
+                return url, e
+
+        if not destinos:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.hilos, len(destinos))) as pool:
+            return dict(pool.map(uno, destinos.keys(), destinos.values()))
+
+    def podar(self):
+        if self.cache is not None:
+            self.cache.podar()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, List, Sequence, Tuple, Union
+
+# Formatos ya comprimidos, deflate no suele ganar nada y gasta cpu, así que
+# solo se comprimen si al probar con MUESTRA bytes se gana más de un 10%
+MUESTRA = 65536
+YA_COMPRIMIDOS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".woff", ".woff2", ".otf",
+                  ".mp3", ".mp4", ".m4a", ".ogg", ".zip", ".gz")
+# Entradas que se comprimen a la vez (y que están en memoria a la vez)
+LOTE = 64
+# Límites del formato zip sin zip64
+MAX_ENTRADAS = 0xFFFF
+MAX_OFFSET = 0xFFFFFFFF
+
+Entrada = Tuple[str, Union[bytes, str]]
+
+
+def _leer(data: Union[bytes, str]) -> bytes:
+    if isinstance(data, bytes):
+        return data
+    with open(data, "rb") as f:
+        return f.read()
+
+
+def _sin_comprimir(name: str, nivel: int, data: bytes) -> bool:
+    if nivel == 0 or name == "mimetype":
+        return True
+    if not name.lower().endswith(YA_COMPRIMIDOS):
+        return False
+    muestra = data[:MUESTRA]
+    return len(zlib.compress(muestra, 1)) > len(muestra) * 0.9
+
+
+def _comprimir(name: str, data: bytes, nivel: int) -> Tuple[int, int, bytes]:
+    crc = zlib.crc32(data)
+    if _sin_comprimir(name, nivel, data):
+        return zipfile.ZIP_STORED, crc, data
+    c = zlib.compressobj(nivel, zlib.DEFLATED, -15)
+    comp = c.compress(data) + c.flush()
+    if len(comp) >= len(data):
+        return zipfile.ZIP_STORED, crc, data
+    return zipfile.ZIP_DEFLATED, crc, comp
+
+
+def _lotes(entradas: Sequence[Entrada]) -> Iterator[List[Entrada]]:
+    for i in range(0, len(entradas), LOTE):
+        yield entradas[i:i + LOTE]
+
+
+def _dos(date_time: Tuple[int, ...]) -> Tuple[int, int]:
+    y, m, d, hh, mm, ss = date_time
+    return (hh << 11) | (mm << 5) | (ss // 2), ((y - 1980) << 9) | (m << 5) | d
+
+
+def _zipfile(file: str, entradas: Sequence[Entrada], nivel: int, date_time: Tuple[int, ...]):
+    """
+    Lo mismo que empaqueta pero con zipfile, en serie, para los zip que
+    necesitan zip64
+    """
+    with zipfile.ZipFile(file, "w", allowZip64=True) as zip_file:
+        for name, data in entradas:
+            data = _leer(data)
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_STORED if _sin_comprimir(name, nivel, data) else zipfile.ZIP_DEFLATED
+            zip_file.writestr(info, data, compresslevel=nivel)
+
+
+def empaqueta(file: str, entradas: Sequence[Entrada], nivel: int = 6, jobs: Union[int, None] = None, date_time: Union[Tuple[int, ...], None] = None):
+    """
+    Escribe el zip file con las entradas (nombre, contenido) en ese orden.
+    El contenido puede ser bytes o la ruta de un fichero, que se lee cuando
+    toca para no tener todo en memoria.
+    mimetype se guarda sin comprimir, y los formatos ya comprimidos también
+    salvo que con una muestra se gane más de un 10%; el resto se comprimen
+    con deflate al nivel indicado (0 guarda todo sin comprimir, 1 es lo más
+    rápido y 9 lo más pequeño) en paralelo en jobs hilos (zlib
+    libera el GIL mientras comprime).
+    """
+    if not 0 <= nivel <= 9:
+        raise ValueError(f"nivel {nivel} no válido, tiene que estar entre 0 y 9")
+    date_time = date_time or datetime.now().timetuple()[:6]
+    if len(entradas) >= MAX_ENTRADAS:
+        _zipfile(file, entradas, nivel, date_time)
+        return
+    if not _empaqueta(file, entradas, nivel, jobs, date_time):
+        _zipfile(file, entradas, nivel, date_time)
+
+
+def _empaqueta(file: str, entradas: Sequence[Entrada], nivel: int, jobs: Union[int, None], date_time: Tuple[int, ...]) -> bool:
+    """
+    Escribe el zip a mano para poder comprimir las entradas en paralelo.
+    Devuelve False si no cabe en un zip sin zip64
+    """
+    dostime, dosdate = _dos(date_time)
+    central = []
+    offset = 0
+    with open(file, "wb") as f, ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for lote in _lotes(entradas):
+            datos = [_leer(data) for _, data in lote]
+            comprimidos = pool.map(_comprimir, [name for name, _ in lote], datos, [nivel] * len(lote))
+            for (name, _), data, (metodo, crc, comp) in zip(lote, datos, comprimidos):
+                if offset + len(comp) >= MAX_OFFSET or len(data) >= MAX_OFFSET:
+                    return False
+                bname = name.encode("utf-8")
+                flags = 0 if bname.isascii() else 0x800
+                f.write(struct.pack("<4s2B4HL2L2H", b"PK\003\004", 20, 0, flags, metodo,
+                                    dostime, dosdate, crc, len(comp), len(data), len(bname), 0))
+                f.write(bname)
+                f.write(comp)
+                central.append(struct.pack("<4s4B4HL2L5H2L", b"PK\001\002", 20, 3, 20, 0, flags, metodo,
+                                           dostime, dosdate, crc, len(comp), len(data), len(bname), 0, 0,
+                                           0, 0, 0o644 << 16, offset) + bname)
+                offset = offset + 30 + len(bname) + len(comp)
+        size = sum(map(len, central))
+        if offset + size >= MAX_OFFSET:
+            return False
+        f.writelines(central)
+        f.write(struct.pack("<4s4H2LH", b"PK\005\006", 0, 0, len(central), len(central), size, offset, 0))
+    return True
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import os
+import re
+from functools import lru_cache
+from subprocess import DEVNULL, CalledProcessError, call, check_output
+from typing import Dict, List, NamedTuple, Sequence, Tuple, Union
+
+import PIL
+from PIL import Image, ImageChops
+
+# Calidad que usa ImageMagick cuando no puede estimar la del original
+CALIDAD_JPEG = 92
+# Cambiar si cambia el resultado de pillow() o externo() para invalidar la caché
+VERSION = "2"
+# Chunks de png que hacen falta para pintar la imagen (también animada); el
+# resto (exif, iCCP, textos, tIME, etc) son metadatos
+CHUNKS_PNG = frozenset((b"IHDR", b"PLTE", b"IDAT", b"IEND", b"tRNS", b"gAMA", b"cHRM", b"sRGB",
+                        b"sBIT", b"pHYs", b"bKGD", b"acTL", b"fcTL", b"fdAT"))
+
+
+class Operaciones(NamedTuple):
+    """
+    Operaciones de mogrify que el motor Pillow sabe hacer en memoria (las
+    de MetaData.mogrify), aplicadas siempre en este orden: recortar, gris,
+    redimensionar.
+    """
+    trim: bool = False
+    fuzz: float = 0
+    gray: bool = False
+    width: Union[int, None] = None
+
+    @staticmethod
+    def from_mogrify(mogrify: Sequence[str]) -> "Operaciones":
+        args = list(mogrify)
+        if args and args[0] == "mogrify":
+            args = args[1:]
+        ops = {}
+        itr = iter(args)
+        for a in itr:
+            if a in ("-strip", "+repage"):
+                continue
+            if a == "-trim":
+                ops["trim"] = True
+                continue
+            if a == "-fuzz":
+                ops["fuzz"] = _fuzz(next(itr))
+                continue
+            if a == "-colorspace":
+                v = next(itr)
+                if v.upper() != "GRAY":
+                    raise ValueError(f"-colorspace {v} no soportado")
+                ops["gray"] = True
+                continue
+            if a == "-resize":
+                v = next(itr)
+                m = re.match(r"^(\d+)>$", v)
+                if m is None:
+                    raise ValueError(f"-resize {v} no soportado")
+                ops["width"] = int(m.group(1))
+                continue
+            raise ValueError(f"{a} no soportado")
+        return Operaciones(**ops)
+
+
+def duplicados(imgs: Dict[str, bytes]) -> Dict[str, str]:
+    """
+    Devuelve {duplicado: original} donde original es la primera aparición
+    en imgs de una imagen con el mismo contenido.
+    Solo se calcula el hash de las imágenes que comparten tamaño con otra.
+    """
+    por_size: Dict[int, List[str]] = {}
+    for p, data in imgs.items():
+        por_size.setdefault(len(data), []).append(p)
+    dup: Dict[str, str] = {}
+    for grupo in por_size.values():
+        if len(grupo) < 2:
+            continue
+        por_hash: Dict[str, str] = {}
+        for p in grupo:
+            original = por_hash.setdefault(hashlib.sha256(imgs[p]).hexdigest(), p)
+            if original != p:
+                dup[p] = original
+    return dup
+
+
+def _fuzz(v: str) -> float:
+    """
+    Pasa el -fuzz de mogrify (en cuántums de 16 bits o en %) a la escala 0-255
+    """
+    if v.endswith("%"):
+        return float(v[:-1]) * 255 / 100
+    return float(v) * 255 / 65535
+
+
+def _bbox(img: Image.Image, fuzz: float) -> Union[Tuple[int, int, int, int], None]:
+    """
+    Caja de la imagen sin los márgenes del color de la esquina superior
+    izquierda, igual que hace -trim
+    """
+    if img.mode not in ("L", "LA", "RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    fondo = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    bandas = ImageChops.difference(img, fondo).split()
+    diff = bandas[0]
+    for b in bandas[1:]:
+        diff = ImageChops.lighter(diff, b)
+    umbral = int(fuzz)
+    return diff.point(lambda p: 255 if p > umbral else 0).getbbox()
+
+
+def pillow(data: bytes, ops: Operaciones) -> bytes:
+    """
+    Aplica las operaciones sobre la imagen decodificada en memoria y la
+    vuelve a codificar optimizada (progresiva en el caso de los jpg).
+    Los metadatos (exif, icc, etc) se pierden siempre.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format not in ("JPEG", "PNG"):
+            raise ValueError(f"formato {img.format} no soportado")
+        img.load()
+        out = img
+        if ops.trim:
+            box = _bbox(out, ops.fuzz)
+            if box is not None and box != (0, 0) + out.size:
+                out = out.crop(box)
+        if ops.gray and out.mode not in ("L", "LA", "1"):
+            alfa = out.mode in ("RGBA", "LA", "PA") or "transparency" in out.info
+            out = out.convert("LA" if alfa else "L")
+        if ops.width and out.width > ops.width:
+            if out.mode in ("P", "1"):
+                # Con paleta Pillow solo sabe redimensionar sin interpolar
+                out = out.convert("RGBA" if "transparency" in out.info else "RGB")
+            height = max(1, round(out.height * ops.width / out.width))
+            out = out.resize((ops.width, height), Image.LANCZOS)
+
+        buff = io.BytesIO()
+        # Si no se le dice nada, Pillow copia a la nueva algunos metadatos de
+        # img.info (el icc en los png y el comentario en los jpg)
+        limpia = {"icc_profile": None, "exif": b""}
+        if img.format == "JPEG":
+            if out.mode not in ("L", "RGB", "CMYK"):
+                out = out.convert("RGB")
+            if out is img:
+                calidad = {"quality": "keep"}
+            elif getattr(img, "quantization", None):
+                calidad = {"qtables": img.quantization}
+            else:
+                calidad = {"quality": CALIDAD_JPEG}
+            out.save(buff, "JPEG", optimize=True, progressive=True, comment=b"", **calidad, **limpia)
+        else:
+            out.save(buff, "PNG", optimize=True, **limpia)
+        return buff.getvalue()
+
+
+def sin_metadatos(data: bytes) -> bytes:
+    """
+    Quita los metadatos de un jpg o png sin volver a codificarlo, para
+    cuando la imagen optimizada no es más pequeña que la original. Si no es
+    ninguno de los dos, o no se entiende, la devuelve tal cual
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return _png_sin_metadatos(data)
+    if data.startswith(b"\xff\xd8"):
+        return _jpg_sin_metadatos(data)
+    return data
+
+
+def _png_sin_metadatos(data: bytes) -> bytes:
+    out = [data[:8]]
+    i = 8
+    while i + 12 <= len(data):
+        fin = i + 12 + int.from_bytes(data[i:i + 4], "big")
+        if fin > len(data):
+            return data
+        if data[i + 4:i + 8] in CHUNKS_PNG:
+            out.append(data[i:fin])
+        i = fin
+    return b"".join(out)
+
+
+def _jpg_sin_metadatos(data: bytes) -> bytes:
+    """
+    Quita los segmentos APP1-APP15 (exif, xmp, icc, iptc, etc) menos el
+    APP14 de Adobe, que dice cómo interpretar los colores, y los COM
+    """
+    out = [data[:2]]
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return data
+        marca = data[i + 1]
+        if marca == 0xFF:
+            # Relleno
+            i = i + 1
+            continue
+        if marca == 0xDA:
+            # Empieza la imagen comprimida, que se copia tal cual
+            out.append(data[i:])
+            return b"".join(out)
+        fin = i + 2 + int.from_bytes(data[i + 2:i + 4], "big")
+        if fin > len(data):
+            return data
+        if not (0xE1 <= marca <= 0xEF and marca != 0xEE) and marca != 0xFE:
+            out.append(data[i:fin])
+        i = fin
+    return data
+
+
+def externo(nombre: str, data: bytes, mogrify: Sequence[str], wks: str) -> bytes:
+    """
+    Optimiza la imagen con mogrify y picopt sobre una copia temporal en wks
+    y devuelve el resultado
+    """
+    c = wks + "/" + nombre
+    with open(c, "wb") as f:
+        f.write(data)
+    if len(mogrify) > 1:
+        call(list(mogrify) + [c])
+    call(["picopt", "--quiet", "--destroy_metadata",
+          "--comics", "--enable_advpng", c])
+    with open(c, "rb") as f:
+        data = f.read()
+    os.remove(c)
+    return data
+
+
+@lru_cache(maxsize=None)
+def _version_programa(*cmd: str) -> str:
+    """
+    Primera línea de la versión de un programa externo, o "no" si no está
+    """
+    try:
+        out = check_output(cmd, stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        return "no"
+    lineas = out.decode("utf-8", "replace").strip().splitlines()
+    return lineas[0].strip() if lineas else "?"
+
+
+def version(engine: str) -> str:
+    """
+    Versión del motor que ha generado una imagen, para la clave de la caché:
+    Pillow, o mogrify y picopt en el caso de external
+    """
+    if engine == "pillow":
+        return "pillow-" + PIL.__version__ + "-" + VERSION
+    return "-".join((engine, _version_programa("mogrify", "-version"), _version_programa("picopt", "--version"), VERSION))
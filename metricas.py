@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List, Union
+
+# Versión del formato del json, cambiar si cambian los campos
+VERSION = 1
+
+
+def _cpu(quien: int) -> float:
+    r = resource.getrusage(quien)
+    return r.ru_utime + r.ru_stime
+
+
+def _rss(quien: int) -> int:
+    # ru_maxrss viene en KB en Linux y en bytes en macOS
+    r = resource.getrusage(quien).ru_maxrss
+    return r if sys.platform == "darwin" else r * 1024
+
+
+class Etapa:
+    """
+    Medidas de una etapa. bytes_in, bytes_out e items los rellena quien
+    la ejecuta, el resto lo mide Metricas.etapa.
+    El rss es el máximo del proceso (o de sus hijos) hasta el final de la
+    etapa, no el de la etapa, porque el sistema no da otra cosa.
+    """
+
+    def __init__(self, nombre: str, bytes_in: int = 0, items: int = 0):
+        self.nombre = nombre
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.items = items
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.cpu_hijos = 0.0
+        self.rss_max = 0
+        self.rss_max_hijos = 0
+        self.py_peak: Union[int, None] = None
+        self.extra: Dict[str, Union[int, float, str]] = {}
+
+    def to_dict(self) -> dict:
+        d = dict(self.__dict__)
+        extra = d.pop("extra")
+        if d["py_peak"] is None:
+            del d["py_peak"]
+        d.update(extra)
+        return d
+
+
+class Metricas:
+    """
+    Instrumentación de las etapas de un programa: tiempo real, tiempo de
+    cpu (propio y de los procesos hijos), rss máximo, bytes de entrada y
+    salida y número de elementos. Opcionalmente perfila con cProfile todo
+    el programa o mide con tracemalloc el pico de memoria Python de cada
+    etapa.
+    """
+
+    def __init__(self, programa: str, profile: Union[str, None] = None):
+        if profile not in (None, "cprofile", "tracemalloc"):
+            raise ValueError(f"profile {profile} no soportado")
+        self.programa = programa
+        self.profile = profile
+        self.etapas: List[Etapa] = []
+        self.info: Dict[str, Union[int, float, str]] = {}
+        self.inicio = datetime.now().astimezone()
+        self._wall = time.perf_counter()
+        self._cpu = _cpu(resource.RUSAGE_SELF)
+        self._cpu_hijos = _cpu(resource.RUSAGE_CHILDREN)
+        self._actual = None
+        self._prof: Union[cProfile.Profile, None] = None
+        if self.profile == "cprofile":
+            self._prof = cProfile.Profile()
+            self._prof.enable()
+        elif self.profile == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def etapa(self, nombre: str, bytes_in: int = 0, items: int = 0) -> Etapa:
+        """
+        Termina la etapa en curso (si la hay) y empieza otra, que termina
+        con la siguiente llamada a etapa o a fin
+        """
+        self._cerrar()
+        e = Etapa(nombre, bytes_in=bytes_in, items=items)
+        if self.profile == "tracemalloc":
+            tracemalloc.reset_peak()
+        self._actual = (e, time.perf_counter(), _cpu(resource.RUSAGE_SELF), _cpu(resource.RUSAGE_CHILDREN))
+        return e
+
+    def _cerrar(self):
+        if self._actual is None:
+            return
+        e, wall, cpu, cpu_hijos = self._actual
+        e.wall = time.perf_counter() - wall
+        e.cpu = _cpu(resource.RUSAGE_SELF) - cpu
+        e.cpu_hijos = _cpu(resource.RUSAGE_CHILDREN) - cpu_hijos
+        e.rss_max = _rss(resource.RUSAGE_SELF)
+        e.rss_max_hijos = _rss(resource.RUSAGE_CHILDREN)
+        if self.profile == "tracemalloc":
+            e.py_peak = tracemalloc.get_traced_memory()[1]
+        self.etapas.append(e)
+        self._actual = None
+
+    def fin(self, prof_file: Union[str, None] = None):
+        """
+        Cierra la medición. Con cProfile guarda las estadísticas en
+        prof_file (para snakeviz, pstats, etc) si se indica
+        """
+        self._cerrar()
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = _cpu(resource.RUSAGE_SELF) - self._cpu
+        self.cpu_hijos = _cpu(resource.RUSAGE_CHILDREN) - self._cpu_hijos
+        if self._prof is not None:
+            self._prof.disable()
+            if prof_file:
+                self._prof.dump_stats(prof_file)
+                print("Perfil de cProfile en " + prof_file)
+            pstats.Stats(self._prof).sort_stats("cumulative").print_stats(20)
+            self._prof = None
+        if self.profile == "tracemalloc" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def to_dict(self) -> dict:
+        return {
+            "version": VERSION,
+            "programa": self.programa,
+            "inicio": self.inicio.isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            "profile": self.profile,
+            "info": self.info,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "cpu_hijos": self.cpu_hijos,
+            "rss_max": _rss(resource.RUSAGE_SELF),
+            "rss_max_hijos": _rss(resource.RUSAGE_CHILDREN),
+            "etapas": [e.to_dict() for e in self.etapas]
+        }
+
+    def imprimir(self):
+        print(f"{'Etapa':<22} {'real':>8} {'cpu':>8} {'hijos':>8} {'rss MB':>8} {'entrada':>10} {'salida':>10} {'items':>6}")
+        for e in self.etapas:
+            print(f"{e.nombre:<22} {e.wall:>8.3f} {e.cpu:>8.3f} {e.cpu_hijos:>8.3f} {e.rss_max / 1048576:>8.1f} {e.bytes_in:>10} {e.bytes_out:>10} {e.items:>6}")
+        print(f"{'Total':<22} {self.wall:>8.3f} {self.cpu:>8.3f} {self.cpu_hijos:>8.3f}")
+
+    def guardar(self, path: str):
+        """
+        Añade el informe como una línea de json a path, para poder acumular
+        varias ejecuciones (por ejemplo las de cada noche) en el mismo fichero
+        """
+        with open(path, "a") as f:
+            f.write(json.dumps(self.to_dict(), ensure_ascii=False) + "\n")
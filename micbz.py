@@ -22,6 +22,9 @@ import pypandoc
 import yaml
 from PIL import Image
 
+from metricas import Metricas
+from empaquetar import empaqueta
+
 ban_file=re.split(r"\s*\n\s*", '''
 SelloDragón_.jpg
 zz_portadilla final.jpg
@@ -74,19 +77,24 @@ def extract(fl, target):
     return target
 
 
-def build(tmp_out, target):
+def build(tmp_out, target, nivel=6, jobs=None):
     target = target+".cbz"
     if os.path.isfile(target):
         os.remove(target)
-    with zipfile.ZipFile(target, "w") as zip_file:
-        #rar_file.write(tmp_out + '/mimetype', 'mimetype', compress_type=zipfile.ZIP_STORED)
-        z = len(tmp_out) + 1
-        for root, dirs, files in os.walk(tmp_out):
-            for f in files:
-                path = os.path.join(root, f)
-                name = path[z:]
-                if name != 'mimetype':
-                    zip_file.write(path, name, compress_type=zipfile.ZIP_DEFLATED)
+    entradas = []
+    z = len(tmp_out) + 1
+    for root, dirs, files in os.walk(tmp_out):
+        for f in files:
+            path = os.path.join(root, f)
+            name = path[z:]
+            if name != 'mimetype':
+                entradas.append((name, path))
+    # Las imágenes se guardan sin comprimir y el resto se comprime en paralelo
+    empaqueta(target, entradas, nivel=nivel, jobs=jobs)
+
+
+def du(target):
+    return sum(os.path.getsize(fl) for fl, _ in get_files(target))
 
 
 def get_files(target):
@@ -104,6 +112,12 @@ parser.add_argument("--out", type=str, help="Directorio de sálida", default="."
 parser.add_argument("--width", type=int, help="Ancho máximo", default=1072)
 parser.add_argument("--height", type=int, help="Alto máximo", default=1448)
 parser.add_argument("--serie", action='store_true', help="Indica que es una serie", default=True)
+parser.add_argument("--zip-level", type=int, default=6, choices=range(10), metavar="{0-9}",
+                    help="Nivel de compresión del cbz: 0 sin comprimir, 1 lo más rápido, 9 lo más pequeño (por defecto 6). Las imágenes y demás formatos ya comprimidos solo se comprimen si al probar con sus primeros 64 KB se gana más de un 10%%")
+parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Hilos para comprimir (por defecto, el número de núcleos)")
+parser.add_argument("--profile", choices=("cprofile", "tracemalloc"),
+                    help="Perfila con cProfile (guarda el perfil en <out>/micbz.prof) o mide con tracemalloc el pico de memoria de cada etapa")
+parser.add_argument("--metrics-json", help="Añade a este fichero una línea json con las métricas de cada etapa")
 parser.add_argument("origen", nargs='+', help="Ficheros de origen")
 
 arg = parser.parse_args()
@@ -133,18 +147,29 @@ arg.serie_name = os.path.basename(os.path.realpath(arg.out)) + " #%0" + (str(len
 
 mogrify = ["-strip", "+repage", "-bordercolor", "None", "-fuzz", "30%", "-trim", "-resize", str(arg.width) + ">"]
 tmp = "/tmp/micbz" #tempfile.mkdtemp()
+met = Metricas("micbz", arg.profile)
+met.info["origen"] = len(arg.origen)
 print("cd " + tmp)
 for i, cbr in enumerate(arg.origen):
     print(os.path.basename(cbr))
     if os.path.isdir(tmp):
         shutil.rmtree(tmp)
     os.makedirs(tmp)
+    e = met.etapa("extraer", bytes_in=du(cbr) if os.path.isdir(cbr) else os.path.getsize(cbr))
+    e.extra["fichero"] = os.path.basename(cbr)
     wks = extract(cbr, tmp)
+    e.bytes_out = du(tmp)
+    e = met.etapa("limpiar", bytes_in=e.bytes_out)
+    e.extra["fichero"] = os.path.basename(cbr)
     rm_ban_files(tmp)
+    e.bytes_out = du(tmp)
     print('cd "%s"' % wks)
+    e = met.etapa("imágenes", bytes_in=du(wks))
+    e.extra["fichero"] = os.path.basename(cbr)
     for fl, name in get_files(wks):
         ext = name.split(".")[-1]
         if ext in ("jpg"):
+            e.items = e.items + 1
             ancho, alto = Image.open(fl).size
             if ancho > alto:
                 call_mogrify(fl, "-rotate", "90", *mogrify[1:])
@@ -157,4 +182,14 @@ for i, cbr in enumerate(arg.origen):
         out = arg.serie_name % (i+1)
     else:
         out = os.path.join(arg.out, os.path.basename(cbr))[:-4]
-    build(wks, out)
+    e.bytes_out = du(wks)
+    e = met.etapa("zip", bytes_in=e.bytes_out)
+    e.extra["fichero"] = os.path.basename(cbr)
+    build(wks, out, nivel=arg.zip_level, jobs=arg.jobs)
+    e.bytes_out = os.path.getsize(out + ".cbz")
+
+met.fin(os.path.join(arg.out, "micbz.prof") if arg.profile == "cprofile" else None)
+if arg.profile or arg.metrics_json:
+    met.imprimir()
+if arg.metrics_json:
+    met.guardar(arg.metrics_json)
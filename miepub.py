@@ -2,28 +2,49 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import filecmp
-import glob
+import contextlib
+import fnmatch
+import io
+import json
 import os
+import posixpath
 import re
+import runpy
 import shutil
 import sys
 import tempfile
+import time
+import traceback
 import unicodedata
-import urllib.request
 import zipfile
-from subprocess import call, check_output
-from shutil import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from subprocess import Popen, call, check_output
 from datetime import date, datetime
-from functools import cached_property
+from functools import cached_property, lru_cache
+from html import unescape
 from typing import Union, NamedTuple, List, Tuple, Dict
+from urllib.parse import unquote, urlparse
 
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
 
 import bs4
+from bs4.dammit import EncodingDetector, EntitySubstitution
 import pypandoc
+import soupsieve
 import yaml
+from lxml import etree
+
+import arbol
+import imagenes
+from cache import Cache
+from descargas import Descargas, extension
+from metricas import Metricas
+from pasos import FASES, Contexto, Pasos
+from empaquetar import empaqueta
+from validar import referencias, referencias_css, valida
 
 parser = argparse.ArgumentParser(
     description='Genera epub')
@@ -44,6 +65,37 @@ parser.add_argument("--trim", help="Recorta los margenes de las imágenes",
 parser.add_argument("--copy-class", help="Copiar el atributo class de la fuente al epub",
                     action='store_true', default=False)
 parser.add_argument("--width", type=int, help="Ancho máximo para las imágenes")
+parser.add_argument("--img-engine", choices=("pillow", "external"), default="pillow",
+                    help="Motor para optimizar imágenes: Pillow en memoria o mogrify/picopt (por defecto pillow)")
+parser.add_argument("--img-cache", default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "miepub", "img"),
+                    help="Directorio de la caché de imágenes optimizadas (por defecto ~/.cache/miepub/img)")
+parser.add_argument("--img-cache-size", type=int, default=1024,
+                    help="Tamaño máximo en MB de la caché de imágenes, 0 para no usarla (por defecto 1024)")
+parser.add_argument("--http-cache", default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "miepub", "http"),
+                    help="Directorio de la caché de descargas: portada, css e imágenes remotas (por defecto ~/.cache/miepub/http)")
+parser.add_argument("--http-cache-size", type=int, default=256,
+                    help="Tamaño máximo en MB de la caché de descargas, 0 para no usarla (por defecto 256)")
+parser.add_argument("--incremental", help="Reutiliza la conversión de pandoc y los capítulos sin cambios de compilaciones anteriores",
+                    action='store_true', default=False)
+parser.add_argument("--build-cache", default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "miepub", "build"),
+                    help="Directorio de la caché de --incremental (por defecto ~/.cache/miepub/build)")
+parser.add_argument("--build-cache-size", type=int, default=1024,
+                    help="Tamaño máximo en MB de la caché de --incremental (por defecto 1024)")
+parser.add_argument("--watch", help="Se queda vigilando la fuente, el css, la portada y el avatar y regenera el epub cuando cambian (implica --incremental)",
+                    action='store_true', default=False)
+parser.add_argument("--profile", choices=("cprofile", "tracemalloc"),
+                    help="Perfila con cProfile (guarda el perfil en <salida>.prof) o mide con tracemalloc el pico de memoria de cada etapa")
+parser.add_argument("--metrics-json", help="Añade a este fichero una línea json con las métricas de cada etapa")
+parser.add_argument("--zip-level", type=int, default=6, choices=range(10), metavar="{0-9}",
+                    help="Nivel de compresión del epub: 0 sin comprimir, 1 lo más rápido, 9 lo más pequeño (por defecto 6). Las imágenes y demás formatos ya comprimidos solo se comprimen si al probar con sus primeros 64 KB se gana más de un 10%%")
+parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                    help="Número de capítulos o imágenes a procesar en paralelo (por defecto, el número de núcleos)")
+parser.add_argument("--backend", choices=("bs4", "lxml"), default="bs4",
+                    help="Motor para transformar los capítulos: bs4 o lxml (más rápido, mismo resultado; con --extract se usa bs4) (por defecto bs4)")
+parser.add_argument("--pasos", action="append", default=[],
+                    help="Fichero python con pasos propios para los capítulos: tiene que definir registra(pasos), a la que se llama con los pasos de cada backend (ver pasos.py) (se puede repetir)")
+parser.add_argument("--epubcheck", choices=("no", "yes", "background"), default="no",
+                    help="Pasar epubcheck al terminar: no (solo la comprobación rápida interna), yes o background (en segundo plano, sin esperar) (por defecto no)")
 parser.add_argument(
     "--notas", default="Notas", help="Nombre del capítulo donde se quieren generar las notas (por defecto se usara el último capítulo)")
 parser.add_argument(
@@ -52,7 +104,13 @@ parser.add_argument("--keep-title", help="Mantiene la página de título",
                     action='store_true', default=False)
 parser.add_argument("fuente", help="Fichero de entrada")
 
+# Errores de la validación interna que se muestran
+MAX_ERRORES = 20
+EPUBCHECK: Union[Popen, None] = None
+
 re_sp = re.compile(r"\s+", re.MULTILINE | re.UNICODE)
+re_url = re.compile(r"https?://", re.IGNORECASE)
+re_esquema = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
 
 
 class MyDir(NamedTuple):
@@ -62,6 +120,132 @@ class MyDir(NamedTuple):
     out: str
 
 
+class Epub:
+    """
+    Ficheros de un epub en memoria, {nombre: contenido}, en el mismo orden
+    en el que estaban en el zip
+    """
+
+    def __init__(self, files: Dict[str, bytes]):
+        self.files = files
+
+    @staticmethod
+    def load(file: Union[str, io.BytesIO]) -> "Epub":
+        with zipfile.ZipFile(file, 'r') as zip_ref:
+            return Epub({i.filename: zip_ref.read(i) for i in zip_ref.infolist() if not i.is_dir()})
+
+    @staticmethod
+    def load_dir(root: str) -> "Epub":
+        files = {}
+        z = len(root) + 1
+        for r, dirs, fls in os.walk(root):
+            for f in fls:
+                path = os.path.join(r, f)
+                with open(path, "rb") as fl:
+                    files[path[z:]] = fl.read()
+        return Epub(files)
+
+    def read(self, name: str) -> bytes:
+        return self.files[name]
+
+    def text(self, name: str) -> str:
+        return self.files[name].decode("utf-8")
+
+    def write(self, name: str, data: Union[str, bytes]):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.files[name] = data
+
+    def remove(self, name: str):
+        del self.files[name]
+
+    def isfile(self, name: str) -> bool:
+        return name in self.files
+
+    def glob(self, pattern: str) -> List[str]:
+        return [n for n in self.files if fnmatch.fnmatchcase(n, pattern)]
+
+    def save_dir(self, root: str):
+        for name, data in self.files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def save(self, file: str, nivel: int = 6, jobs: Union[int, None] = None):
+        entradas = [("mimetype", self.files["mimetype"])]
+        entradas.extend((name, data) for name, data in self.files.items() if name != 'mimetype')
+        empaqueta(file, entradas, nivel=nivel, jobs=jobs)
+
+
+class Opf:
+    """
+    content.opf parseado, con los items del manifest indexados por id y por
+    ruta dentro del epub, para quitar o cambiar items sin recorrerlo ni
+    depender de cómo pandoc reparte las líneas. Se serializa con to_bytes
+    """
+    NS = {"opf": "http://www.idpf.org/2007/opf", "dc": "http://purl.org/dc/elements/1.1/"}
+
+    def __init__(self, path: str, data: bytes):
+        self.path = path
+        self.dir = posixpath.dirname(path)
+        self.root = etree.fromstring(data)
+        self.metadata = self.root.find("opf:metadata", Opf.NS)
+        self.manifest = self.root.find("opf:manifest", Opf.NS)
+        self.spine = self.root.find("opf:spine", Opf.NS)
+        self.guide = self.root.find("opf:guide", Opf.NS)
+        self.items: Dict[str, etree._Element] = {}
+        self.paths: Dict[str, str] = {}
+        for item in self.manifest.iterfind("opf:item", Opf.NS):
+            self.items[item.get("id")] = item
+            self.paths[self.full_path(item.get("href"))] = item.get("id")
+
+    def full_path(self, href: str) -> str:
+        return posixpath.normpath(posixpath.join(self.dir, unquote(href)))
+
+    @property
+    def cover_image(self) -> Union[str, None]:
+        for path, item_id in self.paths.items():
+            if "cover-image" in self.items[item_id].get("properties", "").split():
+                return path
+        return None
+
+    def remove(self, path: str):
+        """
+        Quita el fichero path del manifest, del spine y del guide
+        """
+        item_id = self.paths.pop(path, None)
+        if item_id is None:
+            return
+        Opf.quita(self.items.pop(item_id))
+        if self.spine is not None:
+            for ref in self.spine.xpath("opf:itemref[@idref=$id]", namespaces=Opf.NS, id=item_id):
+                Opf.quita(ref)
+        if self.guide is not None:
+            for ref in list(self.guide.iterfind("opf:reference", Opf.NS)):
+                if self.full_path(ref.get("href", "").split("#", 1)[0]) == path:
+                    Opf.quita(ref)
+
+    @staticmethod
+    def quita(el: etree._Element):
+        """
+        Quita el del opf dejando a su hermano anterior (o al padre) la
+        sangría que iba detrás de el, para que no se descuadre el cierre
+        """
+        prev = el.getprevious()
+        if prev is not None:
+            prev.tail = el.tail
+        else:
+            el.getparent().text = el.tail
+        el.getparent().remove(el)
+
+    def dc(self, name: str) -> List[etree._Element]:
+        return self.metadata.findall("dc:" + name, Opf.NS)
+
+    def to_bytes(self) -> bytes:
+        return b'<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(self.root, encoding="UTF-8")
+
+
 class MetaData:
     def __init__(self, arg: argparse.Namespace):
         self.__arg = arg
@@ -119,12 +303,6 @@ class MetaData:
     def execute(self) -> str:
         return self.__arg.execute
 
-    @cached_property
-    def re_no_content(self):
-        if self.keep_title:
-            return None
-        return re.compile(r'<item id="title_page" |<item id="title_page_xhtml" |<itemref idref="title_page" |<itemref idref="title_page_xhtml"')
-
     @cached_property
     def isHtml(self):
         return self.fuente.endswith(".html")
@@ -149,6 +327,153 @@ class MetaData:
     def width(self) -> int:
         return self.__arg.width
 
+    @property
+    def jobs(self) -> int:
+        return max(1, self.__arg.jobs or 1)
+
+    @property
+    def profile(self) -> Union[str, None]:
+        return self.__arg.profile
+
+    @property
+    def metrics_json(self) -> Union[str, None]:
+        return self.__arg.metrics_json
+
+    @cached_property
+    def backend(self) -> str:
+        if self.__arg.backend == "lxml" and self.extract:
+            print("--extract usa selectores css, los capítulos se transforman con bs4")
+            return "bs4"
+        return self.__arg.backend
+
+    @property
+    def epubcheck(self) -> str:
+        return self.__arg.epubcheck
+
+    @property
+    def watch(self) -> bool:
+        return self.__arg.watch
+
+    def recargar(self) -> "MetaData":
+        """
+        Nuevos metadatos con los mismos argumentos, para cuando cambia la fuente
+        """
+        return MetaData(self.__arg)
+
+    def borrar_tmp(self):
+        if "tmp" in self.__dict__:
+            shutil.rmtree(self.tmp.root, ignore_errors=True)
+
+    def get_watch_files(self) -> Tuple[str, ...]:
+        files = set()
+        for f in (self.fuente, self.file_css, self.__arg.cover, self.cover_avatar) + self.ficheros_pasos:
+            if f and os.path.isfile(f):
+                f = os.path.realpath(f)
+                if not f.startswith(self.tmp.root + "/"):
+                    files.add(f)
+        return tuple(sorted(files))
+
+    @property
+    def zip_level(self) -> int:
+        return self.__arg.zip_level
+
+    @property
+    def img_engine(self) -> str:
+        return self.__arg.img_engine
+
+    @cached_property
+    def img_cache(self) -> Union[Cache, None]:
+        if not self.__arg.img_cache or self.__arg.img_cache_size <= 0:
+            return None
+        return Cache(self.__arg.img_cache, self.__arg.img_cache_size * 1024 * 1024)
+
+    @cached_property
+    def descargas(self) -> Descargas:
+        cache = None
+        if self.__arg.http_cache and self.__arg.http_cache_size > 0:
+            cache = Cache(self.__arg.http_cache, self.__arg.http_cache_size * 1024 * 1024)
+        return Descargas(cache)
+
+    @cached_property
+    def remotos(self) -> Dict[str, str]:
+        """
+        Descarga a la vez todos los recursos remotos (portada, css e imágenes
+        de la fuente) y devuelve url -> fichero local de los que se han podido
+        descargar. Las imágenes que fallan se quedan para que las descargue
+        pandoc; la portada y el css son obligatorios
+        """
+        destinos = {}
+        obligatorios = set()
+        cover = self._src_cover_image
+        if re_url.match(cover or ""):
+            destinos[cover] = self.tmp.source + "/cover" + extension(cover)
+            obligatorios.add(cover)
+        css = self.__get_file_css()
+        if re_url.match(css or ""):
+            destinos[css] = self.tmp.source + "/" + (os.path.basename(urlparse(css).path) or "style")
+            obligatorios.add(css)
+        for src in self.imagenes_remotas:
+            if src not in destinos:
+                nombre = Cache.clave(src.encode("utf-8"))[:16] + extension(src)
+                destinos[src] = self.tmp.source + "/remoto/" + nombre
+        if not destinos:
+            return {}
+        print(f"Descargando {len(destinos)} recursos remotos")
+        remotos = {}
+        for url, r in self.descargas.descargar_todo(destinos).items():
+            if not isinstance(r, Exception):
+                remotos[url] = r
+            elif url in obligatorios:
+                sys.exit(f"No se ha podido descargar {url}: {r}")
+            else:
+                print(f"No se ha podido descargar {url}: {r}")
+        self.descargas.podar()
+        return remotos
+
+    @cached_property
+    def imagenes_remotas(self) -> Tuple[str, ...]:
+        with open(self.fuente, "r", encoding="utf-8", errors="surrogateescape") as f:
+            fuente = f.read()
+        urls = set()
+        for a, b in re_recurso.findall(fuente):
+            src = a or unescape(b)
+            if re_url.match(src):
+                urls.add(src)
+        return tuple(sorted(urls))
+
+    @cached_property
+    def fuente_pandoc(self) -> str:
+        """
+        La fuente con las imágenes remotas cambiadas por las descargadas,
+        para que pandoc no tenga que descargarlas de una en una. Las rutas
+        relativas de pandoc lo son al directorio actual, no al de la fuente,
+        así que la copia puede estar en el directorio temporal
+        """
+        locales = {src: self.remotos[src] for src in self.imagenes_remotas if src in self.remotos}
+        if not locales:
+            return self.fuente
+
+        def cambia(m: re.Match) -> str:
+            g = 1 if m.group(1) else 2
+            src = m.group(g) if g == 1 else unescape(m.group(g))
+            if src not in locales:
+                return m.group(0)
+            ini, fin = m.start(g) - m.start(), m.end(g) - m.start()
+            return m.group(0)[:ini] + locales[src] + m.group(0)[fin:]
+
+        with open(self.fuente, "r", encoding="utf-8", errors="surrogateescape") as f:
+            fuente = re_recurso.sub(cambia, f.read())
+        file = self.tmp.source + "/" + os.path.basename(self.fuente)
+        with open(file, "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.write(fuente)
+        return file
+
+    @cached_property
+    def build_cache(self) -> Union[Cache, None]:
+        if not (self.__arg.incremental or self.__arg.watch) or not self.__arg.build_cache or self.__arg.build_cache_size <= 0:
+            return None
+        return Cache(self.__arg.build_cache, self.__arg.build_cache_size * 1024 * 1024)
+
     @cached_property
     def mogrify(self):
         mogrify = ["mogrify"]
@@ -183,6 +508,17 @@ class MetaData:
             class_names = "." + ", .".join(class_names)
             return tuple(self._soup.select(class_names))
 
+    @cached_property
+    def class_copy_index(self) -> Dict[Tuple[str, str], Union[str, List[str]]]:
+        """
+        {(tag, texto normalizado): class} de los nodos de get_class_copy_nodes,
+        quedándose con el primero de cada clave
+        """
+        index = {}
+        for c in self.get_class_copy_nodes():
+            index.setdefault((c.name, re_sp.sub(" ", c.get_text()).strip()), c.attrs["class"])
+        return index
+
     @cached_property
     def _yml(self) -> dict:
         if not self.isMd:
@@ -205,8 +541,32 @@ class MetaData:
         with open(self.fuente, "rb") as f:
             return bs4.BeautifulSoup(f, "lxml")
 
+    @cached_property
+    def _head(self):
+        """
+        Solo el <head> de la fuente, que es donde están los metadatos: se
+        parsea el fichero por trozos hasta que empieza el <body> (el de
+        verdad, no un <body> dentro de un comentario o un script). El
+        documento entero (_soup) solo hace falta con --copy-class
+        """
+        if not self.isHtml:
+            return bs4.BeautifulSoup('<xml></xml>', "lxml")
+        parser = None
+        with open(self.fuente, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                if parser is None:
+                    encoding = EncodingDetector.find_declared_encoding(chunk, is_html=True)
+                    parser = etree.HTMLPullParser(events=("start",), encoding=encoding or "utf-8")
+                parser.feed(chunk)
+                if any(el.tag == "body" for _, el in parser.read_events()):
+                    break
+        head = None if parser is None else parser.close().find("head")
+        if head is None:
+            return bs4.BeautifulSoup("", "lxml")
+        return bs4.BeautifulSoup(etree.tostring(head, method="html", encoding="unicode", with_tail=False), "lxml")
+
     def _get_meta_content(self, name: str) -> Union[str, None]:
-        n = self._soup.find("meta", {"name": name})
+        n = self._head.find("meta", {"name": name})
         if n is None:
             return None
         txt = n.attrs.get("content")
@@ -245,26 +605,26 @@ class MetaData:
 
     @cached_property
     def file_cover_image(self) -> Union[str, None]:
-        file = self.__get_file_cover_image()
-        if not (file or "").startswith("http"):
+        file = self._src_cover_image
+        if not re_url.match(file or ""):
             return file
-        print("Descargando portada de " + file)
-        _, extension = os.path.splitext(file)
-        dwn = self.tmp.source + "/cover" + extension
-        descargar(file, dwn)
-        return dwn
+        return self.remotos[file]
+
+    @cached_property
+    def _src_cover_image(self) -> Union[str, None]:
+        return self.__get_file_cover_image()
 
     def __get_file_cover_image(self) -> Union[str, None]:
         if self.__arg.cover:
             return self.__arg.cover
-        c = self._soup.find("meta", attrs={'property': "og:image"})
+        c = self._head.find("meta", attrs={'property': "og:image"})
         if c and "content" in c.attrs:
             print("Recuperada portada de los metadatos del html")
             return c.attrs["content"]
 
         if self.cover_txt:
             print(f"Creando portada '{self.cover_txt}'")
-            return generate_cover(self.cover_txt, output_path=self.tmp.source + "/cover.png")
+            return generate_cover(self.cover_txt, output_path=self.tmp.source + "/cover.png", cache=self.img_cache)
         if self._yml.get('cover-image'):
             return None
         title = self._yml.get('title')
@@ -276,7 +636,8 @@ class MetaData:
             author=self.author,
             date_text=self._yml.get('cover-date') or self._yml.get('date'),
             avatar=self.cover_avatar,
-            output_path=self.tmp.source + "/cover.png"
+            output_path=self.tmp.source + "/cover.png",
+            cache=self.img_cache
         )
 
     @cached_property
@@ -297,7 +658,7 @@ class MetaData:
     def file_metadata(self) -> Union[str, None]:
         meta = []
         m: bs4.Tag
-        for m in self._soup.findAll("meta", {"name": re.compile(r"^dc\.", re.IGNORECASE)}):
+        for m in self._head.findAll("meta", {"name": re.compile(r"^dc\.", re.IGNORECASE)}):
             n = m.attrs["name"].lower()
             c = m.attrs["content"]
             n = "dc:" + n[3:]
@@ -313,22 +674,19 @@ class MetaData:
     @cached_property
     def file_css(self) -> Union[str, None]:
         file = self.__get_file_css()
-        if not (file or "").startswith("http"):
+        if not re_url.match(file or ""):
             return file
-        print("Descargando css de " + file)
-        dwn = self.tmp.source + "/" + os.path.basename(file)
-        descargar(file, dwn)
-        return dwn
+        return self.remotos[file]
 
     def __get_file_css(self) -> Union[str, None]:
         if self.__arg.css:
             return self.__arg.css
-        c = soup.find("link", attrs={'media': "print"})
+        c = self._head.find("link", attrs={'media': "print"})
         if c and "type" in c.attrs and c.attrs["type"] == "text/css":
             css: str = c.attrs.get("href")
             if not isinstance(css, str):
                 return None
-            if css.startswith("http") or os.path.isfile(css):
+            if re_url.match(css) or os.path.isfile(css):
                 return css
             full_css = str(self.dir_fuente)
             if not css.startswith("/"):
@@ -368,6 +726,45 @@ class MetaData:
     def extract(self) -> Union[str, None]:
         return self.__arg.extract
 
+    @cached_property
+    def extract_selector(self) -> Union[soupsieve.SoupSieve, None]:
+        """
+        --extract compilado una vez para todos los capítulos, con los
+        prefijos que bs4 encuentra en los de pandoc
+        """
+        if not self.extract:
+            return None
+        return soupsieve.compile(self.extract, namespaces={"xml": arbol.XML_NS, "epub": "http://www.idpf.org/2007/ops"})
+
+    @property
+    def ficheros_pasos(self) -> Tuple[str, ...]:
+        return tuple(self.__arg.pasos)
+
+    @cached_property
+    def pasos(self) -> Dict[str, Pasos]:
+        """
+        Pasos de cada backend que se usa (el capítulo de notas siempre va con
+        bs4): los de miepub.py y detrás los de --pasos
+        """
+        pasos = {"bs4": Pasos("bs4")}
+        pasos_bs4(pasos["bs4"])
+        if self.backend == "lxml":
+            pasos["lxml"] = Pasos("lxml")
+            pasos_lxml(pasos["lxml"])
+        for file in self.ficheros_pasos:
+            registra = runpy.run_path(file).get("registra")
+            if registra is None:
+                sys.exit(f"{file} no define registra(pasos)")
+            for p in pasos.values():
+                registra(p)
+        try:
+            for p in pasos.values():
+                for fase in FASES:
+                    p.orden(fase)
+        except ValueError as e:
+            sys.exit(str(e))
+        return pasos
+
     @property
     def cover_avatar(self) -> Union[str, None]:
         avatar = self._yml.get('cover-avatar')
@@ -407,24 +804,51 @@ class MetaData:
         return n
 
 
-M = MetaData(parser.parse_args())
+# Metadatos del libro que se está generando, los fija main o construye
+M: Union[MetaData, None] = None
+
+# Cambiar si cambia el dibujo de generate_cover para invalidar la caché
+COVER_VERSION = "1"
 
 tag_concat = ['u', 'ul', 'ol', 'i', 'em', 'strong']
 tag_round = ['u', 'i', 'em', 'span', 'strong', 'a']
 tab_block = ['p', 'li', "tr", "thead", "tbody", 'th', 'td', 'div', 'caption', 'h[1-6]', 'figcaption']
 
 
-def generate_cover(title: str, author: str = None, date_text: str = None, avatar: str = None, output_path="cover.png"):
+@lru_cache(maxsize=None)
+def get_font(name: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(name, size)
+
+
+def generate_cover(title: str, author: str = None, date_text: str = None, avatar: str = None, output_path="cover.png", cache: Union[Cache, None] = None):
+    """
+    Dibuja la portada en output_path. Si se pasa cache, reutiliza la
+    portada ya dibujada con el mismo título, autor, fecha y avatar (por
+    su contenido, no por su ruta)
+    """
     if isinstance(date_text, (date, datetime)):
         date_text = date_text.strftime("%Y")
     if isinstance(date_text, int):
         date_text = str(date_text)
 
+    avatar_data = None
+    if avatar:
+        with open(avatar, "rb") as f:
+            avatar_data = f.read()
+    clave = None
+    if cache is not None:
+        clave = Cache.clave(avatar_data or b"", "cover-" + COVER_VERSION, str(title), str(author or ""), date_text or "", str(avatar_data is not None))
+        png = cache.get(clave)
+        if png is not None:
+            with open(output_path, "wb") as f:
+                f.write(png)
+            return output_path
+    avatar_img = Image.open(io.BytesIO(avatar_data)) if avatar_data is not None else None
+
     def get_colors():
-        if avatar is None:
+        if avatar_img is None:
             return "L", 255, 0
-        img: Image.Image = Image.open(avatar)
-        if img.mode in ("L", "P", "1"):
+        if avatar_img.mode in ("L", "P", "1"):
             return "L", 255, 0
         return "RGB", (255, 255, 255), (0, 0, 0)
 
@@ -434,9 +858,9 @@ def generate_cover(title: str, author: str = None, date_text: str = None, avatar
     image = Image.new(mode, (width, height), color=bg_color)
     draw = ImageDraw.Draw(image)
 
-    title_font = ImageFont.truetype("arial.ttf", 90)
-    author_font = ImageFont.truetype("arial.ttf", 60)
-    date_font = ImageFont.truetype("arial.ttf", 48)
+    title_font = get_font("arial.ttf", 90)
+    author_font = get_font("arial.ttf", 60)
+    date_font = get_font("arial.ttf", 48)
 
     margin = 80
     draw.rectangle(
@@ -481,7 +905,7 @@ def generate_cover(title: str, author: str = None, date_text: str = None, avatar
         available_height = available_bottom - available_top
         available_width = width - 2 * margin
 
-        avatar_img = Image.open(avatar).convert(mode)
+        avatar_img = avatar_img.convert(mode)
         avatar_w, avatar_h = avatar_img.size
         scale = min(available_width / avatar_w, available_height / avatar_h)
         new_size = (int(avatar_w * scale), int(avatar_h * scale))
@@ -498,7 +922,12 @@ def generate_cover(title: str, author: str = None, date_text: str = None, avatar
         date_y = height * 0.88
         draw.text((date_x, date_y), date_text, fill=fg_color, font=date_font)
 
-    image.save(output_path)
+    buff = io.BytesIO()
+    image.save(buff, "PNG")
+    with open(output_path, "wb") as f:
+        f.write(buff.getvalue())
+    if clave is not None:
+        cache.put(clave, buff.getvalue())
     return output_path
 
 
@@ -530,39 +959,97 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f %s%s" % (num, 'Y', suffix)
 
 
+def _nombres(t: str) -> Tuple[str, ...]:
+    m = re.match(r"^(\w+)\[(\d)-(\d)\]$", t)
+    if m is None:
+        return (t, )
+    return tuple(m.group(1) + str(i) for i in range(int(m.group(2)), int(m.group(3)) + 1))
+
+
+def _clave_tag(tag: str) -> Tuple[str, str]:
+    """
+    Clasifica un tag serializado como los patrones de minify_soup:
+    "<" para <t>, " " para <t [^>]+> y "/" para </t>
+    """
+    if tag.startswith("</"):
+        return "/", tag[2:-1]
+    nombre, sp, _ = tag[1:-1].partition(" ")
+    if sp and len(tag) > len(nombre) + 3:
+        return " ", nombre
+    return "<", tag[1:-1]
+
+
+re_tag = re.compile(r"(<[^>]*>)")
+re_concat = tuple(
+    ("</" + t + ">", re.compile(r"</" + t + r">(\s*)<" + t + ">", re.MULTILINE | re.DOTALL | re.UNICODE))
+    for t in tag_concat
+)
+# Cada paso es (operación, tags a los que afecta) y se aplican en este orden:
+# "<>" es (<t>)(\s+) -> \2\1, "><" es (\s+)(</t>) -> \2\1,
+# "\n<" es \s*(<t>)\s* -> \n\1 y ">\n" es \s*(</t>)\s* -> \1\n
+minify_pasos = tuple(
+    [(op, frozenset([(k, t)])) for t in tag_round for op, k in (("<>", "<"), ("<>", " "), ("><", "/"))] +
+    [(op, frozenset((k, n) for n in _nombres(t))) for t in tab_block for op, k in (("\n<", "<"), ("\n<", " "), (">\n", "/"))]
+)
+
+
 def minify_soup(soup: bs4.Tag):
-    def __re(rg: str):
-        return re.compile(rg, re.MULTILINE | re.DOTALL | re.UNICODE)
-
-    h = str(soup)  # htmlmin.minify(str(soup), remove_empty_space=True)
-
-    for t in tag_concat:
-        r = __re(r"</" + t + r">(\s*)<" + t + ">")
-        h = r.sub(r"\1", h)
-    for t in tag_round:
-        for r in (
-            __re(r"(<" + t + r">)(\s+)"),
-            __re(r"(<" + t + r" [^>]+>)(\s+)"),
-            __re(r"(\s+)(</" + t + r">)")
-        ):
-            h = r.sub(r"\2\1", h)
-    for t in tab_block:
-        for r in (
-            __re(r"\s*(<" + t + r">)\s*"),
-            __re(r"\s*(<" + t + r" [^>]+>)\s*"),
-        ):
-            h = r.sub(r"\n\1", h)
-        h = __re(r"\s*(</" + t + r">)\s*").sub(r"\1\n", h)
-    return h
-
-
-def descargar(url, dwn):
-    try:
-        urllib.request.urlretrieve(url, dwn)
-    except Exception:
-        call(["wget", url, "--quiet", "-O", dwn])
+    return minify(str(soup))
+
+
+def minify(h: str) -> str:
+    """
+    Ajusta los espacios alrededor de los tags de tag_concat, tag_round y
+    tab_block. Da el mismo resultado que aplicar uno detrás de otro los
+    re.sub que se describen en minify_pasos, pero recorriendo una sola vez
+    el html: se trocea en textos y tags y cada paso solo visita los tags
+    a los que afecta.
+    """
+    h = h.replace(' xmlns:="', ' xmlns="')
+    for cierre, r in re_concat:
+        if cierre in h:
+            h = r.sub(r"\1", h)
+
+    partes = re_tag.split(h)
+    txt = partes[0::2]
+    tags = partes[1::2]
+    indice: Dict[Tuple[str, str], List[int]] = {}
+    for i, tag in enumerate(tags):
+        indice.setdefault(_clave_tag(tag), []).append(i)
+
+    # El tag i va entre txt[i] y txt[i+1]
+    for op, claves in minify_pasos:
+        pos = [i for k in claves for i in indice.get(k, ())]
+        if not pos:
+            continue
+        if op == "<>":
+            mover = [(i, len(txt[i + 1]) - len(txt[i + 1].lstrip())) for i in pos]
+            for i, n in mover:
+                if n:
+                    txt[i] = txt[i] + txt[i + 1][:n]
+                    txt[i + 1] = txt[i + 1][n:]
+        elif op == "><":
+            mover = [(i, len(txt[i]) - len(txt[i].rstrip())) for i in pos]
+            for i, n in mover:
+                if n:
+                    txt[i + 1] = txt[i][-n:] + txt[i + 1]
+                    txt[i] = txt[i][:-n]
+        else:
+            for i in pos:
+                txt[i] = txt[i].rstrip()
+                txt[i + 1] = txt[i + 1].lstrip()
+            if op == "\n<":
+                for i in pos:
+                    txt[i] = txt[i] + "\n"
+            else:
+                for i in pos:
+                    txt[i + 1] = "\n" + txt[i + 1]
+
+    partes[0::2] = txt
+    return "".join(partes)
 
 
+@lru_cache(maxsize=None)
 def simplifica(s):
     s = unicodedata.normalize('NFKD', s)
     s = s.encode('ascii', 'ignore')
@@ -574,17 +1061,103 @@ def simplifica(s):
     return s
 
 
-def optimizar(s):
-    antes = os.path.getsize(s)
-    c = M.tmp.wks + "/" + os.path.basename(s)
-    shutil.copy(s, c)
-    if len(M.mogrify) > 1:
-        call(list(M.mogrify) + [c])
-    call(["picopt", "--quiet", "--destroy_metadata",
-          "--comics", "--enable_advpng", c])
-    despues = os.path.getsize(c)
-    if antes > despues:
-        shutil.move(c, s)
+def tabla_ids(capitulos: List[bytes]) -> Dict[str, str]:
+    """
+    Recorre los ids de los elementos de todos los capítulos (no lo que lo
+    parece en un comentario, un CDATA o un código de ejemplo) y devuelve
+    cómo hay que renombrar los que simplifica cambia.
+    Si dos ids se quedan iguales al simplificarlos, o igual que otro id
+    que no cambia, se les añade -2, -3... para no tener ids repetidos.
+    Pandoc genera ids únicos en todo el libro, así que la tabla es global
+    """
+    ids: Dict[str, None] = {}
+    for data in capitulos:
+        for _, el in etree.iterparse(io.BytesIO(data), events=("start",), recover=True, huge_tree=True):
+            i = el.get("id")
+            if i is not None:
+                ids[i] = None
+    usados = {i for i in ids if simplifica(i) in ("", i)}
+    tabla = {}
+    for i in ids:
+        s = simplifica(i)
+        if s in ("", i):
+            continue
+        nuevo = s
+        n = 2
+        while nuevo in usados:
+            nuevo = f"{s}-{n}"
+            n = n + 1
+        usados.add(nuevo)
+        tabla[i] = nuevo
+    return tabla
+
+
+def renombra_href(href: str, ids: Dict[str, str]) -> str:
+    """
+    Aplica la tabla de tabla_ids al #fragmento de un enlace interno
+    """
+    if "#" not in href or re_esquema.match(href):
+        return href
+    path, frag = href.split("#", 1)
+    nuevo = ids.get(frag) or ids.get(unquote(frag))
+    return path + "#" + nuevo if nuevo else href
+
+
+def _optimizar(s: str, data: bytes) -> Tuple[bytes, str]:
+    """
+    Devuelve la imagen optimizada y el motor que la ha generado (Pillow
+    puede no saber hacerlo y pasarla a mogrify/picopt)
+    """
+    if M.img_engine == "pillow":
+        try:
+            return imagenes.pillow(data, imagenes.Operaciones.from_mogrify(M.mogrify)), "pillow"
+        except (ValueError, OSError) as e:
+            print(f"{os.path.basename(s)}: {e}, se usará mogrify/picopt")
+    return imagenes.externo(os.path.basename(s), data, M.mogrify, M.tmp.wks), "external"
+
+
+def primer_h1(html: bytes) -> Union[str, None]:
+    """
+    Texto (como el .string de bs4) del primer <h1> del capítulo, leyendo
+    el xhtml solo hasta cerrar ese <h1>. Como pandoc parte los capítulos
+    por encabezados, si un capítulo tiene un <h1> es lo primero que aparece.
+    """
+    for _, h1 in etree.iterparse(io.BytesIO(html), events=("end",), tag="{*}h1", recover=True):
+        while len(h1) == 1 and not h1.text and not h1[0].tail:
+            h1 = h1[0]
+        if len(h1) > 0:
+            return None
+        return h1.text
+    return None
+
+
+def optimizar(s: str, antes: bytes) -> bytes:
+    """
+    Devuelve la imagen optimizada, o la original sin metadatos si no se
+    consigue reducirla
+    """
+    despues = None
+    if M.img_cache is not None:
+        # Cada imagen se guarda con la clave del motor que la ha generado,
+        # así que con pillow también vale la de external (las que Pillow no
+        # sabe hacer)
+        motores = ("pillow", "external") if M.img_engine == "pillow" else ("external",)
+        for motor in motores:
+            despues = M.img_cache.get(M.img_cache.clave(antes, *M.mogrify, imagenes.version(motor)))
+            if despues is not None:
+                break
+    if despues is None:
+        despues, motor = _optimizar(s, antes)
+        if len(despues) >= len(antes):
+            # Aunque no se consiga reducir, que no se queden los metadatos
+            despues = imagenes.sin_metadatos(antes)
+            if len(despues) >= len(antes):
+                despues = b""
+        if M.img_cache is not None:
+            M.img_cache.put(M.img_cache.clave(antes, *M.mogrify, imagenes.version(motor)), despues)
+    if len(despues) == 0:
+        return antes
+    return despues
 
 
 def str_to_cmd(s: str):
@@ -600,317 +1173,1109 @@ def str_to_cmd(s: str):
             arr.append(c)
     return arr
 
-print("Convirtiendo con pandoc")
-print(f"pandoc '{M.fuente}'", *map(str, M.extra_args), f" -o '{M.out}'")
-pypandoc.convert_file(M.fuente,
-                      outputfile=M.out,
-                      to="epub",
-                      extra_args=M.extra_args)
-
-print("Epub inicial de " + sizeof_fmt(os.path.getsize(M.out)))
-
-copy(M.out, M.tmp.root)
-
-print("Descomprimiendo epub")
-with zipfile.ZipFile(M.out, 'r') as zip_ref:
-    zip_ref.extractall(M.tmp.out)
-    zip_ref.close()
-
-print("Eliminando navegación innecesaria")
-#os.remove(M.tmp.out + "/EPUB/nav.xhtml")
-if M.keep_title:
-    with open(M.tmp.out + "/EPUB/text/title_page.xhtml", "r") as f:
-        tt_soup = bs4.BeautifulSoup(f, "xml")
-    n_body = tt_soup.new_tag("body")
-    o_body = tt_soup.find("body")
-    for a in o_body.attrs:
-        n_body[a] = o_body.attrs[a]
-    o_body.name = "div"
-    o_body.attrs.clear()
-    o_body.attrs["class"] = "title_page"
-    o_body.wrap(n_body)
-    with open(M.tmp.out + "/EPUB/text/title_page.xhtml", "w") as f:
-        f.write(str(tt_soup))
-else:
-    os.remove(M.tmp.out + "/EPUB/text/title_page.xhtml")
-
-with open(M.tmp.out + "/EPUB/content.opf", "r+") as f:
-    d = "".join(ln for ln in f.readlines() if not (M.re_no_content is not None and M.re_no_content.search(ln)) and ln.strip() != "<dc:source></dc:source>")
+
+class Capitulo(NamedTuple):
+    """
+    Capítulo ya transformado y minificado pero sin numerar sus notas:
+    en html y notas cada número es una marca relativa al capítulo que
+    numera_notas sustituye por el número definitivo
+    """
+    html: str
+    notas: Tuple[str, ...]
+    refs: int
+    fix: Dict[str, str]
+
+
+re_recurso = re.compile(r"!\[[^\]]*\]\(\s*<?([^)\s>]+)|<img\b[^>]*?\ssrc=[\"']([^\"']+)", re.IGNORECASE)
+# Las marcas que se sustituyen en el html de los capítulos son
+# no-caracteres de Unicode (U+FDD0-U+FDEF), reservados para uso interno, y
+# no de uso privado, que sí aparecen en el texto con las fuentes de iconos.
+# Sitio del capítulo de notas donde van las de los otros capítulos
+MARCA_NOTAS = "\ufdd4"
+re_marca_num = re.compile("\ufdd0(\\d+)\ufdd1")
+re_marca_nota = re.compile("\ufdd2(\\d+)\ufdd3")
+re_no_caracter = re.compile(rb"\xef\xb7[\x90-\xaf]|&#(?:[xX]0*[fF][dD][dDeE][0-9a-fA-F]|0*(?:6497[6-9]|649[89][0-9]|6500[0-7]));")
+
+
+def sin_marcas(data: bytes) -> bytes:
+    """
+    Cambia por U+FFFD los no-caracteres que traiga el capítulo (en utf-8 o
+    como referencia numérica) para que no se confundan con las marcas
+    """
+    return re_no_caracter.sub("\ufffd".encode("utf-8"), data)
+
+
+def marca_num(i: int) -> str:
+    return "\ufdd0" + str(i) + "\ufdd1"
+
+
+def marca_nota(i: int) -> str:
+    return "\ufdd2" + str(i) + "\ufdd3"
+
+
+def numera_notas(html: str, count: int) -> str:
+    html = re_marca_num.sub(lambda m: str(count + int(m.group(1))), html)
+    return re_marca_nota.sub(lambda m: EntitySubstitution.substitute_xml(M.parse_note("[" + str(count + int(m.group(1))) + "]")), html)
+
+
+def clases(t: bs4.Tag) -> List[str]:
+    c = t.attrs.get("class")
+    if c is None:
+        return []
+    return c.split() if isinstance(c, str) else c
+
+
+# Los find_all, find y find_parent de bs4 crean un filtro en cada llamada,
+# que cuesta más que la búsqueda cuando se llaman por cada tag del capítulo
+
+def _hijos(t: bs4.Tag, names: Tuple[str, ...]) -> List[bs4.Tag]:
+    return [h for h in t.contents if isinstance(h, bs4.Tag) and h.name in names]
+
+
+def _primero(t: bs4.Tag, name: str) -> Union[bs4.Tag, None]:
+    return next((d for d in t.descendants if isinstance(d, bs4.Tag) and d.name == name), None)
+
+
+def _antecesor(t: bs4.Tag, names: Tuple[str, ...]) -> Union[bs4.Tag, None]:
+    return next((p for p in t.parents if p.name in names), None)
+
+
+# Pasos de la fase pre (ver pasos.Pasos)
+
+def _ids(t: bs4.Tag, ctx: Contexto):
+    """
+    Ids y enlaces renombrados
+    """
+    attrs = t.attrs
+    if "id" in attrs and attrs["id"] in ctx.ids:
+        attrs["id"] = ctx.ids[attrs["id"]]
+    if "href" in attrs:
+        attrs["href"] = renombra_href(attrs["href"], ctx.ids)
+
+
+def _imgdup(img: bs4.Tag, ctx: Contexto):
+    """
+    Imágenes duplicadas
+    """
+    src = img.attrs.get("src")
+    if src in ctx.imgdup:
+        img.attrs["src"] = ctx.imgdup[src]
+    elif src and src.startswith("../") and src[3:] in ctx.imgdup:
+        img.attrs["src"] = "../" + ctx.imgdup[src[3:]]
+
+
+def _p_tabla(p: bs4.Tag, ctx: Contexto):
+    if _antecesor(p, ("table", "figure")) is not None:
+        p.unwrap()
+
+
+def _legend(legend: bs4.Tag, ctx: Contexto):
+    p = legend.parent
+    if p.name == "p" and p.parent is not None and p.parent.name == "fieldset":
+        p.unwrap()
+
+
+def _busca_notas(t: bs4.Tag, ctx: Contexto):
+    if t.name == "section":
+        if ctx.footnotes is None and "footnotes" in clases(t):
+            ctx.footnotes = t
+    elif "footnote-ref" in clases(t):
+        ctx.refs.append(t)
+
+
+# Pasos de la fase post
+
+def _copia_class(t: bs4.Tag, ctx: Contexto):
+    """
+    Copia el class de la fuente al primer tag del capítulo con el mismo
+    nombre y texto, si no tiene ya uno
+    """
+    index = M.class_copy_index
+    hechos = ctx.datos.setdefault("copia_class", set())
+    if len(hechos) == len(index):
+        return
+    k = (t.name, re_sp.sub(" ", t.get_text()).strip())
+    if k not in index or k in hechos:
+        return
+    hechos.add(k)
+    if "class" not in t.attrs:
+        t.attrs["class"] = index[k]
+
+
+def _alt(img: bs4.Tag, ctx: Contexto):
+    if "alt" not in img.attrs:
+        img.attrs["alt"] = ""
+
+
+def _article(n: bs4.Tag, ctx: Contexto):
+    n.name = "div"
+
+
+def _celdas(tr: bs4.Tag) -> Tuple[List[bs4.Tag], bool]:
+    """
+    Junta cada serie de celdas con > con la siguiente en un colspan y pasa
+    a th las celdas que son solo un strong, calculando el texto de cada
+    celda una sola vez. Devuelve las celdas que quedan y si la fila tiene
+    datos (algún td con texto)
+    """
+    celdas = []
+    datos = False
+    colspan = 0
+    for td in _hijos(tr, ("td", "th")):
+        txt = get_text(td)
+        if txt == ">":
+            colspan = colspan + 1
+            td.extract()
+            continue
+        if colspan > 0:
+            td.attrs["colspan"] = str(colspan+1)
+            td.attrs["style"] = "text-align: center;"
+            colspan = 0
+        b = _primero(td, "strong")
+        if b and get_text(b) == txt:
+            b.unwrap()
+            td.name = "th"
+        elif td.name == "td" and txt is not None:
+            datos = True
+        celdas.append(td)
+    return celdas, datos
+
+
+def _tablas(table: bs4.Tag, ctx: Contexto):
+    """
+    Normaliza una tabla en una sola pasada por sus filas: colspan y th en
+    cada fila (ver _celdas), las filas sin datos del principio de cada
+    tbody pasan al thead (si después de la primera con datos no hay más
+    sin datos) y las filas del thead y de cada tbody se marcan como odd o
+    even
+    """
+    if not M.isMd:
+        return
+    grupos = _hijos(table, ("thead", "tbody", "tfoot", "tr"))
+    thead = next((g for g in grupos if g.name == "thead"), None)
+    # Filas de cada grupo que se numeran, las del thead aparte para poder
+    # añadirle las que suben de los tbody
+    filas_thead: List[bs4.Tag] = []
+    numeradas = [filas_thead]
+    for grupo in grupos:
+        if grupo.name == "tr":
+            _celdas(grupo)
+            continue
+        filas = []
+        # Filas sin datos antes de la primera con datos
+        cabecera = []
+        hay_datos = False
+        sube = True
+        for tr in _hijos(grupo, ("tr",)):
+            celdas, datos = _celdas(tr)
+            if grupo.name == "tbody" and not datos:
+                for td in celdas:
+                    td.name = "th"
+                if not hay_datos:
+                    cabecera.append(tr)
+                    continue
+                sube = False
+            hay_datos = hay_datos or datos
+            filas.append(tr)
+        if cabecera and hay_datos and sube:
+            if thead is None:
+                thead = ctx.raiz.new_tag('thead')
+                table.insert(0, thead)
+            for tr in cabecera:
+                thead.append(tr)
+            filas_thead.extend(cabecera)
+        else:
+            filas = cabecera + filas
+        if grupo is thead:
+            filas_thead[:0] = filas
+        elif grupo.name != "tfoot":
+            numeradas.append(filas)
+    for filas in numeradas:
+        for i, tr in enumerate(filas):
+            tr.attrs["class"] = "odd" if (i % 2) == 0 else "even"
+
+
+def _cite(c: bs4.Tag, ctx: Contexto):
+    if not M.isMd:
+        return
+    p = c.parent
+    q = p.parent
+    if q.name == "blockquote" and p.name == "p" and re_sp.sub(" ", p.get_text()).strip() == re_sp.sub(" ", c.get_text()).strip():
+        p.attrs["class"] = "cite"
+        q.attrs["class"] = "cite"
+
+
+def _a_img(img: bs4.Tag, ctx: Contexto):
+    a = img.parent
+    if a.name != "a" or get_text(a) is not None:
+        return
+    # img es el único tag dentro de a
+    if all(d is img for d in a.descendants if isinstance(d, bs4.Tag)):
+        add_class(a, "pandoc_a_img")
+
+
+# Kobo no lo respeta ni así
+# def _pre(pre_code: bs4.Tag, ctx: Contexto):
+#     if pre_code.select(":scope > *") and len(pre_code.select("*")) == 1:
+#         pre_code.attrs['style'] = "white-space: pre !important; font-family: monospace !important; text-align: left !important;"
+
+
+def pasos_bs4(pasos: Pasos):
+    """
+    Registra los pasos de miepub.py con bs4. Los de tablas y citas solo
+    hacen algo con fuentes md
+    """
+    pasos.registra("ids", "pre", entrar=_ids)
+    pasos.registra("imgdup", "pre", ("img",), entrar=_imgdup)
+    pasos.registra("p", "pre", ("p",), entrar=_p_tabla, despues=("ids",))
+    pasos.registra("legend", "pre", ("legend",), entrar=_legend, despues=("p",))
+    pasos.registra("notas", "pre", ("section", "a"), entrar=_busca_notas)
+    pasos.registra("copia_class", "post", sorted({n for n, _ in M.class_copy_index}), entrar=_copia_class)
+    pasos.registra("alt", "post", ("img",), entrar=_alt)
+    pasos.registra("article", "post", ("article",), entrar=_article, despues=("copia_class",))
+    pasos.registra("tablas", "post", ("table",), salir=_tablas, despues=("copia_class",))
+    pasos.registra("cite", "post", ("cite",), entrar=_cite, despues=("copia_class",))
+    pasos.registra("a_img", "post", ("img",), entrar=_a_img, despues=("copia_class", "alt"))
+
+
+def _pre_notas(soup: bs4.BeautifulSoup, ctx: Contexto):
+    if M.extract_selector is not None:
+        for n in M.extract_selector.select(soup):
+            n.extract()
+    M.pasos["bs4"].recorre(soup, "pre", ctx)
+
+
+def _post_notas(soup: bs4.BeautifulSoup, ctx: Contexto):
+    M.pasos["bs4"].recorre(soup, "post", ctx)
+
+
+def transforma_capitulo(html: str, data: bytes, xnota: str, ids: Dict[str, str], imgdup: Dict[str, str]) -> Capitulo:
+    """
+    Transforma un capítulo que no es el de las notas. No depende del resto
+    de capítulos, así que se puede ejecutar en paralelo.
+    """
+    chml = os.path.basename(html)
+    xnota = os.path.basename(xnota)
+    soup = bs4.BeautifulSoup(sin_marcas(data), "xml")
+    ctx = Contexto(soup, html, ids, imgdup)
+    _pre_notas(soup, ctx)
+    notas = []
+    fixNotas = {}
+    count = 0
+    footnotes = ctx.footnotes
+    if footnotes:
+        for p in footnotes.find_all("p"):
+            a = p.select_one("a.footnote-back")
+            if a['href'].startswith("#"):
+                a['href'] = chml + a['href']
+            p['id'] = "fn" + marca_num(count)
+            a['class'] = "volver"
+            a.string = "<<"
+            p.append(a)
+            a.insert_before(" ")
+            first_text = p.find(string=True)
+            first_text.replace_with(re.sub(r"^[\s\.]+", "", first_text.string))
+            sup = soup.new_tag("sup")
+            sup.string = marca_nota(count)
+            p.insert(0, sup)
+            p.insert(1, " ")
+            notas.append(p)
+            count = count + 1
+        count = 0
+        for a in ctx.refs:
+            a['href'] = xnota + "#fn" + marca_num(count)
+            sup = a.find("sup")
+            if not sup:
+                sup = soup.new_tag("sup")
+                a.string = ""
+                a.append(sup)
+            sup.string = marca_nota(count)
+            if a.previous_sibling is None:
+                raise Exception(str(a)+" previous_sibling = None")
+            if len(a.previous_sibling.string) > 0 and len(a.previous_sibling.strip()) == 0:
+                a.previous_sibling.extract()
+            count = count + 1
+    else:
+        for a in ctx.refs:
+            if a['href'].startswith("#"):
+                a['href'] = xnota + a['href']
+                fixNotas[a['id']] = chml
+    # Las notas se terminan aquí, aún dentro del capítulo, para que el de
+    # notas solo tenga que concatenarlas
+    _post_notas(soup, ctx)
+    if footnotes:
+        footnotes.extract()
+    return Capitulo(
+        html=minify_soup(soup),
+        notas=tuple(minify_soup(p).strip() for p in notas),
+        refs=count,
+        fix=fixNotas
+    )
+
+
+def capitulo_notas(data: bytes, notas: str, fixNotas: Dict[str, str], ids: Dict[str, str], imgdup: Dict[str, str]) -> str:
+    """
+    Transforma el capítulo de las notas añadiendo al final de su primera
+    sección las notas (ya numeradas, terminadas y minificadas, cada una
+    precedida de un salto de línea) de los capítulos anteriores. Las notas
+    no se vuelven a parsear: se insertan en el html ya minificado en el
+    sitio de una marca
+    """
+    soup = bs4.BeautifulSoup(sin_marcas(data), "xml")
+    ctx = Contexto(soup, "", ids, imgdup)
+    _pre_notas(soup, ctx)
+    div = soup.select_one("section")
+    enlaces: Dict[str, bs4.Tag] = {}
+    for a in div.find_all("a", href=True):
+        enlaces.setdefault(a.attrs["href"], a)
+    for _id, xml in fixNotas.items():
+        a = enlaces.get("#"+_id)
+        if a:
+            a.attrs["href"] = xml + a.attrs["href"]
+    if not notas:
+        _post_notas(soup, ctx)
+        return minify_soup(soup)
+    div.append(MARCA_NOTAS)
+    _post_notas(soup, ctx)
+    antes, despues = minify_soup(soup).split(MARCA_NOTAS, 1)
+    # Igual que haría minify_soup con los <p> de las notas
+    return antes.rstrip() + notas + "\n" + despues.lstrip()
+
+
+NS_XHTML = {"h": "http://www.w3.org/1999/xhtml"}
+
+
+def _clase(c: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {c} ')"
+
+
+# Lo que queda de los select() de transforma_capitulo (--backend lxml). Para
+# buscar un tag dentro de otro se usa iter(H + "tag"), que es más rápido que
+# un XPath cuando se llama por cada tag del capítulo
+H = "{http://www.w3.org/1999/xhtml}"
+X_FOOTNOTE_BACK = etree.XPath(f".//h:a[{_clase('footnote-back')}]", namespaces=NS_XHTML)
+
+
+def get_text_lxml(n: etree._Element) -> Union[str, None]:
+    txt = re_sp.sub(" ", arbol.texto(n)).strip()
+    if len(txt) == 0:
+        return None
+    return txt
+
+
+# Los mismos pasos con lxml
+
+def _ids_lxml(t: etree._Element, ctx: Contexto):
+    _id = t.get("id")
+    if _id in ctx.ids:
+        t.set("id", ctx.ids[_id])
+    href = t.get("href")
+    if href is not None:
+        t.set("href", renombra_href(href, ctx.ids))
+
+
+def _imgdup_lxml(img: etree._Element, ctx: Contexto):
+    src = img.get("src")
+    if src in ctx.imgdup:
+        img.set("src", ctx.imgdup[src])
+    elif src and src.startswith("../") and src[3:] in ctx.imgdup:
+        img.set("src", "../" + ctx.imgdup[src[3:]])
+
+
+def _p_tabla_lxml(p: etree._Element, ctx: Contexto):
+    if next(p.iterancestors(H + "table", H + "figure"), None) is not None:
+        arbol.desenvuelve(p)
+
+
+def _legend_lxml(legend: etree._Element, ctx: Contexto):
+    p = legend.getparent()
+    if arbol.nombre(p) == "p" and p.getparent() is not None and arbol.nombre(p.getparent()) == "fieldset":
+        arbol.desenvuelve(p)
+
+
+def _busca_notas_lxml(t: etree._Element, ctx: Contexto):
+    if arbol.nombre(t) == "section":
+        if ctx.footnotes is None and "footnotes" in arbol.clases(t):
+            ctx.footnotes = t
+    elif "footnote-ref" in arbol.clases(t):
+        ctx.refs.append(t)
+
+
+def _copia_class_lxml(t: etree._Element, ctx: Contexto):
+    index = M.class_copy_index
+    hechos = ctx.datos.setdefault("copia_class", set())
+    if len(hechos) == len(index):
+        return
+    k = (arbol.nombre(t), re_sp.sub(" ", arbol.texto(t)).strip())
+    if k not in index or k in hechos:
+        return
+    hechos.add(k)
+    if t.get("class") is None:
+        c = index[k]
+        t.set("class", c if isinstance(c, str) else " ".join(c))
+
+
+def _alt_lxml(img: etree._Element, ctx: Contexto):
+    if img.get("alt") is None:
+        img.set("alt", "")
+
+
+def _article_lxml(n: etree._Element, ctx: Contexto):
+    n.tag = arbol.tag(n, "div")
+
+
+def _hijos_lxml(t: etree._Element, names: Tuple[str, ...]) -> List[etree._Element]:
+    tags = tuple(H + n for n in names)
+    return [h for h in t if h.tag in tags]
+
+
+def _celdas_lxml(tr: etree._Element) -> Tuple[List[etree._Element], bool]:
+    celdas = []
+    datos = False
+    colspan = 0
+    for td in _hijos_lxml(tr, ("td", "th")):
+        txt = get_text_lxml(td)
+        if txt == ">":
+            colspan = colspan + 1
+            arbol.saca(td)
+            continue
+        if colspan > 0:
+            td.set("colspan", str(colspan+1))
+            td.set("style", "text-align: center;")
+            colspan = 0
+        b = next(td.iter(H + "strong"), None)
+        if b is not None and get_text_lxml(b) == txt:
+            arbol.desenvuelve(b)
+            td.tag = arbol.tag(td, "th")
+        elif td.tag == H + "td" and txt is not None:
+            datos = True
+        celdas.append(td)
+    return celdas, datos
+
+
+def _tablas_lxml(table: etree._Element, ctx: Contexto):
+    if not M.isMd:
+        return
+    grupos = _hijos_lxml(table, ("thead", "tbody", "tfoot", "tr"))
+    thead = next((g for g in grupos if g.tag == H + "thead"), None)
+    filas_thead: List[etree._Element] = []
+    numeradas = [filas_thead]
+    for grupo in grupos:
+        name = arbol.nombre(grupo)
+        if name == "tr":
+            _celdas_lxml(grupo)
+            continue
+        filas = []
+        cabecera = []
+        hay_datos = False
+        sube = True
+        for tr in _hijos_lxml(grupo, ("tr",)):
+            celdas, datos = _celdas_lxml(tr)
+            if name == "tbody" and not datos:
+                for td in celdas:
+                    td.tag = arbol.tag(td, "th")
+                if not hay_datos:
+                    cabecera.append(tr)
+                    continue
+                sube = False
+            hay_datos = hay_datos or datos
+            filas.append(tr)
+        if cabecera and hay_datos and sube:
+            if thead is None:
+                thead = arbol.nuevo(table, "thead", 0)
+            for tr in cabecera:
+                arbol.mueve(tr, thead)
+            filas_thead.extend(cabecera)
+        else:
+            filas = cabecera + filas
+        if grupo is thead:
+            filas_thead[:0] = filas
+        elif name != "tfoot":
+            numeradas.append(filas)
+    for filas in numeradas:
+        for i, tr in enumerate(filas):
+            tr.set("class", "odd" if (i % 2) == 0 else "even")
+
+
+def _cite_lxml(c: etree._Element, ctx: Contexto):
+    if not M.isMd:
+        return
+    p = c.getparent()
+    q = p.getparent()
+    if q is not None and arbol.nombre(q) == "blockquote" and arbol.nombre(p) == "p" and re_sp.sub(" ", arbol.texto(p)).strip() == re_sp.sub(" ", arbol.texto(c)).strip():
+        p.set("class", "cite")
+        q.set("class", "cite")
+
+
+def _a_img_lxml(img: etree._Element, ctx: Contexto):
+    a = img.getparent()
+    if arbol.nombre(a) != "a" or get_text_lxml(a) is not None:
+        return
+    if all(d is img for d in a.iterdescendants(etree.Element)):
+        a.set("class", ((a.get("class") or "") + " pandoc_a_img").strip())
+
+
+def pasos_lxml(pasos: Pasos):
+    """
+    Los mismos pasos que pasos_bs4, con los mismos nombres, para lxml
+    """
+    pasos.registra("ids", "pre", entrar=_ids_lxml)
+    pasos.registra("imgdup", "pre", ("img",), entrar=_imgdup_lxml)
+    pasos.registra("p", "pre", ("p",), entrar=_p_tabla_lxml, despues=("ids",))
+    pasos.registra("legend", "pre", ("legend",), entrar=_legend_lxml, despues=("p",))
+    pasos.registra("notas", "pre", ("section", "a"), entrar=_busca_notas_lxml)
+    pasos.registra("copia_class", "post", sorted({n for n, _ in M.class_copy_index}), entrar=_copia_class_lxml)
+    pasos.registra("alt", "post", ("img",), entrar=_alt_lxml)
+    pasos.registra("article", "post", ("article",), entrar=_article_lxml, despues=("copia_class",))
+    pasos.registra("tablas", "post", ("table",), salir=_tablas_lxml, despues=("copia_class",))
+    pasos.registra("cite", "post", ("cite",), entrar=_cite_lxml, despues=("copia_class",))
+    pasos.registra("a_img", "post", ("img",), entrar=_a_img_lxml, despues=("copia_class", "alt"))
+
+
+def transforma_capitulo_lxml(html: str, data: bytes, xnota: str, ids: Dict[str, str], imgdup: Dict[str, str]) -> Capitulo:
+    """
+    transforma_capitulo con lxml.etree en vez de bs4 y soupsieve (--backend
+    lxml). Hace los mismos pasos y da el mismo html
+    """
+    chml = os.path.basename(html)
+    xnota = os.path.basename(xnota)
+    root = arbol.parse(sin_marcas(data))
+    ctx = Contexto(root, html, ids, imgdup)
+    M.pasos["lxml"].recorre(root, "pre", ctx)
+    notas = []
+    fixNotas = {}
+    count = 0
+    footnotes = ctx.footnotes
+    if footnotes is not None:
+        for p in list(footnotes.iter(H + "p")):
+            a = X_FOOTNOTE_BACK(p)[0]
+            if a.get("href").startswith("#"):
+                a.set("href", chml + a.get("href"))
+            p.set("id", "fn" + marca_num(count))
+            a.set("class", "volver")
+            arbol.vacia(a)
+            a.text = "<<"
+            arbol.mueve(a, p)
+            # bs4 separa con " " el enlace y luego limpia el primer texto,
+            # que si no hay otro es ese mismo " "
+            first_text = arbol.primer_texto(p, a)
+            if first_text is not None:
+                n, attr = first_text
+                setattr(n, attr, re.sub(r"^[\s\.]+", "", getattr(n, attr)))
+                arbol.antes(a, " ")
+            sup = arbol.nuevo(p, "sup", 0)
+            sup.text = marca_nota(count)
+            sup.tail = " " + (sup.tail or "")
+            notas.append(p)
+            count = count + 1
+        count = 0
+        for a in ctx.refs:
+            a.set("href", xnota + "#fn" + marca_num(count))
+            sup = next(a.iter(H + "sup"), None)
+            if sup is None:
+                arbol.vacia(a)
+                a.text = ""
+                sup = arbol.nuevo(a, "sup")
+            arbol.vacia(sup)
+            sup.text = marca_nota(count)
+            prev = a.getprevious()
+            if prev is None:
+                if a.getparent().text is None:
+                    raise Exception(arbol.serializa(a)+" previous_sibling = None")
+                if not a.getparent().text.strip():
+                    a.getparent().text = None
+            elif prev.tail and not prev.tail.strip():
+                prev.tail = None
+            count = count + 1
+    else:
+        for a in ctx.refs:
+            if a.get("href").startswith("#"):
+                a.set("href", xnota + a.get("href"))
+                fixNotas[a.get("id")] = chml
+    M.pasos["lxml"].recorre(root, "post", ctx)
+    # Antes de sacarlas, que fuera del árbol lxml les pone prefijo
+    notas = tuple(minify(arbol.serializa(p)).strip() for p in notas)
+    if footnotes is not None:
+        arbol.saca(footnotes)
+    return Capitulo(
+        html=minify(arbol.serializa(root, documento=True)),
+        notas=notas,
+        refs=count,
+        fix=fixNotas
+    )
+
+
+def media_sin_usar(epub: Epub, opf: Opf) -> List[str]:
+    """
+    Ficheros de media del manifest a los que no enlaza ningún xhtml, css ni
+    el toc.ncx, por ejemplo las imágenes de lo que se ha quitado con
+    --extract. La portada se conserva siempre
+    """
+    usados = set()
+    for name, data in epub.files.items():
+        if name.endswith(".css"):
+            refs = referencias_css(data.decode("utf-8", "ignore"))
+        elif name.endswith((".xhtml", ".ncx")):
+            try:
+                refs = referencias(etree.fromstring(data, arbol.parser))
+            except etree.XMLSyntaxError:
+                # Sin saber qué usa, no se quita nada
+                return []
+        else:
+            continue
+        base = posixpath.dirname(name)
+        for ref in refs:
+            path = ref.partition("#")[0]
+            if path and not re_esquema.match(path):
+                usados.add(posixpath.normpath(posixpath.join(base, unquote(path))))
+    portada = opf.cover_image
+    return [p for p in opf.paths if p.startswith("EPUB/media/") and p not in usados and p != portada]
+
+
+def clave_pandoc() -> str:
+    """
+    Clave de la conversión de pandoc para --incremental: la fuente, los
+    argumentos (con el contenido de los ficheros que se pasan en vez de su
+    ruta, que puede ser temporal) y las imágenes locales y remotas que
+    referencia
+    """
+    with open(M.fuente, "rb") as f:
+        fuente = f.read()
+    partes = [pypandoc.get_pandoc_version()]
+    for a in M.extra_args:
+        if os.path.isfile(a):
+            with open(a, "rb") as f:
+                a = "file:" + Cache.clave(f.read())
+        partes.append(a)
+    recursos = set(a or unescape(b) for a, b in re_recurso.findall(fuente.decode("utf-8", "replace")))
+    for src in sorted(recursos):
+        for ruta in (src, os.path.join(os.path.dirname(M.fuente), src)):
+            if os.path.isfile(ruta):
+                st = os.stat(ruta)
+                partes.append(f"{src}:{st.st_size}:{st.st_mtime_ns}")
+                break
+        if src in M.remotos:
+            with open(M.remotos[src], "rb") as f:
+                partes.append(f"{src}:" + Cache.clave(f.read()))
+    return Cache.clave(fuente, *partes)
+
+
+def firma_capitulos(xnota: str, ids: Dict[str, str], imgdup: Dict[str, str]) -> Tuple[str, ...]:
+    """
+    Todo lo que, además del propio capítulo, afecta a transforma_capitulo
+    (incluidos este script, los módulos de los que tira y los de --pasos)
+    para usarlo en la clave de --incremental
+    """
+    codigo = []
+    for file in (__file__, arbol.__file__, sys.modules[Pasos.__module__].__file__) + M.ficheros_pasos:
+        with open(file, "rb") as f:
+            codigo.append(Cache.clave(f.read()))
+    return (
+        *codigo,
+        os.path.basename(xnota),
+        json.dumps(ids, sort_keys=True),
+        json.dumps(imgdup, sort_keys=True),
+        M.extract or "",
+        M.backend,
+        str(M.isMd),
+        json.dumps(sorted(M.class_copy_index.items()))
+    )
+
+
+def build():
+    """
+    Genera el epub a partir de la fuente según M
+    """
+    met = Metricas("miepub", M.profile)
+    met.info["fuente"] = M.fuente
+    met.info["jobs"] = M.jobs
+    e = met.etapa("descargas")
+    e.items = len(M.remotos)
+    e.bytes_out = sum(os.path.getsize(f) for f in M.remotos.values())
+
+    e = met.etapa("pandoc", bytes_in=os.path.getsize(M.fuente))
+    clave = clave_pandoc() if M.build_cache is not None else None
+    data = M.build_cache.get(clave) if clave else None
+    e.extra["cache"] = data is not None
+    if data is None:
+        print("Convirtiendo con pandoc")
+        print(f"pandoc '{M.fuente_pandoc}'", *map(str, M.extra_args), f" -o '{M.out}'")
+        pypandoc.convert_file(M.fuente_pandoc,
+                              outputfile=M.out,
+                              to="epub",
+                              extra_args=M.extra_args)
+        with open(M.out, "rb") as f:
+            data = f.read()
+        if clave:
+            M.build_cache.put(clave, data)
+    else:
+        print("Reutilizando la conversión de pandoc")
+
+    e.bytes_out = len(data)
+    print("Epub inicial de " + sizeof_fmt(len(data)))
+
+    e = met.etapa("unzip", bytes_in=len(data))
+    epub = Epub.load(io.BytesIO(data))
+    e.items = len(epub.files)
+    e.bytes_out = sum(map(len, epub.files.values()))
+
+    met.etapa("opf y toc")
+    print("Eliminando navegación innecesaria")
+    #os.remove(M.tmp.out + "/EPUB/nav.xhtml")
+    if M.keep_title:
+        tt_soup = bs4.BeautifulSoup(epub.read("EPUB/text/title_page.xhtml"), "xml")
+        n_body = tt_soup.new_tag("body")
+        o_body = tt_soup.find("body")
+        for a in o_body.attrs:
+            n_body[a] = o_body.attrs[a]
+        o_body.name = "div"
+        o_body.attrs.clear()
+        o_body.attrs["class"] = "title_page"
+        o_body.wrap(n_body)
+        epub.write("EPUB/text/title_page.xhtml", str(tt_soup))
+    else:
+        epub.remove("EPUB/text/title_page.xhtml")
+
+    opf = Opf("EPUB/content.opf", epub.read("EPUB/content.opf"))
+    if not M.keep_title:
+        opf.remove("EPUB/text/title_page.xhtml")
+    for source in opf.dc("source"):
+        if not (source.text or "").strip():
+            Opf.quita(source)
     if isinstance(M.dc_date, int):
-        d = re.sub(r"<dc:date>[^<]+</dc:date>", f"<dc:date>{M.dc_date}</dc:date>", d)
-    f.seek(0)
-    f.write(d)
-    f.truncate()
+        for dc_date in opf.dc("date"):
+            if (dc_date.text or "").strip():
+                dc_date.text = str(M.dc_date)
 
-marcas = {}
+    ids = tabla_ids([epub.read(html) for html in epub.glob("EPUB/text/ch*.xhtml")])
 
-with open(M.tmp.out + "/EPUB/toc.ncx", "r+") as f:
-    soup = bs4.BeautifulSoup(f, "xml")
+    soup = bs4.BeautifulSoup(epub.read("EPUB/toc.ncx"), "xml")
     nav = soup.find("navMap")
     nav.find("navPoint").extract()
     for c in nav.select("content"):
-        antes = c.attrs["src"]
-        despues = simplifica(antes)
-        if antes != despues:
-            c.attrs["src"] = despues
-            despues = despues.split("#", 1)[-1]
-            antes = antes.split("#", 1)[-1]
-            marcas[antes] = despues
-    content = re.sub(r' xmlns:="', ' xmlns="', str(soup))
-    f.seek(0)
-    f.write(content)
-    f.truncate()
-
-media = M.tmp.out + "/EPUB/media/"
-imgs = []
-for g in ['*.jpeg', '*.jpg', '*.png']:
-    imgs.extend(glob.glob(media + g))
-imgdup = {}
-i = 0
-while i < len(imgs) - 1:
-    c = imgs[i]
-    dup = [x for x in imgs[i + 1:] if filecmp.cmp(x, c)]
-    c = "media/" + os.path.basename(c)
-    for d in dup:
-        imgs.remove(d)
-        os.remove(d)
-        d = "media/" + os.path.basename(d)
-        imgdup[d] = c
-    i += 1
-
-if imgdup:
-    re_keys = [re.escape(k) for k in imgdup.keys()]
-    re_imgdup = re.compile("href=\"(" + "|".join(re_keys) + ")\"")
-    with open(M.tmp.out + "/EPUB/content.opf", "r+") as f:
-        d = [l for l in f.readlines() if not re_imgdup.search(l)]
-        f.seek(0)
-        f.write("".join(d))
-        f.truncate()
-    print("Eliminadas imágenes duplicadas")
-
-xhtml = sorted(glob.glob(M.tmp.out + "/EPUB/text/ch*.xhtml"))
-notas = []
-xnota = None
-count = 1
-
-if M.notas:
-    for html in xhtml:
-        with open(html, "r+") as f:
-            soup = bs4.BeautifulSoup(f, "xml")
-            if soup.find("h1", text=M.notas):
+        c.attrs["src"] = renombra_href(c.attrs["src"], ids)
+    epub.write("EPUB/toc.ncx", str(soup).replace(' xmlns:="', ' xmlns="'))
+
+    e = met.etapa("duplicados")
+    media = "EPUB/media/"
+    imgs = []
+    for g in ['*.jpeg', '*.jpg', '*.png']:
+        imgs.extend(epub.glob(media + g))
+    # Si la portada está repetida tiene que ser ella la que se conserve
+    # porque text/cover.xhtml no se revisa
+    portada = opf.cover_image
+    if portada:
+        imgs.sort(key=lambda i: i != portada)
+    imgdup = {}
+    dup = imagenes.duplicados({i: epub.read(i) for i in imgs})
+    for d, c in dup.items():
+        epub.remove(d)
+        opf.remove(d)
+        imgdup["media/" + os.path.basename(d)] = "media/" + os.path.basename(c)
+    imgs = [i for i in imgs if i not in dup]
+    e.items = len(imgs) + len(dup)
+    e.extra["duplicados"] = len(dup)
+    if imgdup:
+        print("Eliminadas imágenes duplicadas")
+
+    met.etapa("nav")
+    xhtml = sorted(epub.glob("EPUB/text/ch*.xhtml"))
+    notas = io.StringIO()
+    xnota = None
+    count = 1
+
+    if M.notas:
+        for html in xhtml:
+            if primer_h1(epub.read(html)) == M.notas:
                 xnota = os.path.basename(html)
                 break
 
-if xnota is None:
-    xnota = os.path.basename(xhtml[-1])            
+    if xnota is None:
+        xnota = os.path.basename(xhtml[-1])            
 
 
-if os.path.isfile(M.tmp.out + "/EPUB/nav.xhtml"):
-    with open(M.tmp.out + "/EPUB/nav.xhtml", "r+") as f:
-        soup = bs4.BeautifulSoup(f, "xml")
+    if epub.isfile("EPUB/nav.xhtml"):
+        soup = bs4.BeautifulSoup(epub.read("EPUB/nav.xhtml"), "xml")
         for a in soup.select("a"):
             href: str = a.attrs.get("href")
             if href == "text/title_page.xhtml" and not M.keep_title:
                 a.find_parent("li").extract()
                 continue
-            if a and "#" in href:
-                href, antes = href.rsplit("#", 1)
-                despues = simplifica(antes)
-                if despues and antes != despues:
-                    a.attrs["href"] = href + "#" + despues
-
-        minified = minify_soup(soup)
-        minified = re.sub(r' xmlns:="', ' xmlns="', minified)
-        f.seek(0)
-        f.write(minified)
-        f.truncate()
-
-fixNotas = {}
-for html in xhtml:
-    chml = os.path.basename(html)
-    with open(html, "r+") as f:
-        soup = bs4.BeautifulSoup(f, "xml")
-        if M.extract:
-            for n in soup.select(M.extract):
-                n.extract()
-        for c in soup.select("div"):
-            if "id" in c.attrs and c.attrs["id"] in marcas:
-                c.attrs["id"] = marcas[c.attrs["id"]]
-        for ids in soup.select("*[id]"):
-            antes = ids.attrs["id"]
-            despues = simplifica(antes)
-            if despues and antes != despues:
-                ids.attrs["id"] = despues
-        for p in soup.select("table p") + soup.select("figure p"):
-            p.unwrap()
-        for legend in soup.select("fieldset > p > legend"):
-            legend.parent.unwrap()
-        for i in soup.select("img"):
-            if "src" in i.attrs and i.attrs["src"] in imgdup:
-                i.attrs["src"] = imgdup[i.attrs["src"]]
-        if chml == xnota:
-            div = soup.select_one("section")
-            for n in notas:
-                div.append(n)
-            for _id, xml in fixNotas.items():
-                a = div.find("a", attrs={"href": "#"+_id})
-                if a:
-                    a.attrs["href"] = xml + a.attrs["href"]
-        else:
-            footnotes = soup.select_one("section.footnotes")
-            if footnotes:
-                bak_count = count
-                for p in footnotes.select("p"):
-                    a = p.select_one("a.footnote-back")
-                    if a['href'].startswith("#"):
-                        a['href'] = chml + a['href']
-                    p['id'] = "fn" + str(count)
-                    a['class'] = "volver"
-                    a.string = "<<"
-                    p.append(a)
-                    a.insert_before(" ")
-                    first_text = p.find(text=True)
-                    first_text.replace_with(re.sub(r"^[\s\.]+", "", first_text.string))
-                    sup = soup.new_tag("sup")
-                    sup.string = M.parse_note("[" + str(count) + "]")
-                    p.insert(0, sup)
-                    p.insert(1, " ")
-                    notas.append(p)
-                    count = count + 1
-                footnotes.extract()
-                count = bak_count
-                for a in soup.select("a.footnote-ref"):
-                    a['href'] = xnota + "#fn" + str(count)
-                    sup = a.find("sup")
-                    if not sup:
-                        sup = soup.new_tag("sup")
-                        a.string = ""
-                        a.append(sup)
-                    sup.string = M.parse_note("[" + str(count) + "]")
-                    if a.previous_sibling is None:
-                        raise Exception(str(a)+" previous_sibling = None")
-                    if len(a.previous_sibling.string) > 0 and len(a.previous_sibling.strip()) == 0:
-                        a.previous_sibling.extract()
-                    count = count + 1
+            if href:
+                a.attrs["href"] = renombra_href(href, ids)
+        epub.write("EPUB/nav.xhtml", minify_soup(soup))
+
+    print("Transformando capítulos")
+    xnota = os.path.dirname(xhtml[0]) + "/" + xnota
+    capitulos = [html for html in xhtml if html != xnota]
+    e = met.etapa("capítulos", bytes_in=sum(len(epub.read(html)) for html in capitulos), items=len(capitulos))
+    hechos: Dict[str, Capitulo] = {}
+    if M.build_cache is not None:
+        firma = firma_capitulos(xnota, ids, imgdup)
+        claves = {html: Cache.clave(epub.read(html), html, *firma) for html in capitulos}
+        for html, clave in claves.items():
+            data = M.build_cache.get(clave)
+            if data is not None:
+                cap = json.loads(data)
+                hechos[html] = Capitulo(cap["html"], tuple(cap["notas"]), cap["refs"], cap["fix"])
+        if hechos:
+            print(f"Reutilizando {len(hechos)} de {len(capitulos)} capítulos")
+    pendientes = [html for html in capitulos if html not in hechos]
+    transforma = transforma_capitulo_lxml if M.backend == "lxml" else transforma_capitulo
+    e.extra["backend"] = M.backend
+    if M.jobs > 1 and len(pendientes) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        # Los procesos hijos heredan M (y el índice de --copy-class)
+        M.class_copy_index
+        with ProcessPoolExecutor(max_workers=M.jobs, mp_context=multiprocessing.get_context("fork")) as pool:
+            hechos.update(zip(pendientes, pool.map(
+                transforma,
+                pendientes,
+                [epub.read(html) for html in pendientes],
+                repeat(xnota),
+                repeat(ids),
+                repeat(imgdup)
+            )))
+    else:
+        hechos.update((html, transforma(html, epub.read(html), xnota, ids, imgdup)) for html in pendientes)
+    if M.build_cache is not None:
+        for html in pendientes:
+            M.build_cache.put(claves[html], json.dumps(hechos[html]._asdict()).encode("utf-8"))
+        M.build_cache.podar()
+    capitulos = hechos
+    e.extra["cache"] = len(capitulos) - len(pendientes)
+    e.bytes_out = sum(len(cap.html.encode("utf-8")) for cap in capitulos.values())
+
+    e = met.etapa("notas", items=len(xhtml))
+    fixNotas = {}
+    for html in xhtml:
+        if html == xnota:
+            epub.write(html, capitulo_notas(epub.read(html), notas.getvalue(), fixNotas, ids, imgdup))
+            continue
+        cap = capitulos[html]
+        epub.write(html, numera_notas(cap.html, count))
+        for n in cap.notas:
+            notas.write("\n")
+            notas.write(numera_notas(n, count))
+        fixNotas.update(cap.fix)
+        count = count + cap.refs
+    e.extra["notas"] = count - 1
+
+    e = met.etapa("opf")
+    sin_usar = media_sin_usar(epub, opf)
+    for m in sin_usar:
+        epub.remove(m)
+        opf.remove(m)
+    if sin_usar:
+        print(f"Eliminados {len(sin_usar)} ficheros de media sin usar")
+        imgs = [i for i in imgs if i not in sin_usar]
+    e.extra["sin_usar"] = len(sin_usar)
+    epub.write(opf.path, opf.to_bytes())
+
+    if len(M.mogrify)>1 and len(imgs) > 0:
+        print("Limpiando imagenes")
+        imgs = sorted(imgs)
+        if M.img_engine == "external":
+            antes = sum(len(epub.read(i)) for i in imgs)
+            e = met.etapa("exif", bytes_in=antes, items=len(imgs))
+            for i in imgs:
+                with open(M.tmp.wks + "/" + os.path.basename(i), "wb") as f:
+                    f.write(epub.read(i))
+            call(["exiftool", "-r", "-overwrite_original", "-q", "-all=", M.tmp.wks])
+            for i in imgs:
+                with open(M.tmp.wks + "/" + os.path.basename(i), "rb") as f:
+                    epub.write(i, f.read())
+                os.remove(M.tmp.wks + "/" + os.path.basename(i))
+            despu = sum(len(epub.read(i)) for i in imgs)
+            e.bytes_out = despu
+            print("Ahorrado borrando exif: " + sizeof_fmt(antes - despu))
+        antes = sum(len(epub.read(i)) for i in imgs)
+        e = met.etapa("imágenes", bytes_in=antes, items=len(imgs))
+        with ThreadPoolExecutor(max_workers=M.jobs) as pool:
+            for i, data in zip(imgs, pool.map(optimizar, imgs, [epub.read(i) for i in imgs])):
+                epub.write(i, data)
+        if M.img_cache is not None:
+            M.img_cache.podar()
+        e.bytes_out = sum(len(epub.read(i)) for i in imgs)
+        despu = antes - e.bytes_out
+        if despu > 0:
+            print("Ahorrado optimizando: " + sizeof_fmt(despu))
+
+    if M.execute:
+        met.etapa("execute")
+        # Con --watch se reutiliza entre compilaciones: no puede quedar nada
+        # de la anterior o load_dir lo volvería a meter en el epub
+        shutil.rmtree(M.tmp.out, ignore_errors=True)
+        os.makedirs(M.tmp.out)
+        epub.save_dir(M.tmp.out)
+        call([M.execute, M.tmp.out, M.fuente])
+        epub = Epub.load_dir(M.tmp.out)
+
+    e = met.etapa("validar", bytes_in=sum(map(len, epub.files.values())), items=len(epub.files))
+    errores = valida(epub.files)
+    e.extra["errores"] = len(errores)
+    if errores:
+        print(f"El epub tiene {len(errores)} errores:")
+        for err in errores[:MAX_ERRORES]:
+            print("  " + err)
+        if len(errores) > MAX_ERRORES:
+            print(f"  ... y {len(errores) - MAX_ERRORES} más")
+
+    e = met.etapa("zip", bytes_in=sum(map(len, epub.files.values())), items=len(epub.files))
+    epub.save(M.out, nivel=M.zip_level, jobs=M.jobs)
+    e.bytes_out = os.path.getsize(M.out)
+
+    if M.ebook_meta:
+        met.etapa("ebook-meta")
+        check_output(["ebook-meta"] + list(M.ebook_meta) + [M.out])
+
+    print("Epub final de " + sizeof_fmt(os.path.getsize(M.out)))
+
+    if M.epubcheck == "yes":
+        met.etapa("epubcheck", bytes_in=os.path.getsize(M.out))
+        call(["epubcheck", M.out])
+    elif M.epubcheck == "background":
+        epubcheck_fondo(M.out)
+
+    met.fin(M.out + ".prof" if M.profile == "cprofile" else None)
+    met.info["epub"] = os.path.getsize(M.out)
+    if M.profile or M.metrics_json:
+        met.imprimir()
+    if M.metrics_json:
+        met.guardar(M.metrics_json)
+
+
+def epubcheck_fondo(out: str):
+    """
+    Lanza epubcheck sin esperar a que termine. Si aún sigue el de una
+    compilación anterior (con --watch) se mata, porque está leyendo un
+    epub que ya se ha sobrescrito
+    """
+    global EPUBCHECK
+    if EPUBCHECK is not None and EPUBCHECK.poll() is None:
+        EPUBCHECK.kill()
+        EPUBCHECK.wait()
+    print("Lanzando epubcheck en segundo plano")
+    EPUBCHECK = Popen(["epubcheck", out])
+
+
+def _firma(files: Tuple[str, ...]) -> Tuple[Tuple[int, int], ...]:
+    firma = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            firma.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            firma.append((0, 0))
+    return tuple(firma)
+
+
+def vigilar(intervalo: float = 0.3):
+    """
+    Compila y vuelve a compilar cada vez que cambia alguno de los ficheros
+    de M.get_watch_files(). Solo se vuelven a leer los metadatos si cambia
+    la fuente o el avatar, el resto de cambios los recoge pandoc y la
+    caché de --incremental hace que solo se repita lo que ha cambiado.
+    """
+    global M
+    files = M.get_watch_files()
+    firma = _firma(files)
+    while True:
+        ini = time.perf_counter()
+        try:
+            build()
+            print(f"Compilado en {time.perf_counter() - ini:.2f}s")
+        except Exception:
+            traceback.print_exc()
+        except SystemExit as e:
+            print(e)
+        print("Esperando cambios en:", *files, sep="\n  ")
+        try:
+            while True:
+                time.sleep(intervalo)
+                nueva = _firma(files)
+                if nueva == firma:
+                    continue
+                # Esperar a que el editor termine de escribir
+                time.sleep(intervalo)
+                if _firma(files) == nueva:
+                    break
+        except KeyboardInterrupt:
+            return
+        cambios = [f for f, a, b in zip(files, firma, nueva) if a != b]
+        print("Cambios en:", *cambios)
+        if set(cambios).intersection(os.path.realpath(f) for f in (M.fuente, M.cover_avatar) if f):
+            viejo = M
+            try:
+                M = M.recargar()
+            except SystemExit as e:
+                print(e)
             else:
-                for a in soup.select("a.footnote-ref"):
-                    if a['href'].startswith("#"):
-                        a['href'] = xnota + a['href']
-                        fixNotas[a['id']] = chml
-
-        for c in M.get_class_copy_nodes():
-            fnd = soup.find(lambda t: t.name == c.name and re_sp.sub(
-                " ", t.get_text()).strip() == re_sp.sub(" ", c.get_text()).strip())
-            if fnd and "class" not in fnd.attrs:
-                fnd.attrs["class"] = c.attrs["class"]
-
-        for img in soup.findAll("img"):
-            if "alt" not in img.attrs:
-                img.attrs["alt"] = ""
-
-        for n in soup.select("article"):
-            n.name = "div"
-
-        if M.isMd:
-            for tr in soup.select("tr"):
-                if "class" in tr:
-                    del tr.attrs["class"]
-                colspan = 0
-                td: bs4.Tag
-                for td in tr.findAll(["td", "th"]):
-                    if get_text(td) == ">":
-                        colspan = colspan + 1
-                        td.extract()
-                    elif colspan > 0:
-                        td.attrs["colspan"] = str(colspan+1)
-                        td.attrs["style"] = "text-align: center;"
-                        colspan = 0
-            for td in soup.findAll(["td", "th"]):
-                b = td.select_one("strong")
-                if b and get_text(b) == get_text(td):
-                    b.unwrap()
-                    td.name = "th"
-            for tbody in soup.select("tbody"):
-                trs = list(tbody.select("tr"))
-                last_tr_th = None
-                first_tr_td = None
-                tr_to_th = []
-                for i, tr in enumerate(trs):
-                    if any(map(get_text, tr.select("td"))):
-                        if first_tr_td is None:
-                            first_tr_td = i
-                        continue
-                    last_tr_th = i
-                    for td in tr.select("td"):
-                        td.name = "th"
-                    tr_to_th.append(tr)
-                if None not in (first_tr_td, last_tr_th) and last_tr_th < first_tr_td:
-                    table = tbody.find_parent("table")
-                    for tr in tr_to_th:
-                        thead = table.select_one("thead")
-                        if thead is None:
-                            thead = soup.new_tag('thead')
-                            table.insert(0, thead)
-                        thead.append(tr)
-            for tbody in soup.select("thead, tbody"):
-                for i, tr in enumerate(tbody.select("tr")):
-                    tr.attrs["class"] = "odd" if (i % 2) == 0 else "even"
-            for c in soup.select("cite"):
-                p = c.parent
-                q = p.parent
-                if q.name == "blockquote" and p.name == "p" and re_sp.sub(" ", p.get_text()).strip() == re_sp.sub(" ", c.get_text()).strip():
-                    p.attrs["class"] = "cite"
-                    q.attrs["class"] = "cite"
-
-        for img in soup.select("a > img"):
-            a = img.find_parent("a")
-            if get_text(a) is not None:
-                continue
-            chls = a.select(":scope *")
-            if len(chls) == 1 and chls[0] == img:
-                add_class(a, "pandoc_a_img")
-
-        # Kobo no lo respeta ni así
-        # for pre_code in soup.select("pre"):
-        #     if pre_code.select(":scope > *") and len(pre_code.select("*")) == 1:
-        #         pre_code.attrs['style'] = "white-space: pre !important; font-family: monospace !important; text-align: left !important;"
-
-        minified = minify_soup(soup)
-        minified = re.sub(r' xmlns:="', ' xmlns="', minified)
-        f.seek(0)
-        f.write(minified)
-        f.truncate()
-
-if len(M.mogrify)>1 and len(imgs) > 0:
-    print("Limpiando imagenes")
-    antes = sum(map(os.path.getsize, imgs))
-    call(["exiftool", "-r", "-overwrite_original", "-q", "-all=", media])
-    despu = sum(map(os.path.getsize, imgs))
-    print("Ahorrado borrando exif: " + sizeof_fmt(antes - despu))
-    imgs = sorted(imgs)
-    for img in imgs:
-        optimizar(img)
-    despu = despu - sum([os.path.getsize(s) for s in imgs])
-    if despu > 0:
-        print("Ahorrado optimizando: " + sizeof_fmt(despu))
-
-if M.execute:
-    call([M.execute, M.tmp.out, M.fuente])
-
-with zipfile.ZipFile(M.out, "w") as zip_file:
-    zip_file.write(M.tmp.out + '/mimetype', 'mimetype',
-                   compress_type=zipfile.ZIP_STORED)
-    z = len(M.tmp.out) + 1
-    for root, dirs, files in os.walk(M.tmp.out):
-        for f in files:
-            path = os.path.join(root, f)
-            name = path[z:]
-            if name != 'mimetype':
-                zip_file.write(path, name, compress_type=zipfile.ZIP_DEFLATED)
-
-if M.ebook_meta:
-    check_output(["ebook-meta"] + list(M.ebook_meta) + [M.out])
-
-print("Epub final de " + sizeof_fmt(os.path.getsize(M.out)))
-
-call(["epubcheck", M.out])
+                viejo.borrar_tmp()
+                files = M.get_watch_files()
+        else:
+            if M.file_css and os.path.realpath(M.file_css) in cambios:
+                # El índice de --copy-class depende de las clases del css, y
+                # los tags que visita el paso copia_class, del índice
+                M.__dict__.pop("class_copy_index", None)
+                M.__dict__.pop("pasos", None)
+            if set(cambios).intersection(os.path.realpath(f) for f in M.ficheros_pasos):
+                # Para volver a registrar los pasos con el nuevo registra()
+                M.__dict__.pop("pasos", None)
+        firma = _firma(files)
+
+
+class Resultado(NamedTuple):
+    fuente: str
+    out: Union[str, None]
+    segundos: float
+    size: int
+    error: Union[str, None]
+    log: str
+
+
+def construye(argv: List[str]) -> Resultado:
+    """
+    Genera un libro con los argumentos argv (los mismos que en la línea
+    de comandos) sin salir nunca: los errores se devuelven en el resultado.
+    Pensado para llamarse varias veces desde el mismo proceso (ver
+    miepub_lote.py), por eso borra el directorio de trabajo al terminar.
+    """
+    global M
+    ini = time.perf_counter()
+    log = io.StringIO()
+    error = None
+    fuente = " ".join(argv)
+    M = None
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            args = parser.parse_args(argv)
+            fuente = os.path.realpath(args.fuente)
+            M = MetaData(args)
+            build()
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                error = e.code
+            elif e.code:
+                # argparse ya ha escrito el motivo en el log
+                error = (log.getvalue().strip().splitlines() or [str(e.code)])[-1]
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+    out = M.out if M is not None else None
+    if M is not None:
+        M.borrar_tmp()
+    size = os.path.getsize(out) if error is None and out and os.path.isfile(out) else 0
+    return Resultado(fuente, out, time.perf_counter() - ini, size, error, log.getvalue())
+
+
+def main(argv: Union[List[str], None] = None):
+    global M
+    M = MetaData(parser.parse_args(argv))
+    if M.watch:
+        vigilar()
+    else:
+        build()
+
+
+if __name__ == "__main__":
+    main()
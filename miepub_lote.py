@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Tuple
+
+from miepub import Resultado, construye, sizeof_fmt
+
+
+def leer_manifest(path: str) -> List[Tuple[str, List[str]]]:
+    """
+    Una línea por libro con los argumentos de miepub.py tal y como se
+    escribirían en la shell. Las líneas vacías y las que empiezan por #
+    se ignoran. Las rutas relativas son relativas al manifest.
+    """
+    libros = []
+    root = os.path.dirname(os.path.realpath(path))
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            libros.append((root, shlex.split(line)))
+    return libros
+
+
+def _construye(cwd: str, argv: List[str]) -> Resultado:
+    os.chdir(cwd)
+    return construye(argv)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Genera varios epub con miepub.py en paralelo')
+    parser.add_argument("--manifest", action="append", default=[],
+                        help="Fichero con un libro por línea (los argumentos de miepub.py para ese libro)")
+    parser.add_argument("--args", default="",
+                        help="Argumentos de miepub.py comunes a todos los libros, entre comillas")
+    parser.add_argument("--libros", type=int, default=os.cpu_count(),
+                        help="Número de libros a generar a la vez (por defecto, el número de núcleos)")
+    parser.add_argument("--verbose", action="store_true", default=False,
+                        help="Muestra la salida de cada libro y no solo la de los que fallan")
+    parser.add_argument("fuente", nargs="*", help="Ficheros de entrada")
+    arg = parser.parse_args()
+
+    comunes = shlex.split(arg.args)
+    if "--watch" in comunes:
+        sys.exit("--watch no tiene sentido con varios libros")
+    libros = [(os.getcwd(), [f]) for f in arg.fuente]
+    for m in arg.manifest:
+        libros.extend(leer_manifest(m))
+    if not libros:
+        sys.exit("No hay libros que generar")
+
+    # Se reparten los núcleos entre los libros que van a la vez, salvo que
+    # se indique --jobs en --args o en el manifest
+    workers = max(1, min(arg.libros, len(libros)))
+    comunes = ["--jobs", str(max(1, (os.cpu_count() or 1) // workers))] + comunes
+
+    ini = time.perf_counter()
+    resultados: List[Resultado] = []
+    # Los procesos se reutilizan de un libro a otro (imports, fuentes
+    # cargadas, etc) y comparten las cachés de imágenes y de --incremental,
+    # que son seguras entre procesos
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuros = {pool.submit(_construye, cwd, comunes + argv): argv for cwd, argv in libros}
+        for f in as_completed(futuros):
+            try:
+                r = f.result()
+            except Exception as e:
+                # El proceso ha muerto (memoria, señal...)
+                r = Resultado(futuros[f][-1], None, 0, 0, f"{type(e).__name__}: {e}", "")
+            resultados.append(r)
+            print(("OK   " if r.error is None else "FAIL ") + r.fuente, flush=True)
+            if r.error is not None or arg.verbose:
+                print(r.log)
+
+    print()
+    print(f"{'Libro':<50} {'tiempo':>8} {'tamaño':>10}  resultado")
+    for r in sorted(resultados, key=lambda r: r.fuente):
+        print(f"{os.path.relpath(r.fuente):<50} {r.segundos:>7.1f}s {sizeof_fmt(r.size) if r.size else '-':>10}  {r.error or 'OK'}")
+    fallos = sum(1 for r in resultados if r.error is not None)
+    print(f"{len(resultados) - fallos} de {len(resultados)} libros en {time.perf_counter() - ini:.1f}s")
+    if fallos:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
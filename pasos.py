@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+import bs4
+from lxml import etree
+
+# pre: antes de numerar las notas, post: después
+FASES = ("pre", "post")
+
+Visita = Callable[[Any, "Contexto"], None]
+
+
+class Paso(NamedTuple):
+    nombre: str
+    fase: str
+    # Tags a los que se aplica (None para todos)
+    tags: Union[Tuple[str, ...], None]
+    entrar: Union[Visita, None]
+    salir: Union[Visita, None]
+    # Pasos que tienen que haberse aplicado antes al mismo tag
+    despues: Tuple[str, ...]
+
+
+class Contexto:
+    """
+    Lo que comparten los pasos mientras se recorre un capítulo
+    """
+
+    def __init__(self, raiz, html: str, ids: Dict[str, str], imgdup: Dict[str, str]):
+        self.raiz = raiz
+        self.html = html
+        self.ids = ids
+        self.imgdup = imgdup
+        # Lo que encuentra la fase pre para las notas
+        self.footnotes = None
+        self.refs: List[Any] = []
+        # Para el estado de cada paso, por su nombre
+        self.datos: Dict[str, Any] = {}
+
+
+class Pasos:
+    """
+    Transformaciones de un capítulo registradas como visitas a los tags con
+    un nombre, que se aplican en un solo recorrido del árbol por fase en
+    vez de hacer un select() por cada una.
+
+    En cada tag se llama primero a los entrar de los pasos que lo visitan,
+    luego se recorren sus hijos (leídos después de los entrar, así que un
+    paso puede cambiar o quitar los hijos del tag que visita) y por último
+    a los salir. Es decir, al entrar en un tag ya se ha entrado en todos
+    sus antecesores y al salir ya se ha salido de todos sus descendientes.
+    Si un paso desenvuelve el tag se recorre su contenido en su lugar, y si
+    lo saca del árbol no se sigue con él.
+
+    En el mismo tag los pasos se aplican en el orden en el que se
+    registran, salvo que declaren con despues que otros (de su fase o de la
+    anterior) tienen que ir antes.
+    """
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.pasos: Dict[str, Paso] = {}
+        self._tablas: Dict[str, Tuple[dict, dict, tuple, tuple]] = {}
+
+    def registra(self, nombre: str, fase: str = "post", tags=None, entrar: Visita = None, salir: Visita = None, despues=()):
+        """
+        Registra (o sustituye si ya hay uno con ese nombre) un paso
+        """
+        if fase not in FASES:
+            raise ValueError(f"El paso {nombre} tiene una fase desconocida: {fase}")
+        if isinstance(tags, str) or isinstance(despues, str):
+            raise ValueError(f"El paso {nombre} necesita una tupla en tags y en despues")
+        self.pasos[nombre] = Paso(nombre, fase, None if tags is None else tuple(tags), entrar, salir, tuple(despues))
+        self._tablas.clear()
+
+    def paso(self, nombre: str, fase: str = "post", tags=None, despues=()):
+        """
+        Decorador que registra la función como el entrar de un paso
+        """
+        def registra(f: Visita) -> Visita:
+            self.registra(nombre, fase, tags, entrar=f, despues=despues)
+            return f
+        return registra
+
+    def orden(self, fase: str) -> List[Paso]:
+        """
+        Pasos de la fase ordenados según despues y, si no, según se
+        registraron
+        """
+        pasos = [p for p in self.pasos.values() if p.fase == fase]
+        for p in pasos:
+            for d in p.despues:
+                if d not in self.pasos:
+                    raise ValueError(f"El paso {p.nombre} va después de {d}, que no existe")
+                if FASES.index(self.pasos[d].fase) > FASES.index(fase):
+                    raise ValueError(f"El paso {p.nombre} ({fase}) no puede ir después de {d} ({self.pasos[d].fase})")
+        orden = []
+        hechos = set()
+        while len(orden) < len(pasos):
+            listo = next((p for p in pasos if p.nombre not in hechos and all(
+                d in hechos or self.pasos[d].fase != fase for d in p.despues)), None)
+            if listo is None:
+                raise ValueError("Dependencias circulares entre los pasos " + ", ".join(p.nombre for p in pasos if p.nombre not in hechos))
+            orden.append(listo)
+            hechos.add(listo.nombre)
+        return orden
+
+    def _tabla(self, fase: str) -> Tuple[dict, dict, tuple, tuple]:
+        """
+        {tag: visitas} para entrar y salir, y las visitas de los pasos que
+        se aplican a todos los tags
+        """
+        tabla = self._tablas.get(fase)
+        if tabla is not None:
+            return tabla
+        orden = self.orden(fase)
+        nombres = {t for p in orden if p.tags for t in p.tags}
+
+        def visitas(name: Union[str, None], attr: str) -> tuple:
+            return tuple(getattr(p, attr) for p in orden if getattr(p, attr) is not None and (p.tags is None or name in p.tags))
+
+        tabla = (
+            {t: visitas(t, "entrar") for t in nombres},
+            {t: visitas(t, "salir") for t in nombres},
+            visitas(None, "entrar"),
+            visitas(None, "salir")
+        )
+        self._tablas[fase] = tabla
+        return tabla
+
+    def recorre(self, raiz, fase: str, ctx: Contexto):
+        """
+        Aplica los pasos de la fase en un solo recorrido del árbol
+        """
+        if self.backend == "lxml":
+            self._recorre_lxml(raiz, self._tabla(fase), ctx)
+        else:
+            self._recorre_bs4(raiz, self._tabla(fase), ctx)
+
+    # Los dos recorridos son el mismo; se repiten para no pagar una llamada
+    # por tag solo para saber su nombre, su padre o sus hijos. Si un paso
+    # saca o desenvuelve el tag, se sigue por lo que haya quedado en su lugar
+    # (entre sus hermanos de antes y de después), así que no hace falta
+    # guardar la lista de sus hijos antes de cada visita
+
+    @staticmethod
+    def _recorre_bs4(raiz: bs4.Tag, tabla: Tuple[dict, dict, tuple, tuple], ctx: Contexto):
+        entrar, salir, todos_entrar, todos_salir = tabla
+        Tag = bs4.Tag
+        pila = [raiz]
+        while pila:
+            n = pila.pop()
+            if n.__class__ is tuple:
+                n, visitas = n
+                if n.parent is not None or n is raiz:
+                    for f in visitas:
+                        f(n, ctx)
+                continue
+            if n.parent is None and n is not raiz:
+                # Lo ha sacado otro paso
+                continue
+            name = n.name
+            visitas = entrar.get(name, todos_entrar)
+            if visitas:
+                padre, antes, despues = n.parent, n.previous_sibling, n.next_sibling
+                for f in visitas:
+                    f(n, ctx)
+                    if padre is not None and n.parent is None:
+                        break
+                else:
+                    padre = None
+                if padre is not None:
+                    h = antes.next_sibling if antes is not None else next(iter(padre.contents), None)
+                    nuevos = []
+                    while h is not None and h is not despues:
+                        if isinstance(h, Tag):
+                            nuevos.append(h)
+                        h = h.next_sibling
+                    pila.extend(reversed(nuevos))
+                    continue
+            visitas = salir.get(name, todos_salir)
+            if visitas:
+                pila.append((n, visitas))
+            if n.contents:
+                pila.extend(h for h in reversed(n.contents) if isinstance(h, Tag))
+
+    @staticmethod
+    def _recorre_lxml(raiz: etree._Element, tabla: Tuple[dict, dict, tuple, tuple], ctx: Contexto):
+        entrar, salir, todos_entrar, todos_salir = tabla
+        # {tag de lxml: nombre sin espacio de nombres}
+        nombres: Dict[str, str] = {}
+        pila = [raiz]
+        while pila:
+            n = pila.pop()
+            if n.__class__ is tuple:
+                n, visitas = n
+                if n.getparent() is not None or n is raiz:
+                    for f in visitas:
+                        f(n, ctx)
+                continue
+            tag = n.tag
+            name = nombres.get(tag)
+            if name is None:
+                if not isinstance(tag, str):
+                    # Comentarios e instrucciones de procesamiento
+                    continue
+                name = nombres[tag] = tag[tag.find("}") + 1:]
+            if n.getparent() is None and n is not raiz:
+                continue
+            visitas = entrar.get(name, todos_entrar)
+            if visitas:
+                padre, antes, despues = n.getparent(), n.getprevious(), n.getnext()
+                for f in visitas:
+                    f(n, ctx)
+                    if padre is not None and n.getparent() is None:
+                        break
+                else:
+                    padre = None
+                if padre is not None:
+                    h = antes.getnext() if antes is not None else next(iter(padre), None)
+                    nuevos = []
+                    while h is not None and h is not despues:
+                        nuevos.append(h)
+                        h = h.getnext()
+                    pila.extend(reversed(nuevos))
+                    continue
+            visitas = salir.get(name, todos_salir)
+            if visitas:
+                pila.append((n, visitas))
+            if len(n):
+                pila.extend(reversed(n))
@@ -0,0 +1,53 @@
+import os
+import sys
+import types
+
+import pytest
+
+# Los módulos de miepub son scripts sueltos en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+XHTML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="es" lang="es">
+<head>
+  <meta charset="utf-8" />
+  <title>t</title>
+  <link rel="stylesheet" type="text/css" href="../styles/stylesheet1.css" />
+</head>
+<body epub:type="bodymatter">
+<section id="%s" class="level1">
+%s
+</section>
+</body>
+</html>
+'''
+
+
+@pytest.fixture
+def xhtml():
+    """
+    Capítulo como los que genera pandoc con ese cuerpo en su sección
+    """
+    def xhtml(cuerpo: str, id: str = "cap") -> bytes:
+        return (XHTML % (id, cuerpo)).encode("utf-8")
+    return xhtml
+
+
+@pytest.fixture
+def m(monkeypatch):
+    """
+    El miepub.M mínimo para transformar capítulos sin fuente ni pandoc
+    """
+    import miepub
+    from pasos import Pasos
+    m = types.SimpleNamespace(
+        isMd=True, extract=None, extract_selector=None, backend="bs4",
+        class_copy_index={}, notes_format={}, ficheros_pasos=()
+    )
+    m.parse_note = lambda n: miepub.MetaData.parse_note(m, n)
+    monkeypatch.setattr(miepub, "M", m)
+    m.pasos = {"bs4": Pasos("bs4"), "lxml": Pasos("lxml")}
+    miepub.pasos_bs4(m.pasos["bs4"])
+    miepub.pasos_lxml(m.pasos["lxml"])
+    return m
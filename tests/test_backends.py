@@ -0,0 +1,154 @@
+"""
+--backend bs4 y --backend lxml tienen que dar exactamente el mismo capítulo
+"""
+import types
+
+import pytest
+
+import miepub
+from pasos import Pasos
+
+H = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="es" lang="es">
+<head>
+  <meta charset="utf-8" />
+  <title>t</title>
+  <link rel="stylesheet" type="text/css" href="../styles/stylesheet1.css" />
+</head>
+<body epub:type="bodymatter">
+<section id="año" class="level1">
+<h1>Título <em>x</em></h1>
+%s
+</section>
+</body>
+</html>
+'''
+CASOS = {
+"tablas": '''<table>
+<thead><tr class="header"><th>a</th><th>b</th><th>c</th></tr></thead>
+<tbody>
+<tr class="odd"><td><strong>x</strong></td><td>&gt;</td><td>y</td></tr>
+<tr class="even"><td>  <strong> z </strong> </td><td> <p>p en tabla</p> </td><td>&gt;</td></tr>
+</tbody></table>
+<table><tbody>
+<tr><td></td><td><strong></strong></td></tr>
+<tr><td> </td><td></td></tr>
+<tr><td>dato</td><td>2</td></tr>
+</tbody></table>
+<table>
+<tbody>
+<tr><td>h1</td></tr>
+<tr><td>d</td></tr>
+</tbody></table>''',
+"tablas2": '''<table>
+<tbody>
+<tr><td><strong>H</strong></td><td><strong>I</strong></td></tr>
+<tr><td><strong>J</strong></td><td>  </td></tr>
+<tr><td>d</td><td>e</td></tr>
+</tbody></table>''',
+"cite": '''<blockquote>
+<p><cite>Alguien</cite></p>
+</blockquote>
+<blockquote><p> <cite>A  b</cite> </p><p>x<cite>z</cite></p></blockquote>
+<p>copia me</p><p>copia   me</p><h2>T</h2>''',
+"img": '''<p><a href="#año"><img src="../media/a.png" /></a> <a href="http://x"> <img src="b.png" alt="z"/> </a><a><img src="c.png"/><span/></a><a class="k"><img src="d.png"/></a></p>
+<figure><img src="../media/a.png" /><figcaption><p>cap <em>e</em></p></figcaption></figure>
+<fieldset><p><legend>L</legend> resto</p><p>no</p></fieldset>
+<article id="art">x<!-- comentario --> y<?pi algo?></article>
+<p title='con "comillas"' data-x="a'b" data-y="a'&quot;b" data-z="&lt;&amp;&gt;">a &amp; b &lt; c</p>
+<pre>  
+  codigo   
+</pre>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="10"><image xlink:href="../media/a.png"/></svg>''',
+"notas": '''<p>Texto<a href="#fn1" class="footnote-ref" id="fnref1" role="doc-noteref"><sup>1</sup></a> y <a href="#fn2" class="footnote-ref" id="fnref2"><sup>2</sup></a> más <span>s</span> <a href="#fn3" class="footnote-ref" id="fnref3">3</a>.</p>
+<table><tr><td><p>v <a href="#fn4" class="footnote-ref" id="fnref4"><sup>4</sup></a></p></td></tr></table>
+<section id="footnotes" class="footnotes footnotes-end-of-document" role="doc-endnotes">
+<hr />
+<ol>
+<li id="fn1"><p>. Nota uno<a href="#fnref1" class="footnote-back" role="doc-backlink">↩︎</a></p></li>
+<li id="fn2"><p><em>.  Nota</em> dos <a href="#fnref2" class="footnote-back" role="doc-backlink">↩︎</a> cola</p></li>
+<li id="fn3"><p><img src="x.png"/><a href="#fnref3" class="footnote-back" role="doc-backlink">↩︎</a></p></li>
+<li id="fn4"><p>.<a href="#fnref4" class="footnote-back" role="doc-backlink">↩︎</a></p></li>
+</ol>
+</section>''',
+"anidadas": '''<table><tbody>
+<tr><td><strong>A</strong></td><td>&gt;</td><td>B</td></tr>
+<tr><td><table><tbody><tr><td> </td><td>&gt;</td><td>h</td></tr><tr><td>x</td><td>y</td><td>z</td></tr></tbody></table></td><td>q</td></tr>
+<tr><td>celda</td><td>r</td></tr>
+</tbody></table>
+<article><p>celda</p><table><tbody><tr><td>celda</td></tr></tbody></table></article>
+<fieldset><p><legend>L</legend> m</p></fieldset>''',
+"tablas3": '''<table>
+<caption>Cap</caption>
+<colgroup><col/><col/><col/></colgroup>
+<tbody>
+<tr><td><strong>A</strong></td><td>&gt;</td><td>&gt;</td></tr>
+<tr><td><strong>B</strong> b</td><td></td><td><strong>C</strong></td></tr>
+<tr><td>1</td><td>&gt;</td><td>2</td></tr>
+<tr><td>&gt;</td><td>&gt;</td><td>3</td></tr>
+<tr><td><strong>D</strong></td><td><strong>E</strong></td><td> </td></tr>
+<tr><td>4</td><td>5</td><td>6</td></tr>
+</tbody>
+<tbody>
+<tr><td><strong>F</strong></td><td><strong>G</strong></td><td></td></tr>
+<tr><td>7</td><td>8</td><td>9</td></tr>
+<tr><td>7</td><td>8</td><td>9</td></tr>
+</tbody>
+<tfoot><tr><td>&gt;</td><td>pie</td><td><strong>P</strong></td></tr></tfoot>
+</table>
+<table>
+<thead><tr class="header"><th>a</th><th>b</th></tr><tr><th>c</th><th>&gt;</th></tr></thead>
+<tbody>
+<tr><td><strong>s1</strong></td><td><strong>s2</strong></td></tr>
+<tr><td><strong>s3</strong></td><td></td></tr>
+<tr><td>d1</td><td>d2</td></tr>
+<tr><td>d3</td><td>d4</td></tr>
+<tr><td>d5</td><td>d6</td></tr>
+</tbody>
+<tbody>
+<tr><td><strong>t</strong></td><td><strong>u</strong></td></tr>
+<tr><td>d7</td><td>d8</td></tr>
+</tbody>
+</table>
+<table><tbody><tr><td><strong>solo</strong></td></tr><tr><td></td></tr></tbody></table>
+<table><tbody><tr><td>x</td></tr><tr><td>y</td></tr></tbody></table>''',
+"sinnotas": '''<p>Texto<a href="#fn1" class="footnote-ref" id="fnref1"><sup>1</sup></a></p>''',
+}
+
+CASOS["enlaces"] = '''<p id="año2"><a href="ch002.xhtml#año">otro</a> <a href="#año">este</a> <a href="../media/a.png">img</a></p>
+<p class="copia">copia me</p>'''
+
+
+@pytest.fixture
+def m(monkeypatch):
+    m = types.SimpleNamespace(
+        isMd=True,
+        extract=None,
+        extract_selector=None,
+        backend="lxml",
+        class_copy_index={
+            ("p", "copia me"): ["c1", "c2"],
+            ("h2", "T"): "k",
+            ("td", "celda"): "cc",
+            ("article", "celda celda"): "ar",
+            ("td", "B"): "bb"
+        }
+    )
+    monkeypatch.setattr(miepub, "M", m)
+    m.pasos = {"bs4": Pasos("bs4"), "lxml": Pasos("lxml")}
+    miepub.pasos_bs4(m.pasos["bs4"])
+    miepub.pasos_lxml(m.pasos["lxml"])
+    return m
+
+
+@pytest.mark.parametrize("md", (True, False), ids=("md", "html"))
+@pytest.mark.parametrize("caso", sorted(CASOS))
+def test_mismo_capitulo(m, md, caso):
+    m.isMd = md
+    data = (H % CASOS[caso]).encode("utf-8")
+    args = ("EPUB/text/ch001.xhtml", data, "EPUB/text/ch009.xhtml", {"año": "ano", "año2": "ano2"}, {"media/a.png": "media/b.png"})
+    a = miepub.transforma_capitulo(*args)
+    b = miepub.transforma_capitulo_lxml(*args)
+    assert a.html.encode("utf-8") == b.html.encode("utf-8")
+    assert a == b
@@ -0,0 +1,35 @@
+import os
+
+from cache import Cache
+
+
+def test_clave():
+    assert Cache.clave(b"a", "x", "y") == Cache.clave(b"a", "x", "y")
+    assert Cache.clave(b"a", "x", "y") != Cache.clave(b"a", "y", "x")
+    # Las partes van separadas, no concatenadas
+    assert Cache.clave(b"a", "xy") != Cache.clave(b"a", "x", "y")
+    assert Cache.clave(b"a") != Cache.clave(b"b")
+
+
+def test_get_put(tmp_path):
+    cache = Cache(str(tmp_path), 1 << 20)
+    clave = Cache.clave(b"img")
+    assert cache.get(clave) is None
+    cache.put(clave, b"optimizada")
+    cache.put(Cache.clave(b"vacia"), b"")
+    assert cache.get(clave) == b"optimizada"
+    assert cache.get(Cache.clave(b"vacia")) == b""
+    # Sin temporales a medias
+    assert not [f for _, _, fs in os.walk(tmp_path) for f in fs if f.startswith(".tmp")]
+
+
+def test_podar_quita_lo_menos_usado(tmp_path):
+    cache = Cache(str(tmp_path), 250)
+    claves = [Cache.clave(str(i).encode()) for i in range(4)]
+    for i, clave in enumerate(claves):
+        cache.put(clave, b"x" * 100)
+        os.utime(cache._path(clave), (1000 + i, 1000 + i))
+    # Leer la más antigua la convierte en la más reciente
+    assert cache.get(claves[0]) is not None
+    cache.podar()
+    assert [cache.get(c) is not None for c in claves] == [True, False, False, True]
@@ -0,0 +1,44 @@
+import miepub
+
+CAP = "EPUB/text/ch001.xhtml"
+NOTAS = "EPUB/text/ch009.xhtml"
+
+
+def test_imgdup_desde_text(m, xhtml):
+    # Los capítulos están en EPUB/text y enlazan las imágenes con ../media
+    data = xhtml('<p><img src="../media/b.png" alt="b" /><img src="media/b.png" alt="c" /><img src="../media/c.png" alt="d" /></p>')
+    cap = miepub.transforma_capitulo(CAP, data, NOTAS, {}, {"media/b.png": "media/a.png"})
+    assert '<p><img alt="b" src="../media/a.png"/><img alt="c" src="media/a.png"/><img alt="d" src="../media/c.png"/></p>' in cap.html
+
+
+def test_tabla_ids_sin_colisiones(xhtml):
+    capitulos = [
+        xhtml('<h2 id="Año">a</h2><h2 id="Ano">b</h2>', id="Uno."),
+        xhtml('<h2 id="Áno">c</h2><p id="x">d</p><p id="Ano-2">e</p>', id="dos"),
+    ]
+    assert miepub.tabla_ids(capitulos) == {"Uno.": "Uno", "Año": "Ano-3", "Áno": "Ano-4"}
+
+
+def test_tabla_ids_solo_de_elementos(xhtml):
+    capitulo = xhtml(
+        '<!-- <p id="Ñu"> --><pre><code>&lt;p id="Ña"&gt;</code></pre>'
+        '<script><![CDATA[ x = \'<p id="Ñe">\' ]]></script><p title=\' id="Ñi"\' id="ñ&amp;o">t</p>'
+    )
+    assert miepub.tabla_ids([capitulo]) == {"ñ&o": "n&o"}
+
+
+def test_renombra_href():
+    ids = {"Año": "Ano-2"}
+    assert miepub.renombra_href("#Año", ids) == "#Ano-2"
+    assert miepub.renombra_href("ch002.xhtml#A%C3%B1o", ids) == "ch002.xhtml#Ano-2"
+    assert miepub.renombra_href("ch002.xhtml#otro", ids) == "ch002.xhtml#otro"
+    assert miepub.renombra_href("ch002.xhtml", ids) == "ch002.xhtml"
+    assert miepub.renombra_href("https://example.com/#Año", ids) == "https://example.com/#Año"
+
+
+def test_renombra_ids_y_enlaces(m, xhtml):
+    data = xhtml('<h2 id="Año">a</h2>\n<p><a href="#Año">1</a> <a href="ch002.xhtml#Áno">2</a> <a href="#x">3</a></p>', id="Uno.")
+    cap = miepub.transforma_capitulo(CAP, data, NOTAS, {"Uno.": "Uno", "Año": "Ano-2", "Áno": "Ano-3"}, {})
+    assert '<section class="level1" id="Uno">' in cap.html
+    assert '<h2 id="Ano-2">a</h2>' in cap.html
+    assert '<p><a href="#Ano-2">1</a> <a href="ch002.xhtml#Ano-3">2</a> <a href="#x">3</a></p>' in cap.html
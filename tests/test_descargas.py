@@ -0,0 +1,95 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from cache import Cache
+from descargas import Descargas
+
+ETAG = '"v1"'
+CUERPO = b"\x89PNG imagen"
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    /fallo-N responde 503 las N primeras veces y luego 200; /etag responde
+    304 si se le pide con el ETag vigente. Cada petición queda en peticiones
+    """
+
+    def do_GET(self):
+        self.server.peticiones.append((self.path, dict(self.headers)))
+        if self.path.startswith("/fallo-"):
+            fallos = int(self.path.rsplit("-", 1)[1])
+            if sum(p == self.path for p, _ in self.server.peticiones) <= fallos:
+                self.responder(503)
+                return
+        if self.path == "/etag" and self.headers.get("If-None-Match") == ETAG:
+            self.responder(304)
+            return
+        self.responder(200, CUERPO, {"ETag": ETAG, "Content-Type": "image/png"})
+
+    def responder(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servidor():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.peticiones = []
+    hilo = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    hilo.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(servidor, path):
+    return f"http://127.0.0.1:{servidor.server_port}{path}"
+
+
+def test_reintenta_ante_503(servidor):
+    data, tipo = Descargas(reintentos=3).get(url(servidor, "/fallo-2"))
+    assert (data, tipo) == (CUERPO, "image/png")
+    assert [p for p, _ in servidor.peticiones] == ["/fallo-2"] * 3
+
+
+def test_agota_los_reintentos(servidor):
+    with pytest.raises(requests.RequestException):
+        Descargas(reintentos=1).get(url(servidor, "/fallo-5"))
+    assert len(servidor.peticiones) == 2
+
+
+def test_get_condicional(servidor, tmp_path):
+    cache = Cache(str(tmp_path), 1 << 20)
+    assert Descargas(cache).get(url(servidor, "/etag")) == (CUERPO, "image/png")
+    assert "If-None-Match" not in servidor.peticiones[0][1]
+    # Otra instancia (otra compilación) con la misma caché: pide con el
+    # ETag, el servidor responde 304 y el contenido sale de la caché
+    assert Descargas(cache).get(url(servidor, "/etag")) == (CUERPO, "image/png")
+    assert servidor.peticiones[1][1]["If-None-Match"] == ETAG
+    assert len(servidor.peticiones) == 2
+
+
+def test_sin_servidor_usa_la_cache(servidor, tmp_path):
+    cache = Cache(str(tmp_path), 1 << 20)
+    u = url(servidor, "/etag")
+    Descargas(cache).get(u)
+    servidor.shutdown()
+    servidor.server_close()
+    assert Descargas(cache, reintentos=0).get(u) == (CUERPO, "image/png")
+
+
+def test_descargar_anade_la_extension(servidor, tmp_path):
+    dwn = Descargas().descargar(url(servidor, "/etag"), str(tmp_path / "img" / "a"))
+    assert dwn.endswith("a.png")
+    with open(dwn, "rb") as f:
+        assert f.read() == CUERPO
@@ -0,0 +1,83 @@
+import os
+import zipfile
+
+import pytest
+
+import empaquetar
+from empaquetar import empaqueta
+
+TEXTO = b"<p>Un capitulo que se comprime bien.</p>\n" * 200
+ALEATORIO = os.urandom(100000)
+
+
+def _entradas(tmp_path):
+    (tmp_path / "foto.jpg").write_bytes(ALEATORIO)
+    return [
+        ("mimetype", b"application/epub+zip"),
+        ("EPUB/text/ch001.xhtml", TEXTO),
+        ("EPUB/media/foto.jpg", str(tmp_path / "foto.jpg")),
+        ("EPUB/media/plano.png", bytes(100000)),
+        ("EPUB/fonts/ñ.bin", ALEATORIO),
+    ]
+
+
+def _metodos(file):
+    with zipfile.ZipFile(file) as z:
+        assert z.testzip() is None
+        return {i.filename: i.compress_type for i in z.infolist()}
+
+
+def test_orden_y_contenido(tmp_path):
+    entradas = _entradas(tmp_path)
+    file = str(tmp_path / "libro.epub")
+    empaqueta(file, entradas, date_time=(2024, 1, 2, 3, 4, 6))
+    with zipfile.ZipFile(file) as z:
+        assert z.namelist() == [name for name, _ in entradas]
+        assert z.read("EPUB/media/foto.jpg") == ALEATORIO
+        assert z.read("EPUB/fonts/ñ.bin") == ALEATORIO
+        assert z.getinfo("EPUB/text/ch001.xhtml").date_time == (2024, 1, 2, 3, 4, 6)
+    # mimetype va el primero y sin comprimir, como pide el formato epub
+    with open(file, "rb") as f:
+        assert f.read(58)[30:] == b"mimetypeapplication/epub+zip"
+
+
+def test_comprimidos_y_sin_comprimir(tmp_path):
+    file = str(tmp_path / "libro.epub")
+    empaqueta(file, _entradas(tmp_path))
+    assert _metodos(file) == {
+        "mimetype": zipfile.ZIP_STORED,
+        "EPUB/text/ch001.xhtml": zipfile.ZIP_DEFLATED,
+        # Ya comprimido, la muestra no gana nada
+        "EPUB/media/foto.jpg": zipfile.ZIP_STORED,
+        # Ya comprimido en teoría, pero la muestra gana más de un 10%
+        "EPUB/media/plano.png": zipfile.ZIP_DEFLATED,
+        # Deflate no lo reduce
+        "EPUB/fonts/ñ.bin": zipfile.ZIP_STORED,
+    }
+
+
+def test_nivel_0(tmp_path):
+    file = str(tmp_path / "libro.epub")
+    empaqueta(file, _entradas(tmp_path), nivel=0)
+    assert set(_metodos(file).values()) == {zipfile.ZIP_STORED}
+    with pytest.raises(ValueError):
+        empaqueta(file, _entradas(tmp_path), nivel=10)
+
+
+@pytest.mark.parametrize("limite", ["MAX_ENTRADAS", "MAX_OFFSET"])
+def test_zip64_con_zipfile(tmp_path, monkeypatch, limite):
+    # Sin zip64 caben 65535 entradas y 4 GB: se bajan los límites para no
+    # tener que generar un zip así
+    monkeypatch.setattr(empaquetar, limite, 3 if limite == "MAX_ENTRADAS" else 150000)
+    llamadas = []
+    _zipfile = empaquetar._zipfile
+    monkeypatch.setattr(empaquetar, "_zipfile", lambda *args: llamadas.append(args[0]) or _zipfile(*args))
+    entradas = _entradas(tmp_path)
+    file = str(tmp_path / "libro.epub")
+    empaqueta(file, entradas)
+    assert llamadas == [file]
+    metodos = _metodos(file)
+    assert list(metodos) == [name for name, _ in entradas]
+    assert metodos["mimetype"] == zipfile.ZIP_STORED
+    assert metodos["EPUB/media/foto.jpg"] == zipfile.ZIP_STORED
+    assert metodos["EPUB/text/ch001.xhtml"] == zipfile.ZIP_DEFLATED
@@ -0,0 +1,198 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+import imagenes
+from imagenes import Operaciones
+
+
+def _imagen(formato: str, size=(400, 300), caja=(100, 50, 300, 250)) -> bytes:
+    im = Image.new("RGB", size, "white")
+    ImageDraw.Draw(im).rectangle(caja, fill=(200, 30, 30))
+    buff = io.BytesIO()
+    im.save(buff, formato)
+    return buff.getvalue()
+
+
+def test_from_mogrify_opciones_de_miepub():
+    ops = Operaciones.from_mogrify(("mogrify", "-strip", "+repage", "-fuzz", "600", "-trim",
+                                    "-colorspace", "GRAY", "-resize", "800>"))
+    assert ops == Operaciones(trim=True, fuzz=600 * 255 / 65535, gray=True, width=800)
+    assert Operaciones.from_mogrify(("mogrify",)) == Operaciones()
+    assert Operaciones.from_mogrify(("mogrify", "-fuzz", "10%")).fuzz == pytest.approx(25.5)
+
+
+@pytest.mark.parametrize("args", [("-rotate", "90"), ("-bordercolor", "None"), ("-resize", "50%"), ("-colorspace", "sRGB")])
+def test_from_mogrify_no_soportado(args):
+    with pytest.raises(ValueError):
+        Operaciones.from_mogrify(("mogrify",) + args)
+
+
+@pytest.mark.parametrize("formato", ["PNG", "JPEG"])
+def test_pillow_recorta_gris_y_redimensiona(formato):
+    data = imagenes.pillow(_imagen(formato), Operaciones(trim=True, fuzz=600 * 255 / 65535, gray=True, width=100))
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.format == formato
+        assert img.mode == "L"
+        # La caja de 201x201 recortada y reducida a 100 de ancho
+        assert img.size == (100, 100)
+
+
+def test_pillow_no_amplia_ni_recorta_sin_margen():
+    data = imagenes.pillow(_imagen("PNG", caja=(0, 0, 399, 299)), Operaciones(trim=True, width=800))
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.size == (400, 300)
+        assert img.mode == "RGB"
+
+
+def test_pillow_jpeg_progresivo():
+    data = imagenes.pillow(_imagen("JPEG"), Operaciones())
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.info.get("progressive") or img.info.get("progression")
+
+
+def test_pillow_formato_no_soportado():
+    buff = io.BytesIO()
+    Image.new("RGB", (10, 10)).save(buff, "GIF")
+    with pytest.raises(ValueError):
+        imagenes.pillow(buff.getvalue(), Operaciones())
+
+
+def test_duplicados():
+    imgs = {"a.png": b"x" * 10, "b.png": b"y" * 10, "c.png": b"x" * 10, "d.png": b"x" * 11,
+            "e.png": b"", "f.png": b"", "g.png": b"x" * 10}
+    # Cada duplicado apunta a la primera aparición, aunque haya varios
+    assert imagenes.duplicados(imgs) == {"c.png": "a.png", "g.png": "a.png", "f.png": "e.png"}
+
+
+def _programa(dir_bin, nombre: str, salida: str):
+    path = dir_bin / nombre
+    path.write_text("#!/bin/sh\necho '%s'\n" % salida)
+    path.chmod(0o755)
+
+
+def test_version_external_incluye_mogrify_y_picopt(tmp_path, monkeypatch):
+    _programa(tmp_path, "mogrify", "Version: ImageMagick 7.1.1-15 Q16")
+    _programa(tmp_path, "picopt", "picopt 3.3.1")
+    monkeypatch.setenv("PATH", str(tmp_path))
+    imagenes._version_programa.cache_clear()
+    try:
+        v = imagenes.version("external")
+        assert "ImageMagick 7.1.1-15" in v and "picopt 3.3.1" in v
+        _programa(tmp_path, "picopt", "picopt 4.0")
+        imagenes._version_programa.cache_clear()
+        assert imagenes.version("external") != v
+    finally:
+        imagenes._version_programa.cache_clear()
+
+
+def test_optimizar_guarda_con_la_clave_del_motor_usado(tmp_path, monkeypatch):
+    import types
+    import miepub
+    from cache import Cache
+
+    cache = Cache(str(tmp_path / "cache"), 1 << 20)
+    monkeypatch.setattr(miepub, "M", types.SimpleNamespace(
+        img_engine="pillow", img_cache=cache, mogrify=("mogrify",), tmp=types.SimpleNamespace(wks=str(tmp_path))))
+    llamadas = []
+    monkeypatch.setattr(imagenes, "externo", lambda nombre, data, mogrify, wks: llamadas.append(nombre) or b"x")
+    monkeypatch.setattr(imagenes, "version", lambda engine: engine + "-test")
+    # Pillow no sabe abrirla y se pasa a mogrify/picopt
+    antes = b"no es una imagen" * 10
+    assert miepub.optimizar("a.png", antes) == b"x"
+    assert cache.get(Cache.clave(antes, "mogrify", "external-test")) == b"x"
+    assert cache.get(Cache.clave(antes, "mogrify", "pillow-test")) is None
+    # La siguiente vez sale de la caché
+    assert miepub.optimizar("a.png", antes) == b"x"
+    assert llamadas == ["a.png"]
+    # Y lo que genera Pillow se guarda con la suya
+    png = _imagen("PNG")
+    despues = miepub.optimizar("b.png", png)
+    assert cache.get(Cache.clave(png, "mogrify", "pillow-test")) in (despues, b"")
+    assert llamadas == ["a.png"]
+
+
+def _con_metadatos(formato: str, modo="RGB") -> bytes:
+    im = Image.new("RGB", (64, 48), "white")
+    ImageDraw.Draw(im).rectangle((10, 10, 40, 30), fill=(200, 30, 30))
+    if modo == "P":
+        im = im.convert("P")
+    exif = Image.Exif()
+    exif[0x010F] = "Camara"
+    # GPSInfo
+    exif.get_ifd(0x8825)[1] = "N"
+    buff = io.BytesIO()
+    extra = {"comment": b"comentario"} if formato == "JPEG" else {}
+    im.save(buff, formato, exif=exif.tobytes(), icc_profile=b"perfil icc", **extra)
+    return buff.getvalue()
+
+
+def _metadatos(data: bytes):
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        return {k for k in ("exif", "icc_profile", "comment") if img.info.get(k)}
+
+
+def _pixeles(data: bytes):
+    with Image.open(io.BytesIO(data)) as img:
+        return img.mode, img.size, img.convert("RGBA").tobytes()
+
+
+@pytest.mark.parametrize("formato", ["PNG", "JPEG"])
+def test_sin_metadatos(formato):
+    data = _con_metadatos(formato)
+    assert _metadatos(data) == ({"exif", "icc_profile", "comment"} if formato == "JPEG" else {"exif", "icc_profile"})
+    limpia = imagenes.sin_metadatos(data)
+    assert _metadatos(limpia) == set()
+    # Sin volver a codificarla
+    assert _pixeles(limpia) == _pixeles(data)
+    assert imagenes.sin_metadatos(limpia) == limpia
+    assert imagenes.sin_metadatos(b"GIF89a...") == b"GIF89a..."
+
+
+@pytest.mark.parametrize("formato", ["PNG", "JPEG"])
+@pytest.mark.parametrize("ops", [Operaciones(), Operaciones(width=20)])
+def test_pillow_quita_los_metadatos(formato, ops):
+    assert _metadatos(imagenes.pillow(_con_metadatos(formato), ops)) == set()
+
+
+def test_optimizar_quita_los_metadatos_aunque_no_reduzca(tmp_path, monkeypatch):
+    import types
+    import miepub
+
+    monkeypatch.setattr(miepub, "M", types.SimpleNamespace(img_engine="pillow", img_cache=None, mogrify=("mogrify",)))
+    # Un png con paleta más grande que --width, que Pillow no consigue reducir
+    antes = _con_metadatos("PNG", "P")
+    monkeypatch.setattr(imagenes, "pillow", lambda data, ops: data + b"\0")
+    despues = miepub.optimizar("a.png", antes)
+    assert len(despues) < len(antes)
+    assert _metadatos(despues) == set()
+    assert _pixeles(despues) == _pixeles(antes)
+
+
+def test_pillow_conserva_la_paleta():
+    im = Image.new("P", (40, 30))
+    im.putpalette([255, 255, 255, 200, 30, 30])
+    ImageDraw.Draw(im).rectangle((10, 5, 30, 25), fill=1)
+    buff = io.BytesIO()
+    im.save(buff, "PNG")
+    # Recortar o pedir un ancho mayor no necesita quitar la paleta
+    for ops in (Operaciones(trim=True), Operaciones(width=100)):
+        with Image.open(io.BytesIO(imagenes.pillow(buff.getvalue(), ops))) as img:
+            assert img.mode == "P"
+    with Image.open(io.BytesIO(imagenes.pillow(buff.getvalue(), Operaciones(trim=True)))) as img:
+        assert img.size == (21, 21)
+    # Redimensionar sí, para poder interpolar
+    with Image.open(io.BytesIO(imagenes.pillow(buff.getvalue(), Operaciones(width=20)))) as img:
+        assert img.mode == "RGB" and img.size == (20, 15)
+
+
+def test_pillow_gris_con_transparencia():
+    im = Image.new("P", (10, 10))
+    im.putpalette([0, 0, 0, 200, 30, 30])
+    buff = io.BytesIO()
+    im.save(buff, "PNG", transparency=0)
+    with Image.open(io.BytesIO(imagenes.pillow(buff.getvalue(), Operaciones(gray=True)))) as img:
+        assert img.mode == "LA"
+        assert img.getpixel((0, 0))[1] == 0
@@ -0,0 +1,70 @@
+import os
+
+import miepub
+
+
+def _fuente(tmp_path, m, texto="# Uno\n\n![img](img/a.png)\n\n<img src=\"b.png\"/>\n"):
+    (tmp_path / "img").mkdir(exist_ok=True)
+    (tmp_path / "img" / "a.png").write_bytes(b"a")
+    (tmp_path / "b.png").write_bytes(b"b")
+    (tmp_path / "libro.md").write_text(texto)
+    m.fuente = str(tmp_path / "libro.md")
+    m.extra_args = ()
+    m.remotos = {}
+
+
+def test_clave_pandoc_cambia_con_las_imagenes(tmp_path, m):
+    _fuente(tmp_path, m)
+    clave = miepub.clave_pandoc()
+    assert miepub.clave_pandoc() == clave
+    (tmp_path / "b.png").write_bytes(b"bb")
+    assert miepub.clave_pandoc() != clave
+    clave = miepub.clave_pandoc()
+    st = os.stat(tmp_path / "img" / "a.png")
+    os.utime(tmp_path / "img" / "a.png", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert miepub.clave_pandoc() != clave
+    clave = miepub.clave_pandoc()
+    # Una imagen a la que no enlaza la fuente no cuenta
+    (tmp_path / "img" / "c.png").write_bytes(b"c")
+    assert miepub.clave_pandoc() == clave
+    (tmp_path / "libro.md").write_text("# Otro\n")
+    assert miepub.clave_pandoc() != clave
+
+
+def test_clave_pandoc_usa_el_contenido_de_los_ficheros_de_los_argumentos(tmp_path, m):
+    _fuente(tmp_path, m)
+    css = tmp_path / "tmp1.css"
+    css.write_text("p {}")
+    m.extra_args = ("--css", str(css))
+    clave = miepub.clave_pandoc()
+    # El mismo css en otra ruta temporal da la misma clave
+    otro = tmp_path / "tmp2.css"
+    otro.write_text("p {}")
+    m.extra_args = ("--css", str(otro))
+    assert miepub.clave_pandoc() == clave
+    otro.write_text("p { margin: 0 }")
+    assert miepub.clave_pandoc() != clave
+    m.extra_args = ("--css", str(css), "--toc")
+    assert miepub.clave_pandoc() != clave
+
+
+def test_clave_pandoc_usa_el_contenido_de_las_imagenes_remotas(tmp_path, m):
+    _fuente(tmp_path, m, "# Uno\n\n![r](https://example.com/r.png)\n")
+    (tmp_path / "r.png").write_bytes(b"r")
+    m.remotos = {"https://example.com/r.png": str(tmp_path / "r.png")}
+    clave = miepub.clave_pandoc()
+    (tmp_path / "r.png").write_bytes(b"otra")
+    assert miepub.clave_pandoc() != clave
+
+
+def test_firma_capitulos(m):
+    firma = miepub.firma_capitulos("EPUB/text/ch009.xhtml", {"año": "ano"}, {})
+    assert miepub.firma_capitulos("EPUB/text/ch009.xhtml", {"año": "ano"}, {}) == firma
+    assert miepub.firma_capitulos("EPUB/text/ch008.xhtml", {"año": "ano"}, {}) != firma
+    assert miepub.firma_capitulos("EPUB/text/ch009.xhtml", {}, {}) != firma
+    assert miepub.firma_capitulos("EPUB/text/ch009.xhtml", {"año": "ano"}, {"media/b.png": "media/a.png"}) != firma
+    for attr, valor in (("extract", "hr"), ("backend", "lxml"), ("isMd", False), ("class_copy_index", {("p", "x"): "y"})):
+        antes = getattr(m, attr)
+        setattr(m, attr, valor)
+        assert miepub.firma_capitulos("EPUB/text/ch009.xhtml", {"año": "ano"}, {}) != firma
+        setattr(m, attr, antes)
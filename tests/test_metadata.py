@@ -0,0 +1,38 @@
+import pytest
+
+import miepub
+
+
+def _metadata(tmp_path, html: bytes) -> miepub.MetaData:
+    fuente = tmp_path / "libro.html"
+    fuente.write_bytes(html)
+    return miepub.MetaData(miepub.parser.parse_args([str(fuente)]))
+
+
+@pytest.mark.parametrize("antes", [
+    b"<!-- <body> -->",
+    b'<script>var s = "<body class=x>";</script>',
+    b"<style>/* <body> */</style>",
+])
+def test_head_no_termina_en_un_body_que_no_lo_es(tmp_path, antes):
+    m = _metadata(tmp_path, b'''<!DOCTYPE html>
+<html><head><title>t</title>%s
+<meta name="author" content="Yo" />
+</head>
+<body><meta name="keywords" content="no" /><p>texto</p></body></html>''' % antes)
+    assert m._get_meta_content("author") == "Yo"
+    assert m._get_meta_content("keywords") is None
+
+
+def test_head_sin_body_y_con_otra_codificacion(tmp_path):
+    html = '<html><head><meta charset="iso-8859-1"><meta name="author" content="Año"></head><p>x<meta name="keywords" content="no">'
+    m = _metadata(tmp_path, html.encode("latin-1"))
+    assert m._get_meta_content("author") == "Año"
+    assert m._get_meta_content("keywords") is None
+
+
+def test_head_en_varios_trozos(tmp_path):
+    metas = b"".join(b'<meta name="m%d" content="%d" />' % (i, i) for i in range(5000))
+    m = _metadata(tmp_path, b"<html><head>" + metas + b"</head><body>" + b"x" * 100000 + b'<meta name="keywords" content="no" /></body></html>')
+    assert m._get_meta_content("m4999") == "4999"
+    assert m._get_meta_content("keywords") is None
@@ -0,0 +1,95 @@
+import random
+import re
+
+import bs4
+import pytest
+
+import miepub
+
+
+def minify_regex(h: str) -> str:
+    """
+    El minify_soup original, una cascada de re.sub, que es la referencia
+    con la que tiene que coincidir miepub.minify
+    """
+    def __re(rg: str):
+        return re.compile(rg, re.MULTILINE | re.DOTALL | re.UNICODE)
+
+    for t in miepub.tag_concat:
+        r = __re(r"</" + t + r">(\s*)<" + t + ">")
+        h = r.sub(r"\1", h)
+    for t in miepub.tag_round:
+        for r in (
+            __re(r"(<" + t + r">)(\s+)"),
+            __re(r"(<" + t + r" [^>]+>)(\s+)"),
+            __re(r"(\s+)(</" + t + r">)")
+        ):
+            h = r.sub(r"\2\1", h)
+    for t in miepub.tab_block:
+        for r in (
+            __re(r"\s*(<" + t + r">)\s*"),
+            __re(r"\s*(<" + t + r" [^>]+>)\s*"),
+        ):
+            h = r.sub(r"\n\1", h)
+        h = __re(r"\s*(</" + t + r">)\s*").sub(r"\1\n", h)
+    return h.replace(' xmlns:="', ' xmlns="')
+
+
+TAGS = ["u", "ul", "ol", "i", "em", "strong", "span", "a", "p", "li", "tr", "td", "th", "thead", "tbody",
+        "div", "h1", "h3", "h7", "caption", "figcaption", "b", "x", "pre", "table"]
+TEXTOS = [" ", "\n", "  ", "\t", "\xa0", "", "", "a", "b c", " d ", "\n  e\n"]
+
+
+def _fragmento(rnd: random.Random) -> str:
+    partes = []
+    for _ in range(rnd.randint(1, 12)):
+        partes.append(rnd.choice(TEXTOS))
+        t = rnd.choice(TAGS)
+        r = rnd.random()
+        if r < 0.35:
+            partes.append(f"<{t}>")
+        elif r < 0.6:
+            partes.append(f"</{t}>")
+        elif r < 0.8:
+            partes.append(f'<{t} class="{rnd.choice(["x", "y z"])}">')
+        elif r < 0.85:
+            partes.append(f"<{t}/>")
+        elif r < 0.9:
+            partes.append(f"<{t} >")
+        else:
+            partes.append(f'<{t} a="1"/>')
+    partes.append(rnd.choice(TEXTOS))
+    h = "".join(partes)
+    if rnd.random() < 0.05:
+        h = '<html xmlns:="x">' + h
+    return h
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_minify_igual_que_regex_en_fragmentos(seed):
+    rnd = random.Random(seed)
+    for _ in range(1500):
+        h = _fragmento(rnd)
+        assert miepub.minify(h) == minify_regex(h), repr(h)
+
+
+def _capitulo(rnd: random.Random, bloques: int) -> str:
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head>\n<body>\n<section class="level1">\n<h1> Título </h1>']
+    for _ in range(bloques):
+        r = rnd.random()
+        if r < 0.5:
+            out.append("<p> %s <em> en </em><em>fasis</em> <a href=\"#x\"> enlace </a> <span class=\"s\"> s </span></p>" % rnd.choice(TEXTOS))
+        elif r < 0.7:
+            out.append("<ul>\n<li> uno </li>\n<li><strong> dos</strong> <strong>y </strong></li>\n</ul>\n<ul><li>tres</li></ul>")
+        elif r < 0.9:
+            out.append("<table>\n<caption> c </caption>\n<thead>\n<tr class=\"header\">\n<th> a </th>\n</tr>\n</thead>\n<tbody>\n<tr class=\"odd\">\n<td> <i>x</i> </td>\n</tr>\n</tbody>\n</table>")
+        else:
+            out.append("<div class=\"d\">\n<figure><img src=\"a.png\" alt=\"\"/><figcaption> pie </figcaption></figure>\n<pre>  código  \n  aquí </pre></div>")
+    out.append("</section>\n</body>\n</html>")
+    return "\n".join(out)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_minify_soup_igual_que_regex_en_capitulos(seed):
+    soup = bs4.BeautifulSoup(_capitulo(random.Random(seed), 300), "xml")
+    assert miepub.minify_soup(soup) == minify_regex(str(soup))
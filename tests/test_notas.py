@@ -0,0 +1,120 @@
+from typing import List
+
+import bs4
+import pytest
+
+import miepub
+from pasos import Contexto
+
+NOTAS = "EPUB/text/ch009.xhtml"
+
+
+def _capitulo(xhtml, primera: int, n: int) -> bytes:
+    """
+    Capítulo con n llamadas a notas al pie, de texto "Nota <primera + i>"
+    """
+    refs = "".join(f'<p>Texto {i}<a href="#fn{i}" class="footnote-ref" id="fnref{i}" role="doc-noteref"><sup>{i}</sup></a>.</p>\n'
+                   for i in range(1, n + 1))
+    if n == 0:
+        return xhtml("<p>Sin notas</p>")
+    notas = "".join(f'<li id="fn{i}"><p>Nota {primera + i}<a href="#fnref{i}" class="footnote-back" role="doc-backlink">↩︎</a></p></li>\n'
+                    for i in range(1, n + 1))
+    return xhtml(refs + '<section id="footnotes" class="footnotes footnotes-end-of-document" role="doc-endnotes">\n<hr />\n<ol>\n' + notas + "</ol>\n</section>")
+
+
+def _numera(caps: List[miepub.Capitulo]):
+    """
+    El reduce de build: numera en orden los capítulos y sus notas
+    """
+    count = 1
+    htmls = []
+    notas = []
+    for cap in caps:
+        htmls.append(miepub.numera_notas(cap.html, count))
+        notas.extend(miepub.numera_notas(n, count) for n in cap.notas)
+        count = count + cap.refs
+    return htmls, notas
+
+
+def _transforma(xhtml, *capitulos):
+    return [miepub.transforma_capitulo(f"EPUB/text/ch00{i + 1}.xhtml", _capitulo(xhtml, *c), NOTAS, {}, {})
+            for i, c in enumerate(capitulos)]
+
+
+def test_numera_las_notas_de_todos_los_capitulos(m, xhtml):
+    caps = _transforma(xhtml, (0, 2), (2, 0), (2, 1))
+    assert [c.refs for c in caps] == [2, 0, 1]
+    htmls, notas = _numera(caps)
+    assert '<p>Texto 1<a class="footnote-ref" href="ch009.xhtml#fn1" id="fnref1" role="doc-noteref"><sup>[1]</sup></a>.</p>' in htmls[0]
+    assert '<p>Texto 2<a class="footnote-ref" href="ch009.xhtml#fn2" id="fnref2" role="doc-noteref"><sup>[2]</sup></a>.</p>' in htmls[0]
+    assert '<p>Texto 1<a class="footnote-ref" href="ch009.xhtml#fn3" id="fnref1" role="doc-noteref"><sup>[3]</sup></a>.</p>' in htmls[2]
+    assert notas == [
+        '<p id="fn1"><sup>[1]</sup> Nota 1 <a class="volver" href="ch001.xhtml#fnref1" role="doc-backlink">&lt;&lt;</a></p>',
+        '<p id="fn2"><sup>[2]</sup> Nota 2 <a class="volver" href="ch001.xhtml#fnref2" role="doc-backlink">&lt;&lt;</a></p>',
+        '<p id="fn3"><sup>[3]</sup> Nota 3 <a class="volver" href="ch003.xhtml#fnref1" role="doc-backlink">&lt;&lt;</a></p>',
+    ]
+    # Las notas no se quedan en su capítulo
+    assert "Nota" not in htmls[0] and "footnotes" not in htmls[2]
+
+
+def test_formato_de_las_notas(m, xhtml):
+    m.notes_format = {2: "*", -1: "<{}>"}
+    htmls, notas = _numera(_transforma(xhtml, (0, 1), (1, 2)))
+    assert "<sup>&lt;1&gt;</sup>" in htmls[0]
+    assert "<sup>*</sup>" in htmls[1] and "<sup>&lt;3&gt;</sup>" in htmls[1]
+    assert [n.split(" <a ")[0] for n in notas] == [
+        '<p id="fn1"><sup>&lt;1&gt;</sup> Nota 1',
+        '<p id="fn2"><sup>*</sup> Nota 2',
+        '<p id="fn3"><sup>&lt;3&gt;</sup> Nota 3',
+    ]
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_marcas_no_se_confunden_con_el_texto(m, xhtml, backend):
+    # Caracteres de uso privado (fuentes de iconos), también como las marcas
+    # de antes, y no-caracteres como las de ahora
+    texto = "Iconos \ue000 \ue0001\ue001 \ue0022\ue003 \ue004"
+    data = _capitulo(xhtml, 0, 1).replace(b"<p>Texto 1", f"<p>{texto} \ufdd01\ufdd1 &#xFDD2;2&#64979; Texto 1".encode("utf-8"))
+    transforma = miepub.transforma_capitulo_lxml if backend == "lxml" else miepub.transforma_capitulo
+    htmls, notas = _numera([transforma("EPUB/text/ch001.xhtml", data, NOTAS, {}, {})])
+    assert f"<p>{texto} \ufffd1\ufffd \ufffd2\ufffd Texto 1<a " in htmls[0]
+    assert '<sup>[1]</sup>' in htmls[0] and notas[0].startswith('<p id="fn1"><sup>[1]</sup> Nota 1')
+    capitulo = miepub.capitulo_notas(xhtml(f"<h1>Notas</h1>\n<p>{texto} \ufdd4</p>"), "\n" + notas[0], {}, {}, {})
+    assert f"<p>{texto} \ufffd</p>\n{notas[0]}\n</section>" in capitulo
+
+
+def _capitulo_notas_parseando(data, notas, fix):
+    """
+    capitulo_notas antes de insertar las notas en el html ya minificado
+    """
+    soup = bs4.BeautifulSoup(data, "xml")
+    ctx = Contexto(soup, "", {}, {})
+    miepub._pre_notas(soup, ctx)
+    div = soup.select_one("section")
+    wrap = bs4.BeautifulSoup('<div xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">' + "".join(notas) + '</div>', "xml")
+    for n in list(wrap.find("div").contents):
+        div.append(n.extract())
+    for _id, xml in fix.items():
+        a = div.find("a", attrs={"href": "#" + _id})
+        if a:
+            a.attrs["href"] = xml + a.attrs["href"]
+    miepub._post_notas(soup, ctx)
+    return miepub.minify_soup(soup)
+
+
+def test_capitulo_notas_como_si_las_notas_estuvieran_en_el_capitulo(m, xhtml):
+    htmls, notas = _numera(_transforma(xhtml, (0, 2), (2, 0), (2, 1)))
+    propia = '<h1>Notas</h1>\n<p id="fnx">Nota <em>propia</em> <a href="#fnref9">volver</a></p>\n<ul>\n<li>lista</li>\n</ul>'
+    fix = {"fnref9": "ch002.xhtml"}
+    # Lo mismo que con las notas ya en el capítulo, y que con el
+    # capitulo_notas de antes, que las parseaba y las añadía a la sección
+    ref = miepub.capitulo_notas(xhtml(propia + "\n" + "\n".join(notas)), "", fix, {}, {})
+    assert _capitulo_notas_parseando(xhtml(propia), notas, fix) == ref
+    assert miepub.capitulo_notas(xhtml(propia), "".join("\n" + n for n in notas), fix, {}, {}) == ref
+    assert '<a href="ch002.xhtml#fnref9">volver</a>' in ref
+    assert ref.count('<p id="fn') == 4
+
+
+def test_capitulo_notas_sin_notas(m, xhtml):
+    data = xhtml("<h1>Notas</h1>\n<p>Nada</p>")
+    assert miepub.capitulo_notas(data, "", {}, {}, {}) == miepub.minify_soup(miepub.bs4.BeautifulSoup(data, "xml"))
@@ -0,0 +1,111 @@
+import pytest
+
+from miepub import Epub, Opf, media_sin_usar
+
+OPF = b"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>T</dc:title>
+    <dc:source></dc:source>
+  </metadata>
+  <manifest>
+    <item id="title_page_xhtml" href="text/title_page.xhtml" media-type="application/xhtml+xml" />
+    <item id="ch001_xhtml" href="text/ch001.xhtml" media-type="application/xhtml+xml" />
+    <item id="portada" href="media/portada.jpg" media-type="image/jpeg" properties="cover-image" />
+    <item id="a" href="media/a%20b.png" media-type="image/png" />
+    <item id="c" href="media/c.png" media-type="image/png" />
+    <item id="d" href="media/d.png" media-type="image/png" />
+    <item id="it's" href="text/l%27a.xhtml" media-type="application/xhtml+xml" />
+  </manifest>
+  <spine>
+    <itemref idref="title_page_xhtml" />
+    <itemref idref="ch001_xhtml" />
+    <itemref idref="it's" />
+  </spine>
+  <guide>
+    <reference type="title-page" href="text/title_page.xhtml#inicio" />
+  </guide>
+</package>"""
+
+
+def test_remove():
+    opf = Opf("EPUB/content.opf", OPF)
+    assert opf.cover_image == "EPUB/media/portada.jpg"
+    assert opf.paths["EPUB/media/a b.png"] == "a"
+    opf.remove("EPUB/text/title_page.xhtml")
+    opf.remove("EPUB/text/no_existe.xhtml")
+    assert "title_page_xhtml" not in opf.items
+    assert [r.get("idref") for r in opf.spine] == ["ch001_xhtml", "it's"]
+    assert len(opf.guide) == 0
+    out = opf.to_bytes()
+    assert out.startswith(b'<?xml version="1.0" encoding="UTF-8"?>\n<package')
+    assert b"title_page" not in out
+
+
+def test_media_sin_usar():
+    opf = Opf("EPUB/content.opf", OPF)
+    epub = Epub({
+        "EPUB/content.opf": OPF,
+        "EPUB/text/ch001.xhtml": b'<p><img src="../media/a%20b.png" /></p>',
+        "EPUB/styles/stylesheet1.css": b'p { background: url( "../media/c.png" ) }',
+    })
+    assert media_sin_usar(epub, opf) == ["EPUB/media/d.png"]
+
+
+
+XHTML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:xlink="http://www.w3.org/1999/xlink"><head><title>t</title></head>
+<body>%s</body></html>'''
+
+
+@pytest.mark.parametrize("xhtml, css", [
+    (b'<video poster="../media/c.png" src="../media/a%20b.png"/>', b""),
+    (b'<img src="../media/a%20b.png" srcset="../media/a%20b.png 1x,../media/c.png 2x"/>', b""),
+    (b'<object data="../media/c.png"/><p style="background: url(../media/a%20b.png)"/>', b""),
+    (b'<svg xmlns="http://www.w3.org/2000/svg"><image xlink:href="../media/a%20b.png"/></svg>'
+     b'<style>p { background: url("../media/c.png") }</style>', b""),
+    (b"", b'@import "../media/a%20b.png"; /* url(../media/d.png) */ p { background: url(../media/c.png) }'),
+])
+def test_media_sin_usar_otros_atributos(xhtml, css):
+    opf = Opf("EPUB/content.opf", OPF)
+    epub = Epub({
+        "EPUB/content.opf": OPF,
+        "EPUB/text/ch001.xhtml": XHTML % xhtml,
+        "EPUB/styles/stylesheet1.css": css,
+    })
+    assert media_sin_usar(epub, opf) == ["EPUB/media/d.png"]
+    # Un texto o un código que parece un atributo no es una referencia
+    epub.files["EPUB/text/ch001.xhtml"] = XHTML % (b'<pre>&lt;img src="../media/d.png"/&gt;</pre>' + xhtml)
+    assert media_sin_usar(epub, opf) == ["EPUB/media/d.png"]
+
+
+def lineas(opf: Opf):
+    return opf.to_bytes().decode("utf-8").splitlines()
+
+
+def test_remove_mantiene_la_sangria():
+    opf = Opf("EPUB/content.opf", OPF)
+    opf.remove("EPUB/text/title_page.xhtml")
+    opf.remove("EPUB/text/l'a.xhtml")
+    out = lineas(opf)
+    assert "  </manifest>" in out
+    assert "  </spine>" in out
+    assert "  <guide>" in out and "  </guide>" in out
+    assert not any("title_page" in s or "it's" in s for s in out)
+    assert '    <itemref idref="ch001_xhtml"/>' in out
+    assert "" not in out[1:]
+
+
+def test_remove_id_con_comillas():
+    opf = Opf("EPUB/content.opf", OPF)
+    opf.remove("EPUB/text/l'a.xhtml")
+    assert [r.get("idref") for r in opf.spine] == ["title_page_xhtml", "ch001_xhtml"]
+    assert "it's" not in opf.items
+
+
+def test_quita_dc():
+    opf = Opf("EPUB/content.opf", OPF)
+    for source in opf.dc("source"):
+        Opf.quita(source)
+    out = lineas(opf)
+    assert out[3:6] == ["    <dc:title>T</dc:title>", "  </metadata>", "  <manifest>"]
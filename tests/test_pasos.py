@@ -0,0 +1,136 @@
+import bs4
+import pytest
+from lxml import etree
+
+import miepub
+from pasos import Contexto, Pasos
+
+
+def _nombres(pasos, fase="post"):
+    return [p.nombre for p in pasos.orden(fase)]
+
+
+def test_orden():
+    pasos = Pasos("bs4")
+    pasos.registra("a", despues=("c",))
+    pasos.registra("b")
+    pasos.registra("c", despues=("pre1",))
+    pasos.registra("pre1", "pre")
+    pasos.registra("pre2", "pre", despues=("pre1",))
+    assert _nombres(pasos) == ["b", "c", "a"]
+    assert _nombres(pasos, "pre") == ["pre1", "pre2"]
+    # Registrar con el mismo nombre lo sustituye
+    pasos.registra("a")
+    assert _nombres(pasos) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("registra", [
+    # Dependencias circulares
+    lambda p: (p.registra("a", despues=("b",)), p.registra("b", despues=("a",))),
+    # Un paso que no existe
+    lambda p: p.registra("a", despues=("no",)),
+    # Un paso de una fase posterior
+    lambda p: (p.registra("a", "pre", despues=("b",)), p.registra("b", "post")),
+])
+def test_orden_imposible(registra):
+    pasos = Pasos("bs4")
+    registra(pasos)
+    with pytest.raises(ValueError):
+        pasos.orden("pre")
+        pasos.orden("post")
+
+
+def test_registra_mal():
+    pasos = Pasos("bs4")
+    with pytest.raises(ValueError):
+        pasos.registra("a", "otra")
+    with pytest.raises(ValueError):
+        pasos.registra("a", tags="p")
+    with pytest.raises(ValueError):
+        pasos.registra("a", despues="b")
+
+
+HTML = "<div><p>uno<b>x</b></p><span><i>y</i></span><p>dos</p></div>"
+
+
+def _raiz(backend):
+    if backend == "lxml":
+        return etree.fromstring(HTML)
+    return bs4.BeautifulSoup(HTML, "html.parser").div
+
+
+def _hijos(n):
+    return list(n) if isinstance(n, etree._Element) else n.find_all(True, recursive=False)
+
+
+def _nombre(n):
+    return n.tag if isinstance(n, etree._Element) else n.name
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_recorre(backend):
+    pasos = Pasos(backend)
+    visto = []
+    pasos.registra("todo", entrar=lambda n, ctx: visto.append("+" + _nombre(n)),
+                   salir=lambda n, ctx: visto.append("-" + _nombre(n)))
+
+    def desenvuelve(span, ctx):
+        if backend == "lxml":
+            i = span[0]
+            span.getparent().replace(span, i)
+        else:
+            span.unwrap()
+
+    def saca(b, ctx):
+        if backend == "lxml":
+            b.getparent().remove(b)
+        else:
+            b.extract()
+
+    pasos.registra("span", tags=("span",), entrar=desenvuelve, despues=("todo",))
+    pasos.registra("b", tags=("b",), entrar=saca)
+    raiz = _raiz(backend)
+    pasos.recorre(raiz, "post", Contexto(raiz, "", {}, {}))
+    # Después de quitar el b no se sale de él; el span desenvuelto se cambia
+    # por su contenido, que se recorre en su lugar
+    assert visto == ["+div", "+p", "+b", "-p", "+span", "+i", "-i", "+p", "-p", "-div"]
+    assert [_nombre(n) for n in _hijos(raiz)] == ["p", "i", "p"]
+    assert _hijos(_hijos(raiz)[0]) == []
+
+
+PASOS = '''
+def registra(pasos):
+    def marca(p, ctx):
+        if pasos.backend == "lxml":
+            p.set("class", "mio")
+        else:
+            p["class"] = "mio"
+    pasos.registra("mio", tags=("p",), entrar=marca, despues=("copia_class",))
+'''
+
+
+def test_fichero_pasos(m, tmp_path, xhtml):
+    file = tmp_path / "mis_pasos.py"
+    file.write_text(PASOS)
+    firma = miepub.firma_capitulos("EPUB/text/ch009.xhtml", {}, {})
+    for backend in ("bs4", "lxml"):
+        m.backend = backend
+        m.ficheros_pasos = (str(file),)
+        pasos = miepub.MetaData.pasos.func(m)
+        assert "mio" in pasos[backend].pasos
+        m.pasos = pasos
+        transforma = miepub.transforma_capitulo_lxml if backend == "lxml" else miepub.transforma_capitulo
+        cap = transforma("EPUB/text/ch001.xhtml", xhtml("<p>a</p>"), "EPUB/text/ch009.xhtml", {}, {})
+        assert '<p class="mio">a</p>' in cap.html
+    assert miepub.firma_capitulos("EPUB/text/ch009.xhtml", {}, {}) != firma
+    file.write_text(PASOS.replace("mio", "otro"))
+    assert miepub.firma_capitulos("EPUB/text/ch009.xhtml", {}, {}) != firma
+
+
+@pytest.mark.parametrize("texto", ["x = 1\n", PASOS.replace('"copia_class"', '"no_existe"')])
+def test_fichero_pasos_mal(m, tmp_path, texto):
+    file = tmp_path / "mis_pasos.py"
+    file.write_text(texto)
+    m.ficheros_pasos = (str(file),)
+    with pytest.raises(SystemExit):
+        miepub.MetaData.pasos.func(m)
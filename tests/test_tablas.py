@@ -0,0 +1,59 @@
+import re
+
+import pytest
+
+import miepub
+
+TABLA = '''<table>
+<tbody>
+<tr><td><strong>A</strong></td><td>&gt;</td><td><strong>B</strong></td></tr>
+<tr><td>1</td><td>&gt;</td><td>2</td></tr>
+<tr><td>3</td><td>4</td><td>5</td></tr>
+</tbody>
+</table>'''
+ESPERADA = [
+    "<table>",
+    # La fila sin datos, toda en negrita, pasa al thead con th
+    "<thead>", '<tr class="odd">', "<th>", "A", '<th colspan="2" style="text-align: center;">', "B",
+    "<tbody>", '<tr class="odd">', "<td>", "1", '<td colspan="2" style="text-align: center;">', "2",
+    '<tr class="even">', "<td>", "3", "<td>", "4", "<td>", "5",
+    "</table>",
+]
+
+
+def _tablas(m, backend, xhtml, cuerpo):
+    m.backend = backend
+    transforma = miepub.transforma_capitulo_lxml if backend == "lxml" else miepub.transforma_capitulo
+    html = transforma("EPUB/text/ch001.xhtml", xhtml(cuerpo), "EPUB/text/ch009.xhtml", {}, {}).html
+    html = re.sub(r"\s*\n\s*", "", html)
+    return re.findall(r"<(?:table|/table|thead|tbody|tr|th|td)\b[^>]*>|[^<>]+(?=</t[hd]>)", html)
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_colspan_y_thead(m, xhtml, backend):
+    assert _tablas(m, backend, xhtml, TABLA) == ESPERADA
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_sin_thead_si_hay_filas_sin_datos_despues(m, xhtml, backend):
+    tabla = TABLA.replace("</tbody>", "<tr><td><strong>C</strong></td><td></td><td></td></tr>\n</tbody>")
+    out = _tablas(m, backend, xhtml, tabla)
+    assert "<thead>" not in out
+    assert out[:4] == ["<table>", "<tbody>", '<tr class="odd">', "<th>"]
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_tablas_anidadas(m, xhtml, backend):
+    anidada = TABLA.replace("<td>5</td>", "<td>" + TABLA.replace("A", "a").replace("B", "b") + "</td>")
+    # Cada tabla se normaliza por su cuenta: las filas y celdas de la anidada
+    # no cuentan como de la de fuera
+    dentro = [{"A": "a", "B": "b"}.get(t, t) for t in ESPERADA]
+    assert _tablas(m, backend, xhtml, anidada) == ESPERADA[:-2] + dentro + ["</table>"]
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_html_no_toca_las_tablas(m, xhtml, backend):
+    m.isMd = False
+    out = _tablas(m, backend, xhtml, TABLA)
+    assert "<thead>" not in out and "<th>" not in out
+    assert out.count("<td>") == 9
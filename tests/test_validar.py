@@ -0,0 +1,91 @@
+from validar import valida
+
+CONTAINER = b'''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+OPF = '''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+<item id="ch001" href="text/ch001.xhtml" media-type="application/xhtml+xml"/>
+<item id="ch002" href="text/ch002.xhtml" media-type="application/xhtml+xml"/>
+<item id="img" href="media/a%%20b.png" media-type="image/png"/>
+%s</manifest>
+<spine>
+<itemref idref="ch001"/>
+<itemref idref="ch002"/>
+%s</spine>
+</package>'''
+
+XHTML = '''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:xlink="http://www.w3.org/1999/xlink"><head><title>t</title></head>
+<body>%s</body></html>'''
+
+
+def _epub(item="", itemref="", ch001='<p id="uno"><a href="ch002.xhtml#dos">2</a> <a href="#uno">1</a></p>', **extra):
+    files = {
+        "mimetype": b"application/epub+zip",
+        "META-INF/container.xml": CONTAINER,
+        "EPUB/content.opf": (OPF % (item, itemref)).encode("utf-8"),
+        "EPUB/nav.xhtml": (XHTML % '<nav><a href="text/ch001.xhtml#uno">1</a></nav>').encode("utf-8"),
+        "EPUB/text/ch001.xhtml": (XHTML % ch001).encode("utf-8"),
+        "EPUB/text/ch002.xhtml": (XHTML % '<p id="dos"><img src="../media/a%20b.png" alt=""/></p><svg xmlns="http://www.w3.org/2000/svg"><image xlink:href="../media/a%20b.png"/></svg>').encode("utf-8"),
+        "EPUB/media/a b.png": b"png",
+    }
+    files.update(extra)
+    return files
+
+
+def test_epub_correcto():
+    assert valida(_epub(ch001='<p id="uno"><a href="ch002.xhtml#dos">2</a> <a href="https://example.com/#x">web</a> <a href="mailto:a@b.c">correo</a></p>')) == []
+
+
+def test_enlace_roto():
+    assert valida(_epub(ch001='<p id="uno"><a href="ch003.xhtml">3</a><img src="../media/c.png" alt=""/></p>')) == [
+        "EPUB/text/ch001.xhtml: ch003.xhtml no existe",
+        "EPUB/text/ch001.xhtml: ../media/c.png no existe",
+    ]
+
+
+def test_otras_urls_rotas():
+    ch001 = ('<p id="uno"><video poster="../media/p.png" src="../media/a%20b.png"/>'
+             '<img src="../media/a%20b.png" srcset="../media/a%20b.png 1x, ../media/x2.png 2x" alt=""/>'
+             '<span style="background: url(\'../media/f.png\')">s</span></p>')
+    assert valida(_epub(ch001=ch001)) == [
+        "EPUB/text/ch001.xhtml: ../media/p.png no existe",
+        "EPUB/text/ch001.xhtml: ../media/x2.png no existe",
+        "EPUB/text/ch001.xhtml: ../media/f.png no existe",
+    ]
+
+
+def test_fragmento_roto():
+    assert valida(_epub(ch001='<p id="uno"><a href="ch002.xhtml#tres">2</a> <a href="#cuatro">1</a></p>')) == [
+        "EPUB/text/ch001.xhtml: ch002.xhtml#tres apunta a un id que no existe",
+        "EPUB/text/ch001.xhtml: #cuatro apunta a un id que no existe",
+    ]
+
+
+def test_manifest():
+    errores = valida(_epub(item='<item id="css" href="styles/a.css" media-type="text/css"/>\n', **{"EPUB/fonts/f.otf": b"otf"}))
+    assert errores == [
+        "EPUB/content.opf: styles/a.css está en el manifest pero no en el epub",
+        "EPUB/fonts/f.otf: no está en el manifest",
+    ]
+
+
+def test_spine_y_documentos_mal_formados():
+    errores = valida(_epub(itemref='<itemref idref="ch003"/>\n', ch001="<p>sin cerrar"))
+    assert errores[0] == "EPUB/content.opf: el itemref ch003 del spine no está en el manifest"
+    assert errores[1].startswith("EPUB/text/ch001.xhtml: ")
+    assert len(errores) == 2
+
+
+def test_mimetype():
+    files = _epub()
+    mimetype = files.pop("mimetype")
+    files["mimetype"] = mimetype
+    assert valida(files) == ["mimetype: no es el primer fichero"]
+    del files["mimetype"]
+    assert valida(files) == ["mimetype: no existe o no es application/epub+zip", "mimetype: no es el primer fichero"]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import posixpath
+import re
+import sys
+import zipfile
+from typing import Dict, List, Set, Tuple
+from urllib.parse import unquote
+
+from lxml import etree
+
+NS_CONTAINER = "urn:oasis:names:tc:opendocument:xmlns:container"
+NS_OPF = "http://www.idpf.org/2007/opf"
+NS_XLINK = "http://www.w3.org/1999/xlink"
+# Documentos cuyos enlaces e ids se comprueban
+TIPOS_XML = ("application/xhtml+xml", "application/x-dtbncx+xml")
+
+re_esquema = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+re_comentario_css = re.compile(r"/\*.*?\*/", re.DOTALL)
+# url() con o sin comillas, y @import sin url()
+re_url_css = re.compile(r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^)"'\s]*))\s*\)|@import\s+(?:"([^"]*)"|'([^']*)')""")
+# Atributos que llevan una url (y srcset, que lleva varias)
+ATRIBUTOS_URL = ("href", "src", "{%s}href" % NS_XLINK, "poster", "data", "altimg")
+
+parser_xml = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+
+def _resuelve(base: str, ref: str) -> Tuple[str, str]:
+    """
+    (fichero, fragmento) al que apunta ref desde el fichero base
+    """
+    path, _, fragmento = ref.partition("#")
+    if not path:
+        return base, fragmento
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(base), unquote(path)))
+    return path, unquote(fragmento)
+
+
+def referencias_css(css: str) -> List[str]:
+    """
+    urls de un css: las de url() y las de @import
+    """
+    css = re_comentario_css.sub("", css)
+    return [next(g for g in m.groups() if g is not None).strip() for m in re_url_css.finditer(css)]
+
+
+def referencias(root: etree._Element) -> List[str]:
+    """
+    urls de un documento: las de los atributos que las llevan, cada una de
+    las de srcset y las del css de los style
+    """
+    refs = []
+    for el in root.iter(etree.Element):
+        for attr in ATRIBUTOS_URL:
+            v = el.get(attr)
+            if v is not None:
+                refs.append(v.strip())
+        v = el.get("srcset")
+        if v is not None:
+            refs.extend(c.split()[0] for c in v.split(",") if c.strip())
+        v = el.get("style")
+        if v is not None:
+            refs.extend(referencias_css(v))
+        if el.text and el.tag.rpartition("}")[2] == "style":
+            refs.extend(referencias_css(el.text))
+    return refs
+
+
+def valida(files: Dict[str, bytes]) -> List[str]:
+    """
+    Comprobación estructural rápida de un epub en memoria {nombre: contenido}:
+    mimetype, container.xml, que el manifest y los ficheros coincidan, que
+    el spine apunte a items del manifest, que los xhtml, toc.ncx y nav.xhtml
+    estén bien formados y que todos sus href, src y #fragmento apunten a
+    ficheros e ids que existen.
+    No sustituye a epubcheck (no valida contra los esquemas ni el css),
+    pero se hace en milisegundos. Devuelve la lista de errores.
+    """
+    errores = []
+    if files.get("mimetype", b"").strip() != b"application/epub+zip":
+        errores.append("mimetype: no existe o no es application/epub+zip")
+    if next(iter(files), None) != "mimetype":
+        errores.append("mimetype: no es el primer fichero")
+
+    try:
+        container = etree.fromstring(files["META-INF/container.xml"], parser_xml)
+    except KeyError:
+        return errores + ["META-INF/container.xml: no existe"]
+    except etree.XMLSyntaxError as e:
+        return errores + [f"META-INF/container.xml: {e}"]
+    rootfile = container.find(f".//{{{NS_CONTAINER}}}rootfile")
+    opf = rootfile.get("full-path") if rootfile is not None else None
+    if opf not in files:
+        return errores + [f"META-INF/container.xml: el opf {opf} no existe"]
+
+    try:
+        root = etree.fromstring(files[opf], parser_xml)
+    except etree.XMLSyntaxError as e:
+        return errores + [f"{opf}: {e}"]
+
+    manifest: Dict[str, str] = {}
+    tipos: Dict[str, str] = {}
+    for item in root.iterfind(f"{{{NS_OPF}}}manifest/{{{NS_OPF}}}item"):
+        item_id, href = item.get("id"), item.get("href")
+        if item_id in manifest:
+            errores.append(f"{opf}: id {item_id} repetido en el manifest")
+        path, _ = _resuelve(opf, href or "")
+        manifest[item_id] = path
+        tipos[path] = item.get("media-type", "")
+        if path not in files:
+            errores.append(f"{opf}: {href} está en el manifest pero no en el epub")
+    declarados = set(manifest.values())
+    for name in files:
+        if name != "mimetype" and name != opf and not name.startswith("META-INF/") and name not in declarados:
+            errores.append(f"{name}: no está en el manifest")
+
+    spine = root.find(f"{{{NS_OPF}}}spine")
+    if spine is None:
+        errores.append(f"{opf}: no tiene spine")
+    else:
+        toc = spine.get("toc")
+        if toc is not None and toc not in manifest:
+            errores.append(f"{opf}: el toc {toc} del spine no está en el manifest")
+        for ref in spine.iterfind(f"{{{NS_OPF}}}itemref"):
+            if ref.get("idref") not in manifest:
+                errores.append(f"{opf}: el itemref {ref.get('idref')} del spine no está en el manifest")
+
+    # Una sola lectura de cada documento para sacar sus ids y sus enlaces
+    ids: Dict[str, Set[str]] = {}
+    enlaces: Dict[str, List[str]] = {}
+    for path, tipo in tipos.items():
+        if tipo not in TIPOS_XML or path not in files:
+            continue
+        try:
+            doc = etree.fromstring(files[path], parser_xml)
+        except etree.XMLSyntaxError as e:
+            errores.append(f"{path}: {e}")
+            continue
+        ids[path] = set(doc.xpath("//@id"))
+        enlaces[path] = referencias(doc)
+
+    for path, refs in enlaces.items():
+        for ref in refs:
+            if not ref or re_esquema.match(ref):
+                continue
+            destino, fragmento = _resuelve(path, ref)
+            if destino not in files:
+                errores.append(f"{path}: {ref} no existe")
+            elif fragmento and destino in ids and fragmento not in ids[destino]:
+                errores.append(f"{path}: {ref} apunta a un id que no existe")
+    return errores
+
+
+def valida_zip(file: str) -> List[str]:
+    with zipfile.ZipFile(file, "r") as zip_ref:
+        return valida({i.filename: zip_ref.read(i) for i in zip_ref.infolist() if not i.is_dir()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Comprobación estructural rápida de epubs')
+    parser.add_argument("epub", nargs="+", help="Ficheros epub")
+    arg = parser.parse_args()
+    mal = 0
+    for file in arg.epub:
+        errores = valida_zip(file)
+        print(f"{file}: {len(errores)} errores" if errores else f"{file}: OK")
+        for e in errores:
+            print("  " + e)
+        mal += bool(errores)
+    if mal:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()